@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmarks for the shared code in common/ and the spike_sorting_utils helpers
+
+Generates synthetic NWB files (noise plus spikes, with a units table) for each dataset
+in the config, times the hot paths on them and writes a JSON report:
+
+    NwbRecording open and get_traces, make_int16_recording, make_float32_recording,
+    _scale_recording_if_float_type, NwbSorting load, create_sorting_out_nwb_file,
+    compute_correlogram_data and compute_templates
+
+Each benchmark is repeated and the median wall time is reported. When a baseline is
+given, every benchmark that is slower than the baseline by more than the threshold is
+flagged as a regression and the script exits with a non-zero status. Timings depend on
+the machine, so baselines should be recorded and compared on the same machine (or the
+same type of machine), e.g.:
+
+    python run_micro_benchmarks.py --save-baseline baseline.json
+    ... change the code ...
+    python run_micro_benchmarks.py --baseline baseline.json
+
+The config file lists the synthetic datasets:
+    {
+        "datasets": [
+            {"label": "int16-32ch-gzip", "num_channels": 32, "duration_sec": 30, "dtype": "int16", "chunks": [30000, 32], "compression": "gzip"},
+            {"label": "float32-64ch-contiguous", "num_channels": 64, "duration_sec": 30, "dtype": "float32", "chunks": null, "compression": null}
+        ]
+    }
+Missing dataset fields take the values of _default_dataset.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+from typing import Callable, List, Union
+import numpy as np
+
+
+_default_dataset = {
+    'num_channels': 32,
+    'duration_sec': 30,
+    'sampling_frequency': 30000,
+    'dtype': 'int16',
+    'chunks': [30000, 32], # frames x channels, or null for a contiguous dataset
+    'compression': 'gzip', # gzip, lzf or null
+    'num_units': 20,
+    'firing_rate_hz': 10,
+    'seed': 0
+}
+
+_default_config = {
+    'datasets': [
+        {'label': 'int16-32ch-gzip'},
+        {'label': 'int16-32ch-contiguous', 'chunks': None, 'compression': None},
+        {'label': 'float32-64ch-chunked', 'num_channels': 64, 'dtype': 'float32', 'chunks': [3000, 64], 'compression': None}
+    ]
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the shared NWB and recording code')
+    parser.add_argument('--config', default=None, help='JSON file listing the synthetic datasets (default: see _default_config)')
+    parser.add_argument('--output-dir', default='micro_benchmark_output', help='Directory for the synthetic files, the scratch files and the report')
+    parser.add_argument('--num-repeats', type=int, default=3, help='Number of times each benchmark is run')
+    parser.add_argument('--baseline', default=None, help='Baseline report to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='Flag a regression when a benchmark is slower than the baseline by more than this factor')
+    parser.add_argument('--save-baseline', default=None, help='Also write the report to this path, to be used as --baseline later')
+    args = parser.parse_args()
+
+    if args.config is not None:
+        with open(args.config, 'r') as f:
+            config = json.load(f)
+    else:
+        config = _default_config
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    report = {
+        'environment': _get_environment(),
+        'num_repeats': args.num_repeats,
+        'results': []
+    }
+    for dataset in config['datasets']:
+        dataset = {**_default_dataset, **dataset}
+        print(f'=== Dataset {dataset["label"]}')
+        report['results'].extend(run_dataset_benchmarks(dataset=dataset, output_dir=args.output_dir, num_repeats=args.num_repeats))
+
+    json_fname = os.path.join(args.output_dir, 'micro_benchmark_report.json')
+    with open(json_fname, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Wrote {json_fname}')
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Wrote baseline {args.save_baseline}')
+
+    _print_results(report)
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(report, baseline, threshold=args.threshold)
+        if len(regressions) > 0:
+            print(f'{len(regressions)} regression(s) with respect to {args.baseline}:')
+            for r in regressions:
+                print(f'  {r["dataset"]} / {r["benchmark"]}: {r["median_sec"]:.4f} s vs {r["baseline_median_sec"]:.4f} s ({r["ratio"]:.2f}x)')
+            sys.exit(1)
+        print(f'No regressions with respect to {args.baseline} (threshold {args.threshold}x)')
+
+def run_dataset_benchmarks(*, dataset: dict, output_dir: str, num_repeats: int) -> List[dict]:
+    import pynwb
+    from common.NwbRecording import NwbRecording
+    from common.NwbSorting import NwbSorting
+    from common.make_int16_recording import make_int16_recording
+    from common.make_float32_recording import make_float32_recording
+    from common._scale_recording_if_float_type import _scale_recording_if_float_type
+    from common.create_sorting_out_nwb_file import create_sorting_out_nwb_file
+    from helpers.compute_correlogram_data import compute_correlogram_data
+    from helpers.compute_templates import compute_templates
+
+    label = dataset['label']
+    nwb_fname = os.path.join(output_dir, f'{label}.nwb')
+    print(f'Generating {nwb_fname}')
+    generate_synthetic_nwb(nwb_fname, **{k: v for k, v in dataset.items() if k != 'label'})
+    scratch_dir = os.path.join(output_dir, 'scratch')
+    if os.path.exists(scratch_dir):
+        shutil.rmtree(scratch_dir)
+    os.makedirs(scratch_dir)
+
+    electrical_series_path = '/acquisition/ElectricalSeries'
+    sampling_frequency = dataset['sampling_frequency']
+    recording = NwbRecording(file=open(nwb_fname, 'rb'), electrical_series_path=electrical_series_path)
+    sorting = NwbSorting(open(nwb_fname, 'rb'), sampling_frequency=sampling_frequency)
+    num_frames = recording.get_num_frames()
+    num_channels = recording.get_num_channels()
+    bytes_per_sample = np.dtype(dataset['dtype']).itemsize
+    # one-second blocks spread over the recording
+    block_size = min(num_frames, int(sampling_frequency))
+    block_starts = np.linspace(0, num_frames - block_size, 10).astype(int)
+    # the first 10 seconds for the template computation
+    templates_traces = recording.get_traces(start_frame=0, end_frame=min(num_frames, int(sampling_frequency * 10))).astype(np.float32)
+    templates_sorting = sorting.frame_slice(0, templates_traces.shape[0])
+
+    def get_traces():
+        for start in block_starts:
+            recording.get_traces(start_frame=int(start), end_frame=int(start) + block_size)
+
+    def scale_and_get_traces():
+        recording_scaled = _scale_recording_if_float_type(recording)
+        recording_scaled.get_traces(start_frame=0, end_frame=block_size)
+
+    def create_sorting_out():
+        with pynwb.NWBHDF5IO(file=_open_h5(nwb_fname), mode='r', load_namespaces=True) as io:
+            nwbfile_rec = io.read()
+            create_sorting_out_nwb_file(nwbfile_rec=nwbfile_rec, sorting=sorting, sorting_out_fname=os.path.join(scratch_dir, 'sorting.nwb'))
+
+    def compute_autocorrelograms():
+        for unit_id in sorting.get_unit_ids():
+            compute_correlogram_data(sorting=sorting, unit_id1=unit_id, unit_id2=None, window_size_msec=50, bin_size_msec=1)
+
+    benchmarks = [
+        ('nwb_recording_open', lambda: NwbRecording(file=open(nwb_fname, 'rb'), electrical_series_path=electrical_series_path), 0),
+        ('nwb_recording_get_traces', get_traces, len(block_starts) * block_size * num_channels),
+        ('make_int16_recording', lambda: make_int16_recording(recording, dirname=os.path.join(scratch_dir, 'int16_recording')), num_frames * num_channels),
+        ('make_float32_recording', lambda: make_float32_recording(recording, dirname=os.path.join(scratch_dir, 'float32_recording')), num_frames * num_channels),
+        ('scale_recording_if_float_type', scale_and_get_traces, block_size * num_channels),
+        ('nwb_sorting_load', lambda: NwbSorting(open(nwb_fname, 'rb'), sampling_frequency=sampling_frequency), 0),
+        ('create_sorting_out_nwb_file', create_sorting_out, 0),
+        ('compute_correlogram_data', compute_autocorrelograms, 0),
+        ('compute_templates', lambda: compute_templates(traces=templates_traces, sorting=templates_sorting), templates_traces.size)
+    ]
+    results = []
+    for name, func, num_samples in benchmarks:
+        wall_times_sec = _time_repeats(func, num_repeats=num_repeats)
+        median_sec = float(np.median(wall_times_sec))
+        results.append({
+            'dataset': label,
+            'dataset_params': dataset,
+            'benchmark': name,
+            'wall_times_sec': wall_times_sec,
+            'min_sec': min(wall_times_sec),
+            'median_sec': median_sec,
+            'samples_per_sec': num_samples / median_sec if num_samples and median_sec > 0 else None,
+            'mb_per_sec': num_samples * bytes_per_sample / 1e6 / median_sec if num_samples and median_sec > 0 else None
+        })
+        print(f'{label} / {name}: {median_sec:.4f} s (median of {num_repeats})')
+    shutil.rmtree(scratch_dir)
+    return results
+
+def generate_synthetic_nwb(
+    fname: str,
+    *,
+    num_channels: int,
+    duration_sec: float,
+    sampling_frequency: float,
+    dtype: str,
+    chunks: Union[List[int], None],
+    compression: Union[str, None],
+    num_units: int,
+    firing_rate_hz: float,
+    seed: int
+):
+    """
+    Write an NWB file with Gaussian noise plus spikes (a fixed waveform on a few channels
+    per unit, at Poisson times) in /acquisition/ElectricalSeries and the spike times in
+    the units table, so that it can be read with NwbRecording and NwbSorting.
+    """
+    from uuid import uuid4
+    from datetime import datetime
+    import pynwb
+    from pynwb.ecephys import ElectricalSeries
+    from hdmf.backends.hdf5.h5_utils import H5DataIO
+
+    rng = np.random.default_rng(seed)
+    num_frames = int(duration_sec * sampling_frequency)
+    traces = rng.normal(scale=10, size=(num_frames, num_channels)).astype(np.float32)
+    waveform = (-100 * np.exp(-np.linspace(-3, 3, 30) ** 2)).astype(np.float32)
+    unit_spike_frames = []
+    for i in range(num_units):
+        num_spikes = rng.poisson(firing_rate_hz * duration_sec)
+        frames = np.unique(rng.integers(0, num_frames - len(waveform), size=num_spikes))
+        channels = (i * num_channels // max(num_units, 1) + np.arange(min(3, num_channels))) % num_channels
+        for c in channels:
+            np.add.at(traces[:, c], frames[:, None] + np.arange(len(waveform))[None, :], waveform[None, :])
+        unit_spike_frames.append(frames)
+    if np.dtype(dtype).kind in ['i', 'u']:
+        traces = np.clip(traces, np.iinfo(dtype).min, np.iinfo(dtype).max)
+    traces = traces.astype(dtype)
+
+    nwbfile = pynwb.NWBFile(
+        session_description='Synthetic recording for micro-benchmarks',
+        identifier=str(uuid4()),
+        session_start_time=datetime.now().astimezone(),
+        subject=pynwb.file.Subject(
+            subject_id='synthetic',
+            species='Mus musculus',
+            description='Synthetic recording'
+        )
+    )
+    device = nwbfile.create_device(name='synthetic', description='Synthetic probe')
+    electrode_group = nwbfile.create_electrode_group(name='probe', description='Synthetic probe', location='synthetic', device=device)
+    for i in range(num_channels):
+        nwbfile.add_electrode(group=electrode_group, location='synthetic', x=0.0, y=float(i * 20), z=0.0)
+    electrodes = nwbfile.create_electrode_table_region(region=list(range(num_channels)), description='all electrodes')
+    electrical_series = ElectricalSeries(
+        name='ElectricalSeries',
+        data=H5DataIO(
+            data=traces,
+            chunks=tuple(min(c, s) for c, s in zip(chunks, traces.shape)) if chunks is not None else None,
+            compression=compression
+        ),
+        electrodes=electrodes,
+        starting_time=0.0,
+        rate=float(sampling_frequency)
+    )
+    nwbfile.add_acquisition(electrical_series)
+    for i in range(num_units):
+        nwbfile.add_unit(id=i + 1, spike_times=unit_spike_frames[i] / sampling_frequency)
+    with pynwb.NWBHDF5IO(fname, 'w') as io: # type: ignore
+        io.write(nwbfile, cache_spec=True) # type: ignore
+
+def compare_to_baseline(report: dict, baseline: dict, *, threshold: float) -> List[dict]:
+    """Return the benchmarks whose median wall time exceeds threshold times that of the baseline"""
+    baseline_results = {(r['dataset'], r['benchmark']): r for r in baseline['results']}
+    regressions = []
+    for r in report['results']:
+        b = baseline_results.get((r['dataset'], r['benchmark']), None)
+        if b is None:
+            continue
+        if b['dataset_params'] != r['dataset_params']:
+            print(f'Warning: dataset {r["dataset"]} has different parameters in the baseline; not comparing')
+            continue
+        ratio = r['median_sec'] / b['median_sec'] if b['median_sec'] > 0 else float('inf')
+        r['baseline_median_sec'] = b['median_sec']
+        r['ratio'] = ratio
+        if ratio > threshold:
+            regressions.append(r)
+    return regressions
+
+def _time_repeats(func: Callable[[], object], *, num_repeats: int) -> List[float]:
+    ret = []
+    for _ in range(num_repeats):
+        t0 = time.perf_counter()
+        func()
+        ret.append(time.perf_counter() - t0)
+    return ret
+
+def _open_h5(fname: str):
+    import h5py
+    return h5py.File(open(fname, 'rb'), 'r')
+
+def _print_results(report: dict):
+    print('')
+    print(f'{"Dataset":<28} {"Benchmark":<32} {"Median (s)":>10} {"MB/s":>10}')
+    for r in report['results']:
+        mb_per_sec = f'{r["mb_per_sec"]:.1f}' if r['mb_per_sec'] is not None else ''
+        print(f'{r["dataset"]:<28} {r["benchmark"]:<32} {r["median_sec"]:>10.4f} {mb_per_sec:>10}')
+    print('')
+
+def _get_environment() -> dict:
+    import importlib.metadata
+    versions = {}
+    for pkg in ['spikeinterface', 'pynwb', 'h5py', 'numpy']:
+        try:
+            versions[pkg] = importlib.metadata.version(pkg)
+        except importlib.metadata.PackageNotFoundError:
+            versions[pkg] = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'versions': versions
+    }
+
+if __name__ == '__main__':
+    main()
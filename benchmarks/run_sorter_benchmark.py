@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+"""
+Ground-truth spike sorting benchmark
+
+Runs the MountainSort5 processor pipeline (NwbRecording -> preprocessing -> binary
+conversion -> sorting) on synthetic NWB recordings with ground-truth units (for
+example the output of mearec_generate_recording), records wall time, CPU time and
+peak RSS for each stage, matches the sorted units to the ground truth and writes
+a JSON and a Markdown report.
+
+Kilosort runs are supported through spikeinterface but are optional: they are
+reported as skipped when the sorter is not installed, so the benchmark can run on
+CPU-only machines.
+
+Usage:
+    python run_sorter_benchmark.py --recording gt1.nwb --recording gt2.nwb --config config.json --output-dir benchmark_output
+
+The config file lists the runs to benchmark:
+    {
+        "runs": [
+            {"label": "ms5-scheme2", "sorter": "mountainsort5", "params": {"scheme": 2}},
+            {"label": "ms5-scheme1-thr6", "sorter": "mountainsort5", "params": {"scheme": 1, "detect_threshold": 6}},
+            {"label": "ms5-scheme2-int16", "sorter": "mountainsort5", "params": {"preprocessing": {"scratch_dtype": "int16"}}},
+            {"label": "ms5-scheme2-zstd", "sorter": "mountainsort5", "params": {"preprocessing": {"scratch_compression": "zstd"}}},
+            {"label": "ks2_5", "sorter": "kilosort2_5", "params": {}}
+        ]
+    }
+MountainSort5 params use the same names as the mountainsort5 processor parameters
+(with nested "scheme2" and "preprocessing" objects). To compare mountainsort5 with
+mountainsort5_dev, run the benchmark in both images and pass the first report with
+--baseline-report when producing the second.
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+from copy import deepcopy
+from typing import Union
+from common.StageProfiler import StageProfiler
+
+
+_default_config = {
+    'runs': [
+        {'label': 'mountainsort5-scheme2', 'sorter': 'mountainsort5', 'params': {}}
+    ]
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='Ground-truth spike sorting benchmark')
+    parser.add_argument('--recording', action='append', required=True, help='Synthetic NWB recording with ground-truth units (may be repeated)')
+    parser.add_argument('--electrical-series-path', default='/acquisition/ElectricalSeries', help='Path to the electrical series in the NWB files')
+    parser.add_argument('--config', default=None, help='JSON file listing the runs to benchmark (default: MountainSort5 scheme 2)')
+    parser.add_argument('--output-dir', default='benchmark_output', help='Directory for the scratch files and the reports')
+    parser.add_argument('--test-duration-sec', type=float, default=0, help='Only use the first N seconds of each recording (0 means all)')
+    parser.add_argument('--baseline-report', default=None, help='Previous benchmark_report.json to compare against in the Markdown report')
+    args = parser.parse_args()
+
+    if args.config is not None:
+        with open(args.config, 'r') as f:
+            config = json.load(f)
+    else:
+        config = _default_config
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    report = {
+        'environment': _get_environment(),
+        'results': []
+    }
+    for recording_path in args.recording:
+        for run in config['runs']:
+            print(f'=== Benchmarking {run["label"]} on {recording_path}')
+            result = run_benchmark(
+                recording_path=recording_path,
+                electrical_series_path=args.electrical_series_path,
+                run=run,
+                scratch_dir=os.path.join(args.output_dir, 'scratch'),
+                test_duration_sec=args.test_duration_sec
+            )
+            report['results'].append(result)
+
+    baseline = None
+    if args.baseline_report is not None:
+        with open(args.baseline_report, 'r') as f:
+            baseline = json.load(f)
+
+    json_fname = os.path.join(args.output_dir, 'benchmark_report.json')
+    with open(json_fname, 'w') as f:
+        json.dump(report, f, indent=2)
+    md_fname = os.path.join(args.output_dir, 'benchmark_report.md')
+    with open(md_fname, 'w') as f:
+        f.write(_make_markdown_report(report, baseline=baseline))
+    print(f'Wrote {json_fname} and {md_fname}')
+
+def run_benchmark(*, recording_path: str, electrical_series_path: str, run: dict, scratch_dir: str, test_duration_sec: float) -> dict:
+    from common.NwbRecording import NwbRecording
+    from common.NwbSorting import NwbSorting
+
+    result = {
+        'recording': recording_path,
+        'label': run['label'],
+        'sorter': run['sorter'],
+        'params': run.get('params', {}),
+        'stages': [],
+        'skipped': None
+    }
+    if run['sorter'] not in _sorter_runners:
+        raise Exception(f'Unexpected sorter: {run["sorter"]}')
+    skip_reason = _sorter_runners[run['sorter']]['check'](run['sorter'])
+    if skip_reason is not None:
+        print(f'Skipping {run["label"]}: {skip_reason}')
+        result['skipped'] = skip_reason
+        return result
+
+    if os.path.exists(scratch_dir):
+        shutil.rmtree(scratch_dir)
+    os.makedirs(scratch_dir)
+
+    profiler = StageProfiler(run['label'])
+    with profiler.stage('open'):
+        recording = NwbRecording(
+            file=open(recording_path, 'rb'),
+            electrical_series_path=electrical_series_path
+        )
+        if test_duration_sec > 0:
+            recording = recording.frame_slice(0, min(recording.get_num_frames(), int(recording.get_sampling_frequency() * test_duration_sec)))
+    num_samples = recording.get_num_frames() * recording.get_num_channels()
+    result['recording_info'] = {
+        'num_channels': recording.get_num_channels(),
+        'num_frames': recording.get_num_frames(),
+        'sampling_frequency': recording.get_sampling_frequency(),
+        'duration_sec': recording.get_num_frames() / recording.get_sampling_frequency(),
+        'dtype': str(recording.get_dtype())
+    }
+
+    sorting = _sorter_runners[run['sorter']]['run'](
+        recording=recording,
+        sorter_name=run['sorter'],
+        params=run.get('params', {}),
+        scratch_dir=scratch_dir,
+        profiler=profiler,
+        num_samples=num_samples
+    )
+
+    with profiler.stage('compare'):
+        import spikeinterface.comparison as sc
+        gt_sorting = NwbSorting(open(recording_path, 'rb'), sampling_frequency=recording.get_sampling_frequency())
+        if test_duration_sec > 0:
+            gt_sorting = gt_sorting.frame_slice(0, recording.get_num_frames())
+        comparison = sc.compare_sorter_to_ground_truth(gt_sorting, sorting, exhaustive_gt=True)
+        performance = comparison.get_performance()
+    result['stages'] = profiler.stages
+    result['scratch_bytes'] = profiler.metadata.get('scratch_bytes', None)
+    result['accuracy'] = {
+        'num_gt_units': len(gt_sorting.get_unit_ids()),
+        'num_sorted_units': len(sorting.get_unit_ids()),
+        'num_well_detected_units': int(comparison.count_well_detected_units(0.8)),
+        'num_false_positive_units': int(comparison.count_false_positive_units()),
+        'num_redundant_units': int(comparison.count_redundant_units()),
+        'num_overmerged_units': int(comparison.count_overmerged_units()),
+        'mean_accuracy': float(performance['accuracy'].mean()),
+        'mean_precision': float(performance['precision'].mean()),
+        'mean_recall': float(performance['recall'].mean()),
+        'per_unit': {
+            str(unit_id): {k: float(performance.loc[unit_id, k]) for k in ['accuracy', 'precision', 'recall']}
+            for unit_id in performance.index
+        }
+    }
+    result['total_wall_time_sec'] = sum(s['wall_time_sec'] for s in profiler.stages if s['name'] != 'compare')
+    shutil.rmtree(scratch_dir)
+    return result
+
+def _run_mountainsort5(*, recording, sorter_name: str, params: dict, scratch_dir: str, profiler: StageProfiler, num_samples: int):
+    from common.make_scratch_recording import make_scratch_recording
+    from common.preprocess_for_mountainsort5 import preprocess_for_mountainsort5
+    from common.run_mountainsort5_sorting import run_mountainsort5_sorting
+
+    # a validated parameter model, like the context of the processor (e.g., scheme 0 copies it with model_copy)
+    parameters_class = _get_mountainsort5_parameters_class()
+    context = parameters_class.model_validate(_merge_params(_get_model_defaults(parameters_class), params))
+    with profiler.stage('preprocess'):
+        recording_preprocessed = preprocess_for_mountainsort5(recording, preprocessing=context.preprocessing)
+    # the throughput of these stages is in bytes of the scratch recording (as written, i.e., for the scratch dtype and after compression)
+    with profiler.stage('convert', num_samples=num_samples) as st:
+        recording_binary = make_scratch_recording(recording_preprocessed, dirname=os.path.join(scratch_dir, 'preprocessed_recording'), dtype=context.preprocessing.scratch_dtype, compression=context.preprocessing.scratch_compression)
+        scratch_bytes = _get_dir_size(os.path.join(scratch_dir, 'preprocessed_recording'))
+        st['num_bytes'] = scratch_bytes
+    profiler.record_metadata('scratch_bytes', scratch_bytes)
+    with profiler.stage('sort', num_samples=num_samples, num_bytes=scratch_bytes):
+        sorting = run_mountainsort5_sorting(recording=recording_binary, context=context)
+    return sorting
+
+def _run_kilosort(*, recording, sorter_name: str, params: dict, scratch_dir: str, profiler: StageProfiler, num_samples: int):
+    import spikeinterface.sorters as ss
+    from common.make_int16_recording import make_int16_recording
+
+    with profiler.stage('convert', num_samples=num_samples, num_bytes=num_samples * 2):
+        recording_binary = make_int16_recording(recording, dirname=os.path.join(scratch_dir, 'int16_recording'))
+    with profiler.stage('sort', num_samples=num_samples, num_bytes=num_samples * 2):
+        os.environ['HOME'] = '/tmp' # see run_kilosort2_5.py
+        sorting = ss.run_sorter(sorter_name, recording_binary, output_folder=os.path.join(scratch_dir, 'sorting_output'), **params, verbose=True)
+    return sorting
+
+def _check_mountainsort5(sorter_name: str) -> Union[str, None]:
+    try:
+        import mountainsort5 # noqa
+    except ImportError:
+        return 'mountainsort5 is not installed'
+    return None
+
+def _check_kilosort(sorter_name: str) -> Union[str, None]:
+    from spikeinterface.sorters.sorterlist import sorter_dict
+    if not sorter_dict[sorter_name].is_installed():
+        return f'{sorter_name} is not installed'
+    return None
+
+_sorter_runners = {
+    'mountainsort5': {'check': _check_mountainsort5, 'run': _run_mountainsort5},
+    'kilosort2_5': {'check': _check_kilosort, 'run': _run_kilosort},
+    'kilosort3': {'check': _check_kilosort, 'run': _run_kilosort}
+}
+
+def _merge_params(defaults: dict, params: dict) -> dict:
+    ret = deepcopy(defaults)
+    for k, v in params.items():
+        if k not in ret:
+            raise Exception(f'Unexpected parameter: {k}')
+        if isinstance(ret[k], dict):
+            ret[k] = _merge_params(ret[k], v)
+        else:
+            ret[k] = v
+    return ret
+
+def _get_mountainsort5_parameters_class():
+    # the parameters shared by the contexts of the mountainsort5 processors, so that the runs use the same defaults as the processors
+    mountainsort5_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mountainsort5')
+    if mountainsort5_dir not in sys.path:
+        sys.path.append(mountainsort5_dir)
+    from models import Mountainsort5Parameters
+    return Mountainsort5Parameters
+
+def _get_model_defaults(model_class) -> dict:
+    # the defaults of the fields that have one, and of the nested parameter models (e.g., scheme2 and preprocessing)
+    from pydantic import BaseModel
+    ret = {}
+    for name, field in model_class.model_fields.items():
+        if not field.is_required():
+            ret[name] = deepcopy(field.get_default(call_default_factory=True))
+        elif isinstance(field.annotation, type) and issubclass(field.annotation, BaseModel):
+            ret[name] = _get_model_defaults(field.annotation)
+    return ret
+
+def _get_dir_size(dirname: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, fname)) for root, _, fnames in os.walk(dirname) for fname in fnames)
+
+def _get_environment() -> dict:
+    import importlib.metadata
+    versions = {}
+    for pkg in ['mountainsort5', 'spikeinterface', 'numpy', 'h5py']:
+        try:
+            versions[pkg] = importlib.metadata.version(pkg)
+        except importlib.metadata.PackageNotFoundError:
+            versions[pkg] = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'versions': versions
+    }
+
+def _make_markdown_report(report: dict, *, baseline: Union[dict, None]) -> str:
+    env = report['environment']
+    lines = [
+        '# Spike sorting benchmark',
+        '',
+        f'Python {env["python"]} on {env["platform"]} ({env["cpu_count"]} CPUs)',
+        '',
+        ', '.join(f'{k} {v}' for k, v in env['versions'].items()),
+        ''
+    ]
+    baseline_results = {}
+    if baseline is not None:
+        baseline_results = {(r['recording'], r['label']): r for r in baseline['results']}
+    for r in report['results']:
+        lines.append(f'## {r["label"]} on {r["recording"]}')
+        lines.append('')
+        if r['skipped'] is not None:
+            lines.append(f'Skipped: {r["skipped"]}')
+            lines.append('')
+            continue
+        info = r['recording_info']
+        lines.append(f'{info["num_channels"]} channels, {info["duration_sec"]:.1f} s at {info["sampling_frequency"]} Hz ({info["dtype"]})')
+        lines.append('')
+        lines.append('| Stage | Wall (s) | CPU (s) | Peak RSS (MB) | Samples/s | MB/s |')
+        lines.append('| --- | --- | --- | --- | --- | --- |')
+        for s in r['stages']:
+            samples_per_sec = f'{s["samples_per_sec"]:.3g}' if s['samples_per_sec'] is not None else ''
+            mb_per_sec = f'{s["mb_per_sec"]:.1f}' if s['mb_per_sec'] is not None else ''
+            lines.append(f'| {s["name"]} | {s["wall_time_sec"]:.2f} | {s["cpu_time_sec"]:.2f} | {s["peak_rss_mb"]:.0f} | {samples_per_sec} | {mb_per_sec} |')
+        lines.append('')
+        a = r['accuracy']
+        lines.append(f'Units: {a["num_sorted_units"]} sorted, {a["num_gt_units"]} ground truth, {a["num_well_detected_units"]} well detected, {a["num_false_positive_units"]} false positive, {a["num_redundant_units"]} redundant, {a["num_overmerged_units"]} overmerged')
+        lines.append('')
+        lines.append(f'Mean accuracy {a["mean_accuracy"]:.3f}, precision {a["mean_precision"]:.3f}, recall {a["mean_recall"]:.3f}; total time {r["total_wall_time_sec"]:.1f} s')
+        if r.get('scratch_bytes', None) is not None:
+            lines.append('')
+            lines.append(f'Scratch: {r["scratch_bytes"] / 1e6:.1f} MB written')
+        b = baseline_results.get((r['recording'], r['label']), None)
+        if b is not None and b['skipped'] is None:
+            lines.append('')
+            lines.append(f'Baseline: mean accuracy {b["accuracy"]["mean_accuracy"]:.3f}, total time {b["total_wall_time_sec"]:.1f} s ({r["total_wall_time_sec"] / b["total_wall_time_sec"]:.2f}x)')
+        lines.append('')
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import time
+from typing import Any, Callable, Dict, List, Union
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+
+
+class BatchScheduler:
+    """
+    Run the tasks of a batch job on a local process pool within a memory and disk budget.
+
+    Each task is a dict with 'label', 'kwargs' (passed to func in the worker process), and
+    the estimated 'memory_bytes' and 'disk_bytes' that it needs while running. A task is
+    started when a worker is free and its estimates fit in what is left of the budgets
+    (0 means no limit). A task larger than a whole budget is still run, but only when
+    nothing else is running. Tasks are started in order, so a large task is not starved by
+    smaller ones behind it.
+
+    run() returns, for each task in order, either the return value of func or the
+    exception that it raised, so that one failing task does not abort the whole batch.
+    """
+    def __init__(self, *, max_workers: int, max_memory_bytes: int, max_disk_bytes: int):
+        if max_workers < 1:
+            raise ValueError('max_workers must be at least 1')
+        self._max_workers = max_workers
+        self._max_memory_bytes = max_memory_bytes
+        self._max_disk_bytes = max_disk_bytes
+
+    def run(self, func: Callable[..., Any], tasks: List[dict], *, on_done: Union[Callable[[int, Any], None], None] = None) -> List[Any]:
+        """
+        on_done(task_index, result_or_exception), if given, is called in this process as
+        soon as each task finishes (e.g., to release a shared cache entry).
+        """
+        results: List[Any] = [None] * len(tasks)
+        running: Dict[Future, int] = {}
+        memory_in_use = 0
+        disk_in_use = 0
+        next_index = 0
+        timer = time.time()
+        with ProcessPoolExecutor(max_workers=self._max_workers) as executor:
+            while next_index < len(tasks) or len(running) > 0:
+                while next_index < len(tasks) and self._can_start(tasks[next_index], num_running=len(running), memory_in_use=memory_in_use, disk_in_use=disk_in_use):
+                    task = tasks[next_index]
+                    print(f'Starting {task["label"]} ({next_index + 1} of {len(tasks)}; {task["memory_bytes"] / 1e9:.2f} GB memory, {task["disk_bytes"] / 1e9:.2f} GB disk)')
+                    running[executor.submit(func, **task['kwargs'])] = next_index
+                    memory_in_use += task['memory_bytes']
+                    disk_in_use += task['disk_bytes']
+                    next_index += 1
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    memory_in_use -= tasks[i]['memory_bytes']
+                    disk_in_use -= tasks[i]['disk_bytes']
+                    exc = future.exception()
+                    results[i] = exc if exc is not None else future.result()
+                    if exc is not None:
+                        print(f'Error in {tasks[i]["label"]}: {exc}')
+                    else:
+                        print(f'Finished {tasks[i]["label"]} (total elapsed: {time.time() - timer:.1f} s)')
+                    if on_done is not None:
+                        on_done(i, results[i])
+        return results
+
+    def _can_start(self, task: dict, *, num_running: int, memory_in_use: int, disk_in_use: int) -> bool:
+        if num_running >= self._max_workers:
+            return False
+        if num_running == 0:
+            return True
+        if self._max_memory_bytes > 0 and memory_in_use + task['memory_bytes'] > self._max_memory_bytes:
+            return False
+        if self._max_disk_bytes > 0 and disk_in_use + task['disk_bytes'] > self._max_disk_bytes:
+            return False
+        return True
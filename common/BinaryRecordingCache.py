@@ -0,0 +1,141 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from typing import Callable, List, Union
+import spikeinterface as si
+
+
+class BinaryRecordingCache:
+    """
+    Directory of binary recordings (e.g., preprocessed float32 recordings for MountainSort5)
+    keyed by whatever determines their content, so that the same binary is written once and
+    reused by every task (or later job) that needs it.
+
+    An entry is written in a temporary directory and renamed into place together with its
+    binary_info.json once complete, so concurrent writers of the same key (e.g., two jobs
+    sharing the cache directory) never see a partial entry. Reading an entry marks it as
+    recently used, for evict().
+    """
+    def __init__(self, cache_dir: str):
+        self.cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(params: dict) -> str:
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_path(self, key: str) -> str:
+        return f'{self.cache_dir}/{key}'
+
+    def get(self, key: str) -> Union[si.BaseRecording, None]:
+        info_fname = f'{self.get_path(key)}/binary_info.json'
+        if not os.path.exists(info_fname):
+            return None
+        os.utime(info_fname)
+        with open(info_fname, 'r') as f:
+            info = json.load(f)
+        if os.path.exists(f'{self.get_path(key)}/scaled_int16.json'):
+            # written by make_scaled_int16_recording
+            from common.make_scaled_int16_recording import read_scaled_int16_recording
+            return read_scaled_int16_recording(
+                self.get_path(key),
+                sampling_frequency=info['sampling_frequency'],
+                channel_ids=info['channel_ids'],
+                channel_locations=np.array(info['channel_locations']) if info['channel_locations'] is not None else None
+            )
+        if os.path.exists(f'{self.get_path(key)}/compressed.json'):
+            # written with a compression (see make_compressed_recording)
+            from common.make_compressed_recording import read_compressed_recording
+            return read_compressed_recording(
+                self.get_path(key),
+                sampling_frequency=info['sampling_frequency'],
+                channel_ids=info['channel_ids'],
+                channel_locations=np.array(info['channel_locations']) if info['channel_locations'] is not None else None
+            )
+        ret = si.BinaryRecordingExtractor(
+            file_paths=[f'{self.get_path(key)}/recording.dat'],
+            sampling_frequency=info['sampling_frequency'],
+            channel_ids=info['channel_ids'],
+            num_chan=len(info['channel_ids']),
+            dtype=info['dtype']
+        )
+        if info['channel_locations'] is not None:
+            ret.set_channel_locations(info['channel_locations'])
+        return ret
+
+    def get_or_create(self, key: str, make_binary: Callable[[str], si.BinaryRecordingExtractor]) -> si.BinaryRecordingExtractor:
+        """
+        make_binary(dirname) writes dirname/recording.dat (e.g., make_float32_recording), or a
+        compressed store, and returns the binary recording.
+        """
+        ret = self.get(key)
+        if ret is not None:
+            print(f'Using cached binary recording {key}')
+            return ret
+        tmp_dirname = f'{self.get_path(key)}.tmp-{os.getpid()}'
+        recording = make_binary(tmp_dirname)
+        locations = recording.get_channel_locations() if recording.has_probe() or 'location' in recording.get_property_keys() else None
+        info = {
+            'sampling_frequency': recording.get_sampling_frequency(),
+            'channel_ids': [_to_json_value(x) for x in recording.get_channel_ids()],
+            'dtype': str(recording.get_dtype()),
+            'channel_locations': locations.tolist() if locations is not None else None
+        }
+        with open(f'{tmp_dirname}/binary_info.json', 'w') as f:
+            json.dump(info, f)
+        try:
+            os.rename(tmp_dirname, self.get_path(key))
+        except OSError:
+            # another writer finished the same entry first
+            shutil.rmtree(tmp_dirname)
+        ret = self.get(key)
+        assert ret is not None
+        return ret
+
+    def remove(self, key: str):
+        if os.path.exists(self.get_path(key)):
+            shutil.rmtree(self.get_path(key))
+
+    def get_keys(self) -> List[str]:
+        # complete entries only (not those still being written)
+        return [
+            key for key in os.listdir(self.cache_dir)
+            if '.tmp-' not in key and os.path.exists(f'{self.get_path(key)}/binary_info.json')
+        ]
+
+    def get_size(self, key: str) -> int:
+        return sum(
+            os.path.getsize(os.path.join(root, fname))
+            for root, _, fnames in os.walk(self.get_path(key)) for fname in fnames
+        )
+
+    def get_total_size(self) -> int:
+        return sum(self.get_size(key) for key in self.get_keys())
+
+    def evict(self, *, max_bytes: int, keep: List[str]) -> List[str]:
+        """
+        Remove the least recently used entries, other than those in keep, until the cache
+        takes at most max_bytes, and return the keys that were removed.
+        """
+        entries = sorted(
+            (os.path.getmtime(f'{self.get_path(key)}/binary_info.json'), key, self.get_size(key))
+            for key in self.get_keys()
+        )
+        total_size = sum(size for _, _, size in entries)
+        keep_set = set(keep)
+        removed = []
+        for _, key, size in entries:
+            if total_size <= max_bytes:
+                break
+            if key in keep_set:
+                continue
+            self.remove(key)
+            total_size -= size
+            removed.append(key)
+        return removed
+
+def _to_json_value(x):
+    # channel ids are often numpy scalars
+    return x.item() if hasattr(x, 'item') else x
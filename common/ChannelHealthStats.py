@@ -0,0 +1,159 @@
+from typing import List, Union
+import numpy as np
+import spikeinterface as si
+
+
+class ChannelHealthStats:
+    """
+    Per-channel health statistics of a recording, accumulated as a by-product of the pass
+    that converts it to a binary file, so that they cost no extra reads of the input.
+
+    Use the tapped recording (self.recording) in place of the original at the start of
+    the preprocessing chain, and pass this object to make_float32_recording or
+    make_int16_recording, which enable the accumulation only while they write (reads made
+    before, e.g., for the whitening matrix or the int16 scale factor, are not counted).
+    The conversion reads the chunks in order, and frames that were already counted (the
+    margins of the filter) are skipped, so every frame is counted exactly once.
+
+    For each channel: the RMS about the mean, the MAD (median over chunks of the median
+    absolute deviation of the chunk), the number of samples at the minimum or maximum
+    value of the channel (pinned at a rail when a channel saturates) and the fraction of
+    consecutive samples that are identical (flat line).
+    """
+    def __init__(self, recording: si.BaseRecording):
+        if recording.get_num_segments() != 1:
+            raise NotImplementedError('Can only compute channel health statistics for recordings with a single segment')
+        self._channel_ids = recording.get_channel_ids().tolist()
+        num_channels = len(self._channel_ids)
+        self.recording = _ChannelHealthStatsRecording(recording, stats=self)
+        self._enabled = False
+        self._next_frame = 0
+        self._last_row: Union[np.ndarray, None] = None
+        self._num_frames = 0
+        self._sum = np.zeros(num_channels, dtype=np.float64)
+        self._sum_sq = np.zeros(num_channels, dtype=np.float64)
+        self._chunk_mads: List[np.ndarray] = []
+        self._min = np.full(num_channels, np.inf)
+        self._max = np.full(num_channels, -np.inf)
+        self._num_at_min = np.zeros(num_channels, dtype=np.int64)
+        self._num_at_max = np.zeros(num_channels, dtype=np.int64)
+        self._num_diffs = 0
+        self._num_flat_diffs = np.zeros(num_channels, dtype=np.int64)
+
+    def start(self):
+        self._enabled = True
+
+    def stop(self):
+        self._enabled = False
+
+    def update(self, start_frame: int, traces: np.ndarray):
+        if not self._enabled:
+            return
+        end_frame = start_frame + traces.shape[0]
+        if end_frame <= self._next_frame:
+            return
+        if start_frame < self._next_frame:
+            traces = traces[self._next_frame - start_frame:]
+        elif start_frame > self._next_frame:
+            # a gap: do not count a difference across it
+            self._last_row = None
+        x = traces.astype(np.float64)
+        self._num_frames += x.shape[0]
+        self._sum += np.sum(x, axis=0)
+        self._sum_sq += np.sum(x ** 2, axis=0)
+        self._chunk_mads.append(np.median(np.abs(x - np.median(x, axis=0)), axis=0))
+        chunk_min = np.min(x, axis=0)
+        chunk_max = np.max(x, axis=0)
+        num_at_chunk_min = np.sum(x == chunk_min, axis=0)
+        num_at_chunk_max = np.sum(x == chunk_max, axis=0)
+        self._num_at_min = np.where(chunk_min < self._min, num_at_chunk_min, np.where(chunk_min == self._min, self._num_at_min + num_at_chunk_min, self._num_at_min))
+        self._num_at_max = np.where(chunk_max > self._max, num_at_chunk_max, np.where(chunk_max == self._max, self._num_at_max + num_at_chunk_max, self._num_at_max))
+        self._min = np.minimum(self._min, chunk_min)
+        self._max = np.maximum(self._max, chunk_max)
+        if self._last_row is not None:
+            x = np.concatenate([self._last_row[None, :], x], axis=0)
+        self._num_diffs += x.shape[0] - 1
+        self._num_flat_diffs += np.sum(x[1:] == x[:-1], axis=0)
+        self._last_row = x[-1]
+        self._next_frame = end_frame
+
+    def get_stats(self) -> dict:
+        if self._num_frames == 0:
+            raise Exception('No channel health statistics were accumulated')
+        mean = self._sum / self._num_frames
+        rms = np.sqrt(np.maximum(self._sum_sq / self._num_frames - mean ** 2, 0))
+        mad = np.median(np.array(self._chunk_mads), axis=0)
+        saturation_count = np.where(self._min < self._max, self._num_at_min + self._num_at_max, 0)
+        flat_fraction = self._num_flat_diffs / self._num_diffs if self._num_diffs > 0 else np.zeros(len(self._channel_ids))
+        return {
+            'channel_ids': self._channel_ids,
+            'num_frames': self._num_frames,
+            'rms': rms.tolist(),
+            'mad': mad.tolist(),
+            'saturation_count': saturation_count.tolist(),
+            'flat_fraction': flat_fraction.tolist()
+        }
+
+    def get_bad_channels(
+        self,
+        *,
+        max_flat_fraction: float = 0.5,
+        max_saturation_fraction: float = 1e-3,
+        min_relative_mad: float = 0.1,
+        max_relative_mad: float = 10
+    ) -> dict:
+        """
+        Returns a dict mapping the id of each flagged channel to the reason: 'flat' (mostly
+        identical consecutive samples, e.g., disconnected), 'saturated' (too many samples
+        at the rails), 'dead' or 'noisy' (MAD far below or above the median MAD of all
+        channels).
+        """
+        stats = self.get_stats()
+        median_mad = float(np.median(stats['mad']))
+        ret = {}
+        for i, channel_id in enumerate(stats['channel_ids']):
+            if stats['flat_fraction'][i] > max_flat_fraction:
+                ret[channel_id] = 'flat'
+            elif stats['saturation_count'][i] > max_saturation_fraction * stats['num_frames']:
+                ret[channel_id] = 'saturated'
+            elif median_mad > 0 and stats['mad'][i] < min_relative_mad * median_mad:
+                ret[channel_id] = 'dead'
+            elif median_mad > 0 and stats['mad'][i] > max_relative_mad * median_mad:
+                ret[channel_id] = 'noisy'
+        return ret
+
+    def print_summary(self, bad_channels: dict):
+        stats = self.get_stats()
+        print(f'Channel health ({stats["num_frames"]} frames): median RMS {np.median(stats["rms"]):.3g}, median MAD {np.median(stats["mad"]):.3g}')
+        for channel_id, reason in bad_channels.items():
+            i = stats['channel_ids'].index(channel_id)
+            print(f'  Channel {channel_id}: {reason} (RMS {stats["rms"][i]:.3g}, MAD {stats["mad"][i]:.3g}, {stats["saturation_count"][i]} samples at the rails, flat fraction {stats["flat_fraction"][i]:.3f})')
+
+class _ChannelHealthStatsRecording(si.BaseRecording):
+    def __init__(self, recording: si.BaseRecording, *, stats: ChannelHealthStats):
+        si.BaseRecording.__init__(self, channel_ids=recording.get_channel_ids(), sampling_frequency=recording.get_sampling_frequency(), dtype=recording.get_dtype())
+        recording.copy_metadata(self)
+        self.add_recording_segment(_ChannelHealthStatsRecordingSegment(recording._recording_segments[0], stats=stats))
+        # so that the source can still be found through the chain (e.g., by plan_chunk_size)
+        self._kwargs = {'recording': recording}
+
+class _ChannelHealthStatsRecordingSegment(si.BaseRecordingSegment):
+    def __init__(self, parent_segment: si.BaseRecordingSegment, *, stats: ChannelHealthStats):
+        si.BaseRecordingSegment.__init__(self, sampling_frequency=parent_segment.sampling_frequency)
+        self._parent_segment = parent_segment
+        self._stats = stats
+
+    def get_num_samples(self) -> int:
+        return self._parent_segment.get_num_samples()
+
+    def get_traces(self, start_frame: Union[int, None], end_frame: Union[int, None], channel_indices=None) -> np.ndarray:
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.get_num_samples()
+        if channel_indices is None or (isinstance(channel_indices, slice) and channel_indices == slice(None)):
+            traces = self._parent_segment.get_traces(start_frame, end_frame, channel_indices)
+            self._stats.update(start_frame, traces)
+            return traces
+        # only the full reads of the conversion are counted
+        return self._parent_segment.get_traces(start_frame, end_frame, channel_indices)
@@ -0,0 +1,181 @@
+import time
+import threading
+from typing import Any, Dict, List, Union
+
+
+class IoAccountingFile:
+    """
+    Transparent wrapper around a readable file object (a remfile.File, or a local file)
+    that counts what is read through it: number of reads and bytes, how far the position
+    jumps between consecutive reads, histograms of read sizes and latencies and, for a
+    remfile.File or BlockCachedRemoteFile, the HTTP requests and bytes that it actually fetched.
+
+    If trace_fname is given, every read is appended to it as a line
+    <time_sec>,<offset>,<size>,<latency_sec> so that the access pattern can be replayed
+    offline with replay_io_trace.
+    """
+    def __init__(self, file: Any, *, label: str = 'input', trace_fname: Union[str, None] = None):
+        self._file = file
+        self.label = label
+        self._position = 0
+        self._last_read_end: Union[int, None] = None
+        self._start_time = time.time()
+        self._lock = threading.Lock()
+        self._trace_file = open(trace_fname, 'w') if trace_fname else None
+        self._num_reads = 0
+        self._num_bytes = 0
+        self._num_seeks = 0
+        self._num_non_sequential_reads = 0
+        self._seek_distance = 0
+        self._read_time_sec = 0.0
+        self._read_size_histogram: Dict[int, int] = {}
+        self._latency_histogram: Dict[int, int] = {}
+        self._num_http_requests = 0
+        self._num_http_bytes = 0
+        session = getattr(file, 'session', None)
+        if session is not None and hasattr(session, 'hooks'):
+            session.hooks['response'].append(self._on_http_response)
+
+    def read(self, size: int = -1) -> bytes:
+        offset = self._position
+        t0 = time.time()
+        data = self._file.read(size) if size is not None and size >= 0 else self._file.read()
+        elapsed = time.time() - t0
+        self._position = offset + len(data)
+        self._record_read(offset, len(data), elapsed, t0)
+        return data
+
+    def readinto(self, b) -> int:
+        offset = self._position
+        t0 = time.time()
+        if hasattr(self._file, 'readinto'):
+            n = self._file.readinto(b)
+        else:
+            # remfile.File only has read()
+            data = self._file.read(len(b))
+            n = len(data)
+            memoryview(b).cast('B')[:n] = data
+        elapsed = time.time() - t0
+        self._position = offset + n
+        self._record_read(offset, n, elapsed, t0)
+        return n
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        ret = self._file.seek(offset, whence)
+        self._position = self._file.tell()
+        self._num_seeks += 1
+        return ret if ret is not None else self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def seekable(self) -> bool:
+        return True
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self):
+        if self._trace_file is not None:
+            self._trace_file.close()
+            self._trace_file = None
+        if hasattr(self._file, 'close'):
+            self._file.close()
+
+    def __getattr__(self, name: str):
+        # anything else (e.g., attributes of remfile.File) goes to the wrapped file
+        return getattr(self._file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_summary(self) -> dict:
+        with self._lock:
+            # the summary is taken at the end of the run, and the input file is usually not closed
+            if self._trace_file is not None:
+                self._trace_file.flush()
+            return {
+                'label': self.label,
+                'num_reads': self._num_reads,
+                'num_bytes': self._num_bytes,
+                'num_seeks': self._num_seeks,
+                'num_non_sequential_reads': self._num_non_sequential_reads,
+                'total_seek_distance_bytes': self._seek_distance,
+                'read_time_sec': self._read_time_sec,
+                'num_http_requests': self._num_http_requests,
+                'num_http_bytes': self._num_http_bytes,
+                # key k counts reads of size < 2^k bytes (and >= 2^(k-1))
+                'read_size_histogram': {f'<{_format_bytes(2 ** k)}': v for k, v in sorted(self._read_size_histogram.items())},
+                # key k counts reads that took < 2^k microseconds (and >= 2^(k-1))
+                'latency_histogram': {f'<{_format_usec(2 ** k)}': v for k, v in sorted(self._latency_histogram.items())},
+                # for a file read through a SharedBlockCache
+                'block_cache': self._file.get_cache_stats() if hasattr(self._file, 'get_cache_stats') else None
+            }
+
+    def print_summary(self):
+        s = self.get_summary()
+        print(f'I/O summary for {s["label"]}:')
+        print(f'  {s["num_reads"]} reads, {s["num_bytes"] / 1e6:.1f} MB, {s["read_time_sec"]:.3f} s in reads')
+        print(f'  {s["num_seeks"]} seeks, {s["num_non_sequential_reads"]} non-sequential reads, {s["total_seek_distance_bytes"] / 1e6:.1f} MB total seek distance')
+        if s['num_http_requests'] > 0:
+            print(f'  {s["num_http_requests"]} HTTP requests, {s["num_http_bytes"] / 1e6:.1f} MB fetched')
+        if s['block_cache'] is not None:
+            c = s['block_cache']
+            print(f'  Block cache: {c["num_hits"]} hits, {c["num_misses"]} misses, {c["num_bytes_from_cache"] / 1e6:.1f} MB from cache, {c["num_evictions"]} evictions ({c["size_bytes"] / 1e9:.2f} of {c["max_size_bytes"] / 1e9:.2f} GB used)')
+        print('  Read sizes: ' + ', '.join(f'{k}: {v}' for k, v in s['read_size_histogram'].items()))
+        print('  Read latencies: ' + ', '.join(f'{k}: {v}' for k, v in s['latency_histogram'].items()))
+
+    def _record_read(self, offset: int, size: int, elapsed: float, t0: float):
+        with self._lock:
+            self._num_reads += 1
+            self._num_bytes += size
+            self._read_time_sec += elapsed
+            if self._last_read_end is not None and offset != self._last_read_end:
+                self._num_non_sequential_reads += 1
+                self._seek_distance += abs(offset - self._last_read_end)
+            self._last_read_end = offset + size
+            k = _log2_bucket(size)
+            self._read_size_histogram[k] = self._read_size_histogram.get(k, 0) + 1
+            k = _log2_bucket(int(elapsed * 1e6))
+            self._latency_histogram[k] = self._latency_histogram.get(k, 0) + 1
+            if self._trace_file is not None:
+                self._trace_file.write(f'{t0 - self._start_time:.6f},{offset},{size},{elapsed:.6f}\n')
+
+    def _on_http_response(self, response, *args, **kwargs):
+        with self._lock:
+            self._num_http_requests += 1
+            self._num_http_bytes += int(response.headers.get('Content-Length', 0))
+
+def replay_io_trace(trace_fname: str, file: Any) -> dict:
+    """
+    Re-issue the reads of a trace written by IoAccountingFile against another file object
+    (e.g., a remfile.File with different settings) and return the resulting summary.
+    """
+    f = IoAccountingFile(file, label=f'replay of {trace_fname}')
+    with open(trace_fname, 'r') as trace:
+        for line in trace:
+            _, offset, size, _ = line.strip().split(',')
+            f.seek(int(offset))
+            f.read(int(size))
+    return f.get_summary()
+
+def _log2_bucket(x: int) -> int:
+    return max(int(x), 0).bit_length()
+
+def _format_bytes(x: int) -> str:
+    units: List[str] = ['B', 'KiB', 'MiB', 'GiB']
+    i = 0
+    while x >= 1024 and i < len(units) - 1:
+        x //= 1024
+        i += 1
+    return f'{x}{units[i]}'
+
+def _format_usec(x: int) -> str:
+    if x < 1000:
+        return f'{x}us'
+    if x < 1000000:
+        return f'{x / 1000:g}ms'
+    return f'{x / 1000000:g}s'
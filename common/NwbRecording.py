@@ -90,5 +90,43 @@ class NwbRecordingSegment(si.BaseRecordingSegment):
     def get_traces(self, start_frame: int, end_frame: int, channel_indices: Union[List[int], None] = None) -> np.ndarray:
         if channel_indices is None:
             return self._electrical_series_data[start_frame:end_frame, :]
-        else:
+        if isinstance(channel_indices, slice):
             return self._electrical_series_data[start_frame:end_frame, channel_indices]
+        channel_indices = np.asarray(channel_indices, dtype=np.int64)
+        # h5py fancy indexing is slow (one selection per channel) and requires increasing
+        # indices, so read the ranges of the dataset that cover the channels instead
+        unique_channel_indices = np.unique(channel_indices)
+        ranges = _get_channel_ranges(unique_channel_indices, chunk_num_channels=_get_chunk_num_channels(self._electrical_series_data))
+        if len(ranges) == 1:
+            traces = self._electrical_series_data[start_frame:end_frame, ranges[0][0]:ranges[0][1]]
+        else:
+            traces = np.concatenate([self._electrical_series_data[start_frame:end_frame, i1:i2] for i1, i2 in ranges], axis=1)
+        # the columns of the ranges that were read, for each of the unique channels
+        range_starts = np.cumsum([0] + [i2 - i1 for i1, i2 in ranges])
+        range_index = np.searchsorted([i1 for i1, _ in ranges], unique_channel_indices, side='right') - 1
+        columns = range_starts[range_index] + unique_channel_indices - np.array([ranges[k][0] for k in range_index])
+        columns = columns[np.searchsorted(unique_channel_indices, channel_indices)]
+        if len(columns) == traces.shape[1] and np.all(columns == np.arange(len(columns))):
+            return traces
+        return traces[:, columns]
+
+def _get_chunk_num_channels(dataset: h5py.Dataset) -> int:
+    if dataset.chunks is None:
+        # contiguous: the channels of a frame are adjacent, so a frame is read as a whole anyway
+        return dataset.shape[1]
+    return int(dataset.chunks[1])
+
+def _get_channel_ranges(unique_channel_indices: np.ndarray, *, chunk_num_channels: int) -> List[tuple]:
+    """
+    Coalesce sorted channel indices into [i1, i2) ranges to read. Two ranges are merged when
+    the channels between them are in storage chunks that are read for the ranges anyway
+    (the chunk of the last channel of one or the first channel of the next), so the number
+    of bytes read (and downloaded) is the same as for the channels alone, in fewer reads.
+    """
+    ranges = []
+    for i in unique_channel_indices.tolist():
+        if len(ranges) > 0 and (i == ranges[-1][1] or i // chunk_num_channels <= (ranges[-1][1] - 1) // chunk_num_channels + 1):
+            ranges[-1][1] = i + 1
+        else:
+            ranges.append([i, i + 1])
+    return [(i1, i2) for i1, i2 in ranges]
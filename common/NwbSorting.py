@@ -3,7 +3,7 @@ import h5py
 import spikeinterface as si
 
 
-def NwbSorting(file):
+def NwbSorting(file, *, sampling_frequency: float = 30000):
     h5_file = h5py.File(file, 'r')
 
     # Load unit IDs
@@ -20,13 +20,14 @@ def NwbSorting(file):
     print(f'Start time (sec): {start_time_sec}')
     print(f'End time (sec): {end_time_sec}')
     units_dict = {}
-    sampling_frequency = 30000 # TODO: get this from the NWB file
+    # sampling_frequency is not stored in the units table (TODO: get it from the NWB file)
     for i in range(len(ids)):
         if i == 0:
             s = spike_times[0:spike_times_index[0]]
         else:
             s = spike_times[spike_times_index[i - 1]:spike_times_index[i]]
-        units_dict[ids[i]] = (s * sampling_frequency).astype(np.int32)
+        # int64 frames: int32 overflows after about 20 hours at 30 kHz
+        units_dict[ids[i]] = np.round(s * sampling_frequency).astype(np.int64)
     sorting = _numpy_sorting_from_dict([units_dict], sampling_frequency=sampling_frequency)
     return sorting
 
@@ -0,0 +1,83 @@
+from typing import List, Tuple
+import numpy as np
+import spikeinterface as si
+from common.plan_chunk_size import get_storage_chunk_frames
+
+
+class PreviewWindows:
+    """
+    Windows spread evenly across a recording for a quick-look (preview) sorting: the
+    windows are concatenated into a small recording that is sorted instead of the whole
+    session, and the spike times are then mapped back to the frames of the original
+    recording.
+
+    The windows are aligned to the time chunking of the HDF5 dataset behind the recording
+    (when there is one), so that only whole storage chunks are read.
+    """
+    def __init__(self, recording: si.BaseRecording, *, num_windows: int, window_duration_sec: float):
+        if num_windows < 1:
+            raise ValueError('num_windows must be at least 1')
+        num_frames = recording.get_num_frames()
+        storage_chunk_frames = get_storage_chunk_frames(recording) or 1
+        window_num_frames = int(window_duration_sec * recording.get_sampling_frequency())
+        window_num_frames = max(int(np.ceil(window_num_frames / storage_chunk_frames)) * storage_chunk_frames, storage_chunk_frames)
+        if num_windows * window_num_frames >= num_frames:
+            # the windows would cover the whole recording
+            self.windows: List[Tuple[int, int]] = [(0, num_frames)]
+        else:
+            windows = []
+            for i in range(num_windows):
+                # the center of the i-th of num_windows equal parts, aligned down to a storage chunk
+                start = int((i + 0.5) * num_frames / num_windows - window_num_frames / 2)
+                start = (max(start, 0) // storage_chunk_frames) * storage_chunk_frames
+                start = min(start, num_frames - window_num_frames)
+                if len(windows) > 0 and start < windows[-1][1]:
+                    start = windows[-1][1]
+                windows.append((start, min(start + window_num_frames, num_frames)))
+            self.windows = windows
+        self.sampling_frequency = recording.get_sampling_frequency()
+        num_preview_frames = sum(end - start for start, end in self.windows)
+        print(f'Preview: {len(self.windows)} windows of {window_num_frames / self.sampling_frequency:.1f} s ({num_preview_frames / num_frames * 100:.1f}% of the recording)')
+
+    def concatenate(self, recording: si.BaseRecording) -> si.BaseRecording:
+        """
+        The windows of a (lazy, e.g., filtered) recording with the same frames as the one
+        that the windows were planned for, concatenated into a single segment. Filter before
+        concatenating so that the filter margins come from the actual neighboring data
+        rather than from the junctions between windows.
+        """
+        if len(self.windows) == 1:
+            return recording.frame_slice(self.windows[0][0], self.windows[0][1])
+        return si.concatenate_recordings([recording.frame_slice(start, end) for start, end in self.windows])
+
+    def get_num_frames(self) -> int:
+        return sum(end - start for start, end in self.windows)
+
+    def map_sorting(self, sorting: si.BaseSorting) -> si.BaseSorting:
+        """
+        Map a sorting of the concatenated windows back to the frames of the original recording.
+        """
+        offsets = np.cumsum([0] + [end - start for start, end in self.windows])
+        starts = np.array([start for start, _ in self.windows])
+        units = {}
+        for unit_id in sorting.get_unit_ids():
+            spike_train = sorting.get_unit_spike_train(unit_id)
+            window_indices = np.searchsorted(offsets, spike_train, side='right') - 1
+            units[unit_id] = starts[window_indices] + (spike_train - offsets[window_indices])
+        return _numpy_sorting_from_dict([units], sampling_frequency=self.sampling_frequency)
+
+    def get_intervals_sec(self) -> List[Tuple[float, float]]:
+        return [(start / self.sampling_frequency, end / self.sampling_frequency) for start, end in self.windows]
+
+def _numpy_sorting_from_dict(units_dict_list, *, sampling_frequency):
+    try:
+        # different versions of spikeinterface
+        # see: https://github.com/SpikeInterface/spikeinterface/issues/2083
+        sorting = si.NumpySorting.from_dict(
+            units_dict_list, sampling_frequency=sampling_frequency # type: ignore
+        )
+    except: # noqa
+        sorting = si.NumpySorting.from_unit_dict(
+            units_dict_list, sampling_frequency=sampling_frequency # type: ignore
+        )
+    return sorting
@@ -0,0 +1,287 @@
+import os
+import time
+import fcntl
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Union
+import requests
+
+
+class SharedBlockCache:
+    """
+    On-disk cache of fixed-size blocks of remote files, shared by all the processes (jobs)
+    on a node that use the same cache_dir, and bounded to max_size_bytes with least recently
+    used eviction.
+
+    A block is keyed by the identity of the remote file (its ETag when the server provides
+    one, otherwise its URL without the query string, which changes for presigned URLs)
+    and the block index. Each block is a file under cache_dir/blocks, written to a
+    temporary file and renamed into place, and the sizes and access times are kept in a
+    sqlite index. Inserts and evictions are serialized across processes with an fcntl
+    lock on cache_dir/lock.
+    """
+    def __init__(self, cache_dir: str, *, max_size_bytes: int, block_size: int = 1024 * 1024):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size_bytes = max_size_bytes
+        self.block_size = block_size
+        os.makedirs(f'{self.cache_dir}/blocks', exist_ok=True)
+        self._lock_fname = f'{self.cache_dir}/lock'
+        self._thread_lock = threading.Lock()
+        self._num_hits = 0
+        self._num_misses = 0
+        self._num_bytes_from_cache = 0
+        self._num_bytes_fetched = 0
+        self._num_evictions = 0
+        self._db = sqlite3.connect(f'{self.cache_dir}/index.sqlite', timeout=60, isolation_level=None, check_same_thread=False)
+        with self._file_lock():
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS blocks (key TEXT PRIMARY KEY, size INTEGER, last_access REAL)')
+            # e.g., a smaller max_size_bytes than the previous user of the directory
+            self._evict_if_needed()
+
+    def open(self, url: Union[str, Any]) -> 'BlockCachedRemoteFile':
+        """
+        url is a URL, or an object with a get_url() method (e.g., a dendro InputFile) so
+        that an expired presigned URL can be renewed.
+        """
+        return BlockCachedRemoteFile(url, cache=self)
+
+    def get_block(self, file_key: str, block_index: int) -> Union[bytes, None]:
+        key = f'{file_key}.{block_index}'
+        try:
+            with open(self._get_block_path(key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            # never fetched, or evicted by another process
+            with self._thread_lock:
+                self._num_misses += 1
+            return None
+        with self._thread_lock:
+            self._num_hits += 1
+            self._num_bytes_from_cache += len(data)
+            self._db.execute('UPDATE blocks SET last_access = ? WHERE key = ?', (time.time(), key))
+        return data
+
+    def has_block(self, file_key: str, block_index: int) -> bool:
+        return os.path.exists(self._get_block_path(f'{file_key}.{block_index}'))
+
+    def put_block(self, file_key: str, block_index: int, data: bytes):
+        key = f'{file_key}.{block_index}'
+        path = self._get_block_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp-{os.getpid()}-{threading.get_ident()}'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        with self._thread_lock, self._file_lock():
+            os.replace(tmp_path, path)
+            self._db.execute('INSERT OR REPLACE INTO blocks (key, size, last_access) VALUES (?, ?, ?)', (key, len(data), time.time()))
+            self._num_bytes_fetched += len(data)
+            self._evict_if_needed()
+
+    def get_stats(self) -> dict:
+        with self._thread_lock:
+            (num_blocks, size_bytes), = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blocks').fetchall()
+            return {
+                'cache_dir': self.cache_dir,
+                'num_hits': self._num_hits,
+                'num_misses': self._num_misses,
+                'hit_rate': self._num_hits / (self._num_hits + self._num_misses) if self._num_hits + self._num_misses > 0 else None,
+                'num_bytes_from_cache': self._num_bytes_from_cache,
+                'num_bytes_fetched': self._num_bytes_fetched,
+                'num_evictions': self._num_evictions,
+                'num_blocks': num_blocks,
+                'size_bytes': size_bytes,
+                'max_size_bytes': self.max_size_bytes
+            }
+
+    def _evict_if_needed(self):
+        # called with the file lock held
+        (total,), = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM blocks').fetchall()
+        while total > self.max_size_bytes:
+            rows = self._db.execute('SELECT key, size FROM blocks ORDER BY last_access LIMIT 64').fetchall()
+            if len(rows) == 0:
+                break
+            for key, size in rows:
+                try:
+                    os.remove(self._get_block_path(key))
+                except FileNotFoundError:
+                    pass
+                self._db.execute('DELETE FROM blocks WHERE key = ?', (key,))
+                self._num_evictions += 1
+                total -= size
+                if total <= self.max_size_bytes:
+                    break
+
+    def _get_block_path(self, key: str) -> str:
+        return f'{self.cache_dir}/blocks/{key[:2]}/{key}'
+
+    def _file_lock(self):
+        return _FileLock(self._lock_fname)
+
+class BlockCachedRemoteFile:
+    """
+    Read-only file-like object for a remote file (e.g., an NWB file read by h5py) that reads
+    through a SharedBlockCache. Missing blocks are fetched with HTTP range requests, with
+    adjacent missing blocks coalesced into one request and the request size growing while
+    the file is read sequentially. The most recently used blocks are also kept in memory,
+    since h5py makes many small reads within the same block.
+    """
+    def __init__(self, url: Union[str, Any], *, cache: SharedBlockCache, max_readahead_blocks: int = 64, num_memory_blocks: int = 16):
+        self._url_source = url
+        self._url = url if isinstance(url, str) else url.get_url()
+        self._cache = cache
+        self._max_readahead_blocks = max_readahead_blocks
+        self._num_memory_blocks = num_memory_blocks
+        self._memory_blocks: 'OrderedDict[int, bytes]' = OrderedDict()
+        self._position = 0
+        self._readahead_blocks = 1
+        self._last_fetch_end: Union[int, None] = None
+        self.session = requests.Session()
+        # a one byte range request gives the size and the ETag
+        r = self._get_range(0, 1)
+        content_range = r.headers.get('Content-Range', None)
+        if content_range is None:
+            raise Exception(f'Server does not support range requests: {self._url}')
+        self.length = int(content_range.split('/')[-1])
+        etag = r.headers.get('ETag', None)
+        identity = etag if etag is not None else self._url.split('?')[0]
+        # the block index only makes sense for a given block size
+        self._file_key = hashlib.sha1(f'{identity}:{cache.block_size}'.encode('utf-8')).hexdigest()
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.length - self._position
+        start = self._position
+        end = min(start + size, self.length)
+        if end <= start:
+            return b''
+        block_size = self._cache.block_size
+        first_block = start // block_size
+        last_block = (end - 1) // block_size
+        blocks = self._get_blocks(first_block, last_block)
+        data = b''.join(blocks[i] for i in range(first_block, last_block + 1))
+        offset = first_block * block_size
+        self._position = end
+        return data[start - offset:end - offset]
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 0:
+            self._position = offset
+        elif whence == 1:
+            self._position += offset
+        elif whence == 2:
+            self._position = self.length + offset
+        else:
+            raise ValueError(f'Unexpected whence: {whence}')
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def seekable(self) -> bool:
+        return True
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self):
+        self.session.close()
+
+    def get_cache_stats(self) -> dict:
+        return self._cache.get_stats()
+
+    def _get_blocks(self, first_block: int, last_block: int) -> Dict[int, bytes]:
+        ret: Dict[int, bytes] = {}
+        missing: List[int] = []
+        for i in range(first_block, last_block + 1):
+            data = self._memory_blocks.get(i, None)
+            if data is None:
+                data = self._cache.get_block(self._file_key, i)
+            if data is None:
+                missing.append(i)
+            else:
+                ret[i] = data
+                self._remember_block(i, data)
+        # fetch each run of consecutive missing blocks with one request
+        runs: List[List[int]] = []
+        for i in missing:
+            if len(runs) > 0 and runs[-1][-1] == i - 1:
+                runs[-1].append(i)
+            else:
+                runs.append([i])
+        for run in runs:
+            for i, data in self._fetch_blocks(run[0], run[-1]).items():
+                if i <= last_block:
+                    ret[i] = data
+        return ret
+
+    def _fetch_blocks(self, first_block: int, last_block: int) -> Dict[int, bytes]:
+        block_size = self._cache.block_size
+        num_blocks_total = (self.length + block_size - 1) // block_size
+        if self._last_fetch_end == first_block:
+            # sequential access: fetch more ahead of time with each request
+            self._readahead_blocks = min(self._readahead_blocks * 2, self._max_readahead_blocks)
+        else:
+            self._readahead_blocks = 1
+        end_block = last_block
+        while end_block + 1 < num_blocks_total and end_block + 1 < first_block + self._readahead_blocks and not self._cache.has_block(self._file_key, end_block + 1):
+            end_block += 1
+        start = first_block * block_size
+        end = min((end_block + 1) * block_size, self.length)
+        data = self._get_range(start, end).content
+        if len(data) != end - start:
+            raise Exception(f'Unexpected number of bytes: {len(data)} (expected {end - start})')
+        ret: Dict[int, bytes] = {}
+        for i in range(first_block, end_block + 1):
+            block = data[(i - first_block) * block_size:(i - first_block + 1) * block_size]
+            self._cache.put_block(self._file_key, i, block)
+            self._remember_block(i, block)
+            ret[i] = block
+        self._last_fetch_end = end_block + 1
+        return ret
+
+    def _get_range(self, start: int, end: int) -> requests.Response:
+        for attempt in range(3):
+            try:
+                # a stalled server must not hang the job (or the other jobs sharing the cache)
+                r = self.session.get(self._url, headers={'Range': f'bytes={start}-{end - 1}'}, timeout=120)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == 2:
+                    raise
+                time.sleep(2 ** attempt)
+                continue
+            if r.status_code in [401, 403] and not isinstance(self._url_source, str):
+                # presigned URL expired
+                self._url = self._url_source.get_url()
+                continue
+            if r.status_code >= 500 and attempt < 2:
+                time.sleep(2 ** attempt)
+                continue
+            r.raise_for_status()
+            return r
+        r.raise_for_status()
+        return r
+
+    def _remember_block(self, i: int, data: bytes):
+        self._memory_blocks[i] = data
+        self._memory_blocks.move_to_end(i)
+        while len(self._memory_blocks) > self._num_memory_blocks:
+            self._memory_blocks.popitem(last=False)
+
+class _FileLock:
+    def __init__(self, fname: str):
+        self._fname = fname
+        self._f = None
+
+    def __enter__(self):
+        self._f = open(self._fname, 'a')
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        assert self._f is not None
+        fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._f.close()
+        self._f = None
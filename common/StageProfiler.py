@@ -0,0 +1,177 @@
+import os
+import sys
+import time
+import json
+import resource
+import functools
+from contextlib import contextmanager
+from typing import Any, Dict, List, Union
+
+
+class StageProfiler:
+    """
+    Records the wall time, CPU time, peak RSS and I/O of the stages of a processor.
+
+    Use stage() as a context manager (or profile() as a decorator) around each stage:
+
+        profiler = StageProfiler('mountainsort5')
+        with profiler.stage('open'):
+            ...
+        profiler.write_json('output/profile.json')
+
+    Stages can be nested; a nested stage is recorded as <parent>/<name>. CPU time includes
+    child processes that have finished (e.g., a sorter run in a subprocess). Peak RSS is the
+    peak of this process during the stage when the kernel allows resetting it (Linux), and
+    the peak since the start of the process otherwise. Bytes read and written are the read
+    and write calls of the process (files and sockets) as reported by /proc/self/io, or None
+    if unavailable. Writes through memory maps (e.g., binary recordings) do not show up there,
+    so the bytes that reached the storage layer are recorded as well.
+
+    The JSON report (write_json) is for local runs (e.g., the benchmarks, or a processor
+    run by hand): it is not a job output, so it is not uploaded and is lost with the
+    working directory of a dendro job. For a dendro job, the STAGE lines and the summary
+    printed to the console (and kept in the job's console output) are the profile.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.stages: List[dict] = []
+        self._open_stages: List[dict] = []
+        self.io: List[dict] = []
+        self.metadata: Dict[str, Any] = {}
+        self._start_time = time.time()
+
+    @contextmanager
+    def stage(self, name: str, *, num_samples: int = 0, num_bytes: int = 0):
+        """
+        Record a stage. num_samples and num_bytes, if given, are the amount of data
+        processed by the stage and are used to report throughput. When the amount is only
+        known at the end of the stage (e.g., the size of a compressed output), set
+        num_bytes in the dict that the stage yields:
+
+            with profiler.stage('convert') as st:
+                ...
+                st['num_bytes'] = ...
+        """
+        full_name = '/'.join([s['name'] for s in self._open_stages] + [name])
+        # resetting the peak RSS below would lose the peak of the enclosing stages so far
+        for s in self._open_stages:
+            s['peak_rss_mb'] = max(s['peak_rss_mb'], _get_peak_rss_mb())
+        peak_rss_was_reset = _reset_peak_rss()
+        st = {
+            'name': name,
+            'peak_rss_mb': 0.0,
+            'num_bytes': num_bytes
+        }
+        self._open_stages.append(st)
+        io0 = _get_io_counters()
+        t0 = time.time()
+        c0 = _get_cpu_time_sec()
+        try:
+            yield st
+        finally:
+            wall_time_sec = time.time() - t0
+            cpu_time_sec = _get_cpu_time_sec() - c0
+            io1 = _get_io_counters()
+            self._open_stages.pop()
+            record = {
+                'name': full_name,
+                'wall_time_sec': wall_time_sec,
+                'cpu_time_sec': cpu_time_sec,
+                'peak_rss_mb': max(st['peak_rss_mb'], _get_peak_rss_mb()),
+                'peak_rss_is_per_stage': peak_rss_was_reset,
+                'bytes_read': io1['rchar'] - io0['rchar'] if io0 is not None and io1 is not None else None,
+                'bytes_written': io1['wchar'] - io0['wchar'] if io0 is not None and io1 is not None else None,
+                'storage_bytes_read': io1['read_bytes'] - io0['read_bytes'] if io0 is not None and io1 is not None else None,
+                'storage_bytes_written': io1['write_bytes'] - io0['write_bytes'] if io0 is not None and io1 is not None else None,
+                'samples_per_sec': num_samples / wall_time_sec if num_samples and wall_time_sec > 0 else None,
+                'mb_per_sec': st['num_bytes'] / 1e6 / wall_time_sec if st['num_bytes'] and wall_time_sec > 0 else None
+            }
+            # the enclosing stages also saw this peak
+            for s in self._open_stages:
+                s['peak_rss_mb'] = max(s['peak_rss_mb'], record['peak_rss_mb'])
+            self.stages.append(record)
+            print(f':::::::::::::::::::: STAGE {full_name}: {_format_stage(record)} (total elapsed: {time.time() - self._start_time:.3f} s)')
+
+    def profile(self, name: str):
+        """Decorator that records each call of the decorated function as a stage"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record_io(self, summary: dict):
+        """Include the I/O summary of an input file (see IoAccountingFile) in the report"""
+        self.io.append(summary)
+
+    def record_metadata(self, key: str, value: Any):
+        """Include something else in the report (e.g., a decision made during the run)"""
+        self.metadata[key] = value
+
+    def get_report(self) -> dict:
+        return {
+            'name': self.name,
+            'total_wall_time_sec': time.time() - self._start_time,
+            'stages': self.stages,
+            'io': self.io,
+            'metadata': self.metadata
+        }
+
+    def write_json(self, path: str):
+        report = self.get_report()
+        parent = os.path.dirname(path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Wrote profile to {path} (local file, not uploaded as a job output)')
+
+    def print_summary(self):
+        print(f'Profile of {self.name}:')
+        for s in self.stages:
+            print(f'  {s["name"]}: {_format_stage(s)}')
+
+def _format_stage(s: dict) -> str:
+    ret = f'{s["wall_time_sec"]:.3f} s wall, {s["cpu_time_sec"]:.3f} s CPU, {s["peak_rss_mb"]:.0f} MB peak RSS'
+    if s['bytes_read'] is not None:
+        ret += f', {s["bytes_read"] / 1e6:.1f} MB read, {s["bytes_written"] / 1e6:.1f} MB written, {s["storage_bytes_written"] / 1e6:.1f} MB to storage'
+    return ret
+
+def _get_cpu_time_sec() -> float:
+    r_self = resource.getrusage(resource.RUSAGE_SELF)
+    r_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return r_self.ru_utime + r_self.ru_stime + r_children.ru_utime + r_children.ru_stime
+
+def _get_io_counters() -> Union[Dict[str, int], None]:
+    try:
+        with open('/proc/self/io', 'r') as f:
+            ret = {}
+            for line in f:
+                k, v = line.split(':')
+                ret[k.strip()] = int(v)
+            return ret
+    except OSError:
+        return None
+
+def _reset_peak_rss() -> bool:
+    # Writing 5 to clear_refs resets the peak RSS (VmHWM) of the process on Linux
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def _get_peak_rss_mb() -> float:
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    ru_maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return ru_maxrss / 1024 / 1024 if sys.platform == 'darwin' else ru_maxrss / 1024
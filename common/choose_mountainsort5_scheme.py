@@ -0,0 +1,181 @@
+import os
+import json
+import math
+from typing import List, Union
+import numpy as np
+import spikeinterface as si
+from common.get_available_memory_bytes import get_available_memory_bytes
+
+
+# Seconds per unit of work (see _predict_cost). These are rough defaults; they can be
+# calibrated from the predicted and actual costs that run_mountainsort5_sorting records,
+# and overridden with a JSON file of the same keys given by MS5_COST_MODEL.
+DEFAULT_COST_COEFFICIENTS = {
+    'detect_sec_per_sample': 5e-9,
+    'snippet_sec_per_element': 2e-9,
+    'cluster_sec_per_spike': 2e-6,
+    'classify_sec_per_element': 1e-9
+}
+
+def choose_mountainsort5_scheme(
+    recording: si.BaseRecording,
+    *,
+    context,
+    memory_budget_bytes: Union[int, None] = None,
+    num_cores: Union[int, None] = None
+) -> dict:
+    """
+    Choose the MountainSort5 scheme, scheme 2 training duration and scheme 3 block duration
+    for a preprocessed (binary) recording from a cost model of memory and runtime.
+
+    The number of spikes is estimated by a detection pass over short samples of the
+    recording. Among scheme 1, and scheme 2 and scheme 3 (with a few block durations) with
+    the configured training duration, the candidate with the fastest predicted runtime
+    whose predicted memory fits in the budget (80% of the available memory by default) is
+    chosen. If none fits, the training duration is halved (down to a minute) and, failing
+    that, the candidate with the smallest predicted memory is chosen.
+
+    Returns the decision together with the predictions and the inputs of the model so that
+    it can be logged and compared with the actual cost.
+    """
+    sampling_frequency = recording.get_sampling_frequency()
+    num_frames = recording.get_num_frames()
+    num_channels = recording.get_num_channels()
+    duration_sec = num_frames / sampling_frequency
+    if memory_budget_bytes is None:
+        memory_budget_bytes = int(get_available_memory_bytes() * 0.8)
+    if num_cores is None:
+        num_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    coefficients = _get_cost_coefficients()
+
+    event_rate_hz = _estimate_event_rate_hz(
+        recording,
+        detect_threshold=context.detect_threshold,
+        detect_sign=context.detect_sign,
+        detect_time_radius_msec=context.detect_time_radius_msec
+    )
+
+    # the configured training duration first, then shorter ones (down to a minute) if needed to fit
+    training_durations_sec = [min(context.scheme2.scheme2_training_duration_sec, duration_sec)]
+    while training_durations_sec[-1] / 2 >= 60:
+        training_durations_sec.append(training_durations_sec[-1] / 2)
+    # a shorter training duration is faster but gives a worse sorting, so it is only
+    # considered when nothing with a longer one fits
+    candidate_groups: List[List[dict]] = []
+    for training_duration_sec in training_durations_sec:
+        group = [] if len(candidate_groups) > 0 else [{'scheme': 1, 'scheme2_training_duration_sec': None, 'scheme3_block_duration_sec': None}]
+        group += [{'scheme': 2, 'scheme2_training_duration_sec': training_duration_sec, 'scheme3_block_duration_sec': None}]
+        for block_duration_sec in [60 * 30, 60 * 15, 60 * 10, 60 * 5]:
+            if block_duration_sec < duration_sec:
+                group.append({'scheme': 3, 'scheme2_training_duration_sec': min(training_duration_sec, block_duration_sec), 'scheme3_block_duration_sec': block_duration_sec})
+        candidate_groups.append(group)
+    candidates = [c for group in candidate_groups for c in group]
+    for c in candidates:
+        c.update(_predict_cost(
+            c,
+            duration_sec=duration_sec,
+            sampling_frequency=sampling_frequency,
+            num_channels=num_channels,
+            event_rate_hz=event_rate_hz,
+            snippet_num_samples=context.snippet_T1 + context.snippet_T2,
+            num_cores=num_cores,
+            coefficients=coefficients
+        ))
+    chosen = None
+    for i, group in enumerate(candidate_groups):
+        fitting = [c for c in group if c['predicted_memory_bytes'] <= memory_budget_bytes]
+        if len(fitting) > 0:
+            chosen = min(fitting, key=lambda c: c['predicted_runtime_sec'])
+            reason = 'fastest predicted runtime within the memory budget' if i == 0 else 'shortened training to fit in the memory budget'
+            break
+    if chosen is None:
+        chosen = min(candidates, key=lambda c: c['predicted_memory_bytes'])
+        reason = 'no candidate fits in the memory budget; smallest predicted memory'
+    return {
+        **chosen,
+        'reason': reason,
+        'duration_sec': duration_sec,
+        'num_channels': num_channels,
+        'estimated_event_rate_hz': event_rate_hz,
+        'memory_budget_bytes': memory_budget_bytes,
+        'num_cores': num_cores,
+        'cost_coefficients': coefficients,
+        'candidates': candidates
+    }
+
+def _predict_cost(candidate: dict, *, duration_sec: float, sampling_frequency: float, num_channels: int, event_rate_hz: float, snippet_num_samples: int, num_cores: int, coefficients: dict) -> dict:
+    num_frames = duration_sec * sampling_frequency
+    num_spikes = event_rate_hz * duration_sec
+    snippet_bytes = snippet_num_samples * num_channels * 4
+    # scheme 2 detects and classifies in chunks of 100e6 samples (see mountainsort5)
+    chunk_bytes = min(num_frames * num_channels, 100e6) * 4
+    if candidate['scheme'] == 1:
+        # all traces, and all snippets (and a working copy) at once
+        memory_bytes = num_frames * num_channels * 4 + num_spikes * snippet_bytes * 2
+        num_clustered = num_spikes
+        num_blocks = 1
+        num_classified = 0.0
+    else:
+        block_sec = candidate['scheme3_block_duration_sec'] if candidate['scheme'] == 3 else duration_sec
+        num_blocks = math.ceil(duration_sec / block_sec)
+        training_sec = candidate['scheme2_training_duration_sec']
+        num_training_spikes = event_rate_hz * training_sec
+        # the training traces and snippets, plus one chunk of traces and its snippets while classifying
+        chunk_sec = chunk_bytes / (num_channels * 4) / sampling_frequency
+        memory_bytes = (
+            training_sec * sampling_frequency * num_channels * 4 + num_training_spikes * snippet_bytes * 2 +
+            chunk_bytes + event_rate_hz * chunk_sec * snippet_bytes
+        )
+        # each block trains on its own training data
+        num_clustered = num_training_spikes * num_blocks
+        num_classified = num_spikes
+    # the linear algebra (PCA, classification) uses the cores, detection and clustering mostly do not
+    speedup = min(num_cores, 4)
+    # schemes 2 and 3 detect on the training data and then again on all of the data
+    num_detect_passes = 1 if candidate['scheme'] == 1 else 2
+    runtime_sec = (
+        coefficients['detect_sec_per_sample'] * num_frames * num_channels * num_detect_passes +
+        coefficients['snippet_sec_per_element'] * (num_clustered + num_classified) * snippet_num_samples * num_channels / speedup +
+        coefficients['cluster_sec_per_spike'] * num_clustered * math.log2(max(num_clustered / num_blocks, 2)) +
+        coefficients['classify_sec_per_element'] * num_classified * snippet_num_samples * num_channels / speedup
+    )
+    # overhead of the interpreter, temporaries and the sorting output
+    return {
+        'predicted_memory_bytes': int(memory_bytes * 1.5 + 200e6),
+        'predicted_runtime_sec': runtime_sec
+    }
+
+def _estimate_event_rate_hz(recording: si.BaseRecording, *, detect_threshold: float, detect_sign: int, detect_time_radius_msec: float, num_samples: int = 10, sample_duration_sec: float = 1) -> float:
+    from scipy.ndimage import maximum_filter1d
+    sampling_frequency = recording.get_sampling_frequency()
+    num_frames = recording.get_num_frames()
+    sample_num_frames = min(int(sample_duration_sec * sampling_frequency), num_frames)
+    time_radius = max(int(detect_time_radius_msec / 1000 * sampling_frequency), 1)
+    num_events = 0
+    num_sampled_frames = 0
+    starts: List[int] = sorted(set(int(x) for x in np.linspace(0, num_frames - sample_num_frames, num_samples)))
+    for start in starts:
+        traces = recording.get_traces(start_frame=start, end_frame=start + sample_num_frames).astype(np.float32)
+        # the recording is usually whitened, but normalize by the noise level in case it is not
+        traces = traces - np.median(traces, axis=0)
+        noise = np.median(np.abs(traces), axis=0) / 0.6745
+        traces = traces / np.where(noise > 0, noise, 1)
+        if detect_sign < 0:
+            x = np.max(-traces, axis=1)
+        elif detect_sign > 0:
+            x = np.max(traces, axis=1)
+        else:
+            x = np.max(np.abs(traces), axis=1)
+        # peaks above threshold that are the maximum within the time radius
+        is_peak = (x >= detect_threshold) & (x == maximum_filter1d(x, size=2 * time_radius + 1))
+        num_events += int(np.sum(is_peak))
+        num_sampled_frames += sample_num_frames
+    return num_events / (num_sampled_frames / sampling_frequency)
+
+def _get_cost_coefficients() -> dict:
+    ret = dict(DEFAULT_COST_COEFFICIENTS)
+    fname = os.environ.get('MS5_COST_MODEL', '')
+    if fname:
+        with open(fname, 'r') as f:
+            ret.update(json.load(f))
+    return ret
@@ -1,8 +1,21 @@
 import pynwb
 from uuid import uuid4
+from typing import List, Union
 
 
-def create_sorting_out_nwb_file(*, nwbfile_rec, sorting, sorting_out_fname):
+def create_sorting_out_nwb_file(*, nwbfile_rec, sorting, sorting_out_fname, unit_columns: Union[List[dict], None] = None, channel_health: Union[dict, None] = None, preview_intervals_sec: Union[List[tuple], None] = None):
+    """
+    unit_columns, if given, are extra columns of the units table, each a dict with name,
+    description and data (one value per unit, in the order of sorting.get_unit_ids()).
+
+    channel_health, if given, is the output of ChannelHealthStats.get_stats() with the
+    additional 'flagged' (the output of get_bad_channels()) and 'excluded' (the ids of the
+    channels that were not sorted), and is written as the channel_health table of the
+    ecephys processing module.
+
+    preview_intervals_sec, if given, are the (start, stop) times of the windows that were
+    sorted in preview mode, written as the preview_windows time intervals.
+    """
     nwbfile = pynwb.NWBFile(
         session_description=nwbfile_rec.session_description,
         identifier=str(uuid4()),
@@ -23,13 +36,47 @@ def create_sorting_out_nwb_file(*, nwbfile_rec, sorting, sorting_out_fname):
         keywords=nwbfile_rec.keywords
     )
 
+    if unit_columns is None:
+        unit_columns = []
+    for c in unit_columns:
+        nwbfile.add_unit_column(name=c['name'], description=c['description'])
+
     for ii, unit_id in enumerate(sorting.get_unit_ids()):
         st = sorting.get_unit_spike_train(unit_id) / sorting.get_sampling_frequency()
         nwbfile.add_unit(
             id=ii + 1, # must be an int
-            spike_times=st
+            spike_times=st,
+            **{c['name']: c['data'][ii] for c in unit_columns}
         )
 
+    if channel_health is not None:
+        from hdmf.common import DynamicTable
+        table = DynamicTable(name='channel_health', description='Per-channel health statistics computed during the conversion of the recording, and the channels excluded from sorting')
+        table.add_column(name='channel_id', description='Channel id (electrode id in the recording NWB file)')
+        table.add_column(name='rms', description='RMS about the mean')
+        table.add_column(name='mad', description='Median absolute deviation (median over the conversion chunks)')
+        table.add_column(name='saturation_count', description='Number of samples at the minimum or maximum value of the channel')
+        table.add_column(name='flat_fraction', description='Fraction of consecutive samples that are identical')
+        table.add_column(name='flag', description='Why the channel was flagged as bad (flat, saturated, dead or noisy), or empty')
+        table.add_column(name='excluded', description='Whether the channel was excluded from sorting')
+        for i, channel_id in enumerate(channel_health['channel_ids']):
+            table.add_row(
+                channel_id=channel_id,
+                rms=channel_health['rms'][i],
+                mad=channel_health['mad'][i],
+                saturation_count=channel_health['saturation_count'][i],
+                flat_fraction=channel_health['flat_fraction'][i],
+                flag=channel_health['flagged'].get(channel_id, ''),
+                excluded=channel_id in channel_health['excluded']
+            )
+        ecephys_module = nwbfile.create_processing_module(name='ecephys', description='Processed extracellular electrophysiology data')
+        ecephys_module.add(table)
+
+    if preview_intervals_sec is not None:
+        preview_windows = nwbfile.create_time_intervals(name='preview_windows', description='Time windows that were sorted in preview mode (there are no spikes outside of these windows)')
+        for start_time, stop_time in preview_intervals_sec:
+            preview_windows.add_row(start_time=start_time, stop_time=stop_time)
+
     # Write the nwb file
     with pynwb.NWBHDF5IO(sorting_out_fname, 'w') as io: # type: ignore
         io.write(nwbfile, cache_spec=True) # type: ignore
\ No newline at end of file
@@ -0,0 +1,39 @@
+import os
+from typing import Union
+
+
+def get_available_memory_bytes() -> int:
+    """
+    Memory that can be used without swapping: MemAvailable from /proc/meminfo on Linux
+    (or the total physical memory elsewhere), capped by what is left under the cgroup
+    limit when running in a container.
+    """
+    ret = None
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    ret = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    if ret is None:
+        ret = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for limit_fname, usage_fname in [
+        ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'), # cgroup v2
+        ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes') # cgroup v1
+    ]:
+        limit = _read_int(limit_fname)
+        usage = _read_int(usage_fname)
+        if limit is not None and usage is not None:
+            ret = min(ret, max(limit - usage, 0))
+            break
+    return ret
+
+def _read_int(fname: str) -> Union[int, None]:
+    try:
+        with open(fname, 'r') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        # includes 'max' (no limit)
+        return None
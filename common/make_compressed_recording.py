@@ -0,0 +1,181 @@
+import os
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Union
+import numpy as np
+import numcodecs
+import spikeinterface as si
+from common.plan_chunk_size import plan_chunk_size
+from common.ChannelHealthStats import ChannelHealthStats
+
+
+# the size of the compressed chunks (before compression), which are the unit of the reads
+_target_chunk_bytes = 4 * 1024 * 1024
+
+def write_compressed_recording(recording: si.BaseRecording, *, dirname: str, dtype: str, compression: str = 'zstd', channel_health_stats: Union[ChannelHealthStats, None] = None):
+    """
+    Write a recording to dirname as a chunked, losslessly compressed store that is read back
+    lazily with read_compressed_recording, for intermediates on a slow (e.g., network
+    attached) scratch disk that are consumed through the extractor API.
+
+    The traces are cast to dtype and cut into chunks of about 4 MB (all channels, a range of
+    frames). Each chunk is compressed with blosc/zstd, after a bit shuffle for float32 (the
+    exponents and high mantissa bits compress, the noise in the low bits does not) and
+    after a difference along time for each channel for int16 (wrapping, so still lossless).
+    The chunks are compressed by a pool of threads (blosc releases the GIL) and appended to
+    dirname/recording.zdat, with their offsets in dirname/compressed.json.
+    """
+    if compression != 'zstd':
+        raise ValueError(f'Unexpected compression: {compression}')
+    if dtype not in ['float32', 'int16']:
+        raise ValueError(f'Unexpected dtype for a compressed recording: {dtype}')
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.mkdir(dirname)
+    if recording.get_num_segments() != 1:
+        raise NotImplementedError("Can only write recordings with a single segment")
+
+    num_frames = recording.get_num_frames()
+    num_channels = recording.get_num_channels()
+    chunk_num_frames = max(min(_target_chunk_bytes // (num_channels * np.dtype(dtype).itemsize), num_frames), 1)
+    codec = _get_codec(dtype)
+    # the source is read in large blocks (a whole number of chunks), as in make_float32_recording
+    block_num_frames = plan_chunk_size(recording, target_duration_sec=20, num_workers=1)
+    block_num_frames = max(block_num_frames // chunk_num_frames, 1) * chunk_num_frames
+
+    offsets = [0]
+    if channel_health_stats is not None:
+        # accumulated from the reads of this pass (in this thread)
+        channel_health_stats.start()
+    with open(f'{dirname}/recording.zdat', 'wb') as f, ThreadPoolExecutor(max_workers=_get_num_threads()) as executor:
+        for block_start in range(0, num_frames, block_num_frames):
+            block_end = min(block_start + block_num_frames, num_frames)
+            traces = recording.get_traces(start_frame=block_start, end_frame=block_end).astype(dtype, copy=False)
+            chunks = [traces[i:i + chunk_num_frames] for i in range(0, traces.shape[0], chunk_num_frames)]
+            for buf in executor.map(lambda x: _encode_chunk(x, codec=codec), chunks):
+                f.write(buf)
+                offsets.append(offsets[-1] + len(buf))
+    if channel_health_stats is not None:
+        channel_health_stats.stop()
+
+    num_bytes = num_frames * num_channels * np.dtype(dtype).itemsize
+    print(f'Compressed recording: {offsets[-1] / 1e6:.1f} MB ({offsets[-1] / max(num_bytes, 1):.3f} of {num_bytes / 1e6:.1f} MB)')
+    with open(f'{dirname}/compressed.json', 'w') as f:
+        json.dump({
+            'dtype': dtype,
+            'num_frames': int(num_frames),
+            'num_channels': int(num_channels),
+            'chunk_num_frames': int(chunk_num_frames),
+            'codec': codec.get_config(),
+            'delta': dtype == 'int16',
+            'offsets': offsets
+        }, f)
+
+def read_compressed_recording(dirname: str, *, sampling_frequency: float, channel_ids: List, channel_locations: Union[np.ndarray, None] = None) -> si.BaseRecording:
+    with open(f'{dirname}/compressed.json', 'r') as f:
+        info = json.load(f)
+    ret = _CompressedRecording(f'{dirname}/recording.zdat', info=info, sampling_frequency=sampling_frequency, channel_ids=channel_ids)
+    if channel_locations is not None:
+        ret.set_channel_locations(channel_locations)
+    return ret
+
+def _get_codec(dtype: str):
+    return numcodecs.Blosc(
+        cname='zstd',
+        clevel=1, # higher levels are much slower for little gain on noisy traces
+        shuffle=numcodecs.Blosc.BITSHUFFLE if dtype == 'float32' else numcodecs.Blosc.SHUFFLE
+    )
+
+def _get_num_threads() -> int:
+    return min(os.cpu_count() or 1, 8)
+
+def _encode_chunk(x: np.ndarray, *, codec) -> bytes:
+    if x.dtype == np.int16:
+        # difference along time, so that the (correlated) consecutive samples become small numbers
+        d = np.empty_like(x)
+        d[0] = x[0]
+        np.subtract(x[1:], x[:-1], out=d[1:])
+        x = d
+    return bytes(codec.encode(np.ascontiguousarray(x)))
+
+def _decode_chunk(buf: bytes, *, codec, dtype: str, num_channels: int, delta: bool) -> np.ndarray:
+    x = np.frombuffer(codec.decode(buf), dtype=dtype).reshape(-1, num_channels)
+    if delta:
+        x = np.cumsum(x, axis=0, dtype=x.dtype)
+    return x
+
+class _CompressedRecording(si.BaseRecording):
+    def __init__(self, fname: str, *, info: dict, sampling_frequency: float, channel_ids: List):
+        if len(channel_ids) != info['num_channels']:
+            raise ValueError(f'Unexpected number of channel ids for a compressed recording: {len(channel_ids)} != {info["num_channels"]}')
+        si.BaseRecording.__init__(self, channel_ids=channel_ids, sampling_frequency=sampling_frequency, dtype=info['dtype'])
+        self.add_recording_segment(_CompressedRecordingSegment(fname, info=info, sampling_frequency=sampling_frequency))
+        self._kwargs = {'fname': fname}
+
+class _CompressedRecordingSegment(si.BaseRecordingSegment):
+    def __init__(self, fname: str, *, info: dict, sampling_frequency: float):
+        si.BaseRecordingSegment.__init__(self, sampling_frequency=sampling_frequency)
+        self._fname = fname
+        self._dtype = info['dtype']
+        self._num_frames = info['num_frames']
+        self._num_channels = info['num_channels']
+        self._chunk_num_frames = info['chunk_num_frames']
+        self._offsets = info['offsets']
+        self._delta = info['delta']
+        self._codec = numcodecs.get_codec(info['codec'])
+        self._fd = None
+        self._executor = None
+        # the last decoded chunk, for the many short reads within one chunk (e.g., snippets)
+        self._last_chunk = (None, None)
+
+    def get_num_samples(self) -> int:
+        return self._num_frames
+
+    def get_traces(self, start_frame: Union[int, None], end_frame: Union[int, None], channel_indices=None) -> np.ndarray:
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self._num_frames
+        start_frame = int(start_frame)
+        end_frame = int(end_frame)
+        traces = np.empty((max(end_frame - start_frame, 0), self._num_channels), dtype=self._dtype)
+        if end_frame > start_frame:
+            if self._fd is None:
+                self._fd = os.open(self._fname, os.O_RDONLY)
+            i1 = start_frame // self._chunk_num_frames
+            i2 = (end_frame - 1) // self._chunk_num_frames + 1
+
+            def copy_chunk(i: int):
+                chunk = self._get_chunk(i)
+                chunk_start = i * self._chunk_num_frames
+                a = max(start_frame, chunk_start)
+                b = min(end_frame, chunk_start + chunk.shape[0])
+                traces[a - start_frame:b - start_frame] = chunk[a - chunk_start:b - chunk_start]
+            if i2 - i1 == 1:
+                copy_chunk(i1)
+            else:
+                # several chunks (e.g., the blocks read by the sorting) are decoded in parallel,
+                # each directly into its part of the traces
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=_get_num_threads())
+                list(self._executor.map(copy_chunk, range(i1, i2)))
+        if channel_indices is not None:
+            traces = traces[:, channel_indices]
+        return traces
+
+    def _get_chunk(self, i: int) -> np.ndarray:
+        last_index, last_chunk = self._last_chunk
+        if last_index == i:
+            return last_chunk
+        # pread is safe to use from several threads on the same file descriptor
+        buf = os.pread(self._fd, self._offsets[i + 1] - self._offsets[i], self._offsets[i])
+        chunk = _decode_chunk(buf, codec=self._codec, dtype=self._dtype, num_channels=self._num_channels, delta=self._delta)
+        self._last_chunk = (i, chunk)
+        return chunk
+
+    def __del__(self):
+        if self._fd is not None:
+            os.close(self._fd)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
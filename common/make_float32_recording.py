@@ -1,9 +1,22 @@
 import shutil
 import os
+from typing import Union
 import spikeinterface as si
+from common.plan_chunk_size import plan_chunk_size
+from common.ChannelHealthStats import ChannelHealthStats
 
 
-def make_float32_recording(recording: si.BaseRecording, *, dirname: str) -> si.BinaryRecordingExtractor:
+def make_float32_recording(recording: si.BaseRecording, *, dirname: str, channel_health_stats: Union[ChannelHealthStats, None] = None, compression: str = 'none') -> si.BaseRecording:
+    if compression != 'none':
+        # a chunked, compressed store that is read lazily (see make_compressed_recording)
+        from common.make_compressed_recording import write_compressed_recording, read_compressed_recording
+        write_compressed_recording(recording, dirname=dirname, dtype='float32', compression=compression, channel_health_stats=channel_health_stats)
+        return read_compressed_recording(
+            dirname,
+            sampling_frequency=recording.get_sampling_frequency(),
+            channel_ids=recording.get_channel_ids(),
+            channel_locations=recording.get_channel_locations()
+        )
     if os.path.exists(dirname):
         shutil.rmtree(dirname)
     os.mkdir(dirname)
@@ -11,13 +24,19 @@ def make_float32_recording(recording: si.BaseRecording, *, dirname: str) -> si.B
     if recording.get_num_segments() != 1:
         raise NotImplementedError("Can only write recordings with a single segment")
 
+    if channel_health_stats is not None:
+        # accumulated from the reads of this pass (n_jobs=1, so in this process)
+        channel_health_stats.start()
     si.BinaryRecordingExtractor.write_recording(
         recording=recording,
         file_paths=[fname],
         dtype='float32',
         n_jobs=1, # There may be some issues with parallelization (h5py and remfile, who knows)
-        chunk_duration='20s', # this defaults to 1s which is inefficient for download
+        # this defaults to 1s which is inefficient for download
+        chunk_size=plan_chunk_size(recording, target_duration_sec=20, num_workers=1),
     )
+    if channel_health_stats is not None:
+        channel_health_stats.stop()
     ret = si.BinaryRecordingExtractor(
         file_paths=[fname],
         sampling_frequency=recording.get_sampling_frequency(),
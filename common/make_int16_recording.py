@@ -1,11 +1,14 @@
 import shutil
 import os
+from typing import Union
 import numpy as np
 import spikeinterface.preprocessing as spre
 import spikeinterface as si
+from common.plan_chunk_size import plan_chunk_size
+from common.ChannelHealthStats import ChannelHealthStats
 
 
-def make_int16_recording(recording: si.BaseRecording, *, dirname: str) -> si.BinaryRecordingExtractor:
+def make_int16_recording(recording: si.BaseRecording, *, dirname: str, channel_health_stats: Union[ChannelHealthStats, None] = None) -> si.BinaryRecordingExtractor:
     if os.path.exists(dirname):
         shutil.rmtree(dirname)
     os.mkdir(dirname)
@@ -25,13 +28,19 @@ def make_int16_recording(recording: si.BaseRecording, *, dirname: str) -> si.Bin
     # if recording.get_dtype() != np.int16:
     #     # important so it won't be rewritten for kilosort3
     #     raise NotImplementedError(f"Can only write recordings with dtype int16. This recording has dtype {recording.get_dtype()}")
+    if channel_health_stats is not None:
+        # accumulated from the reads of this pass (n_jobs=1, so in this process)
+        channel_health_stats.start()
     si.BinaryRecordingExtractor.write_recording(
         recording=recording,
         file_paths=[fname],
         dtype='int16',
         n_jobs=1, # There may be some issues with parallelization (h5py and remfile, who knows)
-        chunk_duration='20s', # this defaults to 1s which is inefficient for download
+        # this defaults to 1s which is inefficient for download
+        chunk_size=plan_chunk_size(recording, target_duration_sec=20, num_workers=1),
     )
+    if channel_health_stats is not None:
+        channel_health_stats.stop()
     ret = si.BinaryRecordingExtractor(
         file_paths=[fname],
         sampling_frequency=recording.get_sampling_frequency(),
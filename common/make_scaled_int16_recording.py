@@ -0,0 +1,152 @@
+import shutil
+import os
+import json
+from typing import List, Union
+import numpy as np
+import spikeinterface as si
+from common.plan_chunk_size import plan_chunk_size
+from common.ChannelHealthStats import ChannelHealthStats
+from common.make_int16_recording import _determine_optimal_scale_factor_for_int16
+
+
+def make_scaled_int16_recording(recording: si.BaseRecording, *, dirname: str, channel_health_stats: Union[ChannelHealthStats, None] = None, compression: str = 'none') -> si.BaseRecording:
+    """
+    Write a (preprocessed, float) recording to a binary file as int16 with a gain per
+    channel, in half the space of make_float32_recording, and return a recording that
+    reads it back as float32 (dequantized on the fly).
+
+    The gain of each channel is chosen from the first ten seconds as in
+    make_int16_recording, but per channel, since the channels of a filtered (not
+    whitened) recording can have very different noise levels. The samples are rounded,
+    and samples beyond the int16 range are clipped (and counted). The gains are stored in
+    dirname/scaled_int16.json so that the binary can be read again with
+    read_scaled_int16_recording (e.g., by BinaryRecordingCache).
+
+    With a compression (see make_compressed_recording), the int16 samples are written to a
+    chunked, compressed store instead of recording.dat.
+    """
+    if recording.get_num_segments() != 1:
+        raise NotImplementedError("Can only write recordings with a single segment")
+
+    # Look at the first ten seconds of data
+    traces0 = recording.get_traces(start_frame=0, end_frame=min(int(recording.get_sampling_frequency() * 10), recording.get_num_frames())).astype(np.float64)
+    gains = []
+    for m in range(recording.get_num_channels()):
+        max_abs_val = np.max(np.abs(traces0[:, m]))
+        median_abs_val = np.median(np.abs(traces0[:, m]))
+        if max_abs_val == 0:
+            # e.g., a dead channel
+            gains.append(1.0)
+        elif median_abs_val == 0:
+            gains.append(5000 / max_abs_val)
+        else:
+            gains.append(float(_determine_optimal_scale_factor_for_int16(max_abs_val=max_abs_val, median_abs_val=median_abs_val)))
+    recording_quantized = _QuantizedRecording(recording, gains=np.array(gains))
+
+    if compression != 'none':
+        from common.make_compressed_recording import write_compressed_recording
+        write_compressed_recording(recording_quantized, dirname=dirname, dtype='int16', compression=compression, channel_health_stats=channel_health_stats)
+    else:
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        os.mkdir(dirname)
+        if channel_health_stats is not None:
+            # accumulated from the reads of this pass (n_jobs=1, so in this process)
+            channel_health_stats.start()
+        si.BinaryRecordingExtractor.write_recording(
+            recording=recording_quantized,
+            file_paths=[f'{dirname}/recording.dat'],
+            dtype='int16',
+            n_jobs=1, # There may be some issues with parallelization (h5py and remfile, who knows)
+            # this defaults to 1s which is inefficient for download
+            chunk_size=plan_chunk_size(recording, target_duration_sec=20, num_workers=1),
+        )
+        if channel_health_stats is not None:
+            channel_health_stats.stop()
+    num_clipped = recording_quantized.num_clipped
+    if num_clipped > 0:
+        print(f'Warning: {num_clipped} samples were clipped to the int16 range')
+    with open(f'{dirname}/scaled_int16.json', 'w') as f:
+        json.dump({'gains': gains, 'num_clipped': num_clipped}, f)
+    return read_scaled_int16_recording(
+        dirname,
+        sampling_frequency=recording.get_sampling_frequency(),
+        channel_ids=recording.get_channel_ids().tolist(),
+        channel_locations=recording.get_channel_locations()
+    )
+
+def read_scaled_int16_recording(dirname: str, *, sampling_frequency: float, channel_ids: List, channel_locations: Union[np.ndarray, None] = None) -> si.BaseRecording:
+    with open(f'{dirname}/scaled_int16.json', 'r') as f:
+        gains = np.array(json.load(f)['gains'])
+    if os.path.exists(f'{dirname}/compressed.json'):
+        # written with a compression
+        from common.make_compressed_recording import read_compressed_recording
+        recording_int16 = read_compressed_recording(dirname, sampling_frequency=sampling_frequency, channel_ids=channel_ids)
+    else:
+        recording_int16 = si.BinaryRecordingExtractor(
+            file_paths=[f'{dirname}/recording.dat'],
+            sampling_frequency=sampling_frequency,
+            channel_ids=channel_ids,
+            num_chan=len(channel_ids),
+            dtype='int16'
+        )
+    if channel_locations is not None:
+        recording_int16.set_channel_locations(channel_locations)
+    return _DequantizedRecording(recording_int16, gains=gains)
+
+class _QuantizedRecording(si.BaseRecording):
+    def __init__(self, recording: si.BaseRecording, *, gains: np.ndarray):
+        si.BaseRecording.__init__(self, channel_ids=recording.get_channel_ids(), sampling_frequency=recording.get_sampling_frequency(), dtype='int16')
+        recording.copy_metadata(self)
+        self._segment = _QuantizedRecordingSegment(recording._recording_segments[0], gains=gains)
+        self.add_recording_segment(self._segment)
+        # so that the source can still be found through the chain (e.g., by plan_chunk_size)
+        self._kwargs = {'recording': recording}
+
+    @property
+    def num_clipped(self) -> int:
+        return self._segment.num_clipped
+
+class _QuantizedRecordingSegment(si.BaseRecordingSegment):
+    def __init__(self, parent_segment: si.BaseRecordingSegment, *, gains: np.ndarray):
+        si.BaseRecordingSegment.__init__(self, sampling_frequency=parent_segment.sampling_frequency)
+        self._parent_segment = parent_segment
+        self._gains = gains.astype(np.float32)
+        self.num_clipped = 0
+
+    def get_num_samples(self) -> int:
+        return self._parent_segment.get_num_samples()
+
+    def get_traces(self, start_frame: Union[int, None], end_frame: Union[int, None], channel_indices=None) -> np.ndarray:
+        traces = self._parent_segment.get_traces(start_frame, end_frame, channel_indices)
+        gains = self._gains if channel_indices is None else self._gains[channel_indices]
+        # in float32 (rather than float64), in place
+        x = traces.astype(np.float32) * gains[None, :]
+        np.round(x, out=x)
+        if x.size > 0 and (x.min() < -32767 or x.max() > 32767):
+            self.num_clipped += int(np.sum(np.abs(x) > 32767))
+            np.clip(x, -32767, 32767, out=x)
+        return x.astype(np.int16)
+
+class _DequantizedRecording(si.BaseRecording):
+    def __init__(self, recording: si.BaseRecording, *, gains: np.ndarray):
+        si.BaseRecording.__init__(self, channel_ids=recording.get_channel_ids(), sampling_frequency=recording.get_sampling_frequency(), dtype='float32')
+        recording.copy_metadata(self)
+        self.add_recording_segment(_DequantizedRecordingSegment(recording._recording_segments[0], scale=(1 / gains).astype(np.float32)))
+        self._kwargs = {'recording': recording}
+
+class _DequantizedRecordingSegment(si.BaseRecordingSegment):
+    def __init__(self, parent_segment: si.BaseRecordingSegment, *, scale: np.ndarray):
+        si.BaseRecordingSegment.__init__(self, sampling_frequency=parent_segment.sampling_frequency)
+        self._parent_segment = parent_segment
+        self._scale = scale
+
+    def get_num_samples(self) -> int:
+        return self._parent_segment.get_num_samples()
+
+    def get_traces(self, start_frame: Union[int, None], end_frame: Union[int, None], channel_indices=None) -> np.ndarray:
+        traces = self._parent_segment.get_traces(start_frame, end_frame, channel_indices)
+        scale = self._scale if channel_indices is None else self._scale[channel_indices]
+        x = traces.astype(np.float32)
+        x *= scale[None, :]
+        return x
@@ -0,0 +1,21 @@
+from typing import Union
+import spikeinterface as si
+from common.ChannelHealthStats import ChannelHealthStats
+from common.make_float32_recording import make_float32_recording
+from common.make_scaled_int16_recording import make_scaled_int16_recording
+
+
+def make_scratch_recording(recording: si.BaseRecording, *, dirname: str, dtype: str = 'float32', compression: str = 'none', channel_health_stats: Union[ChannelHealthStats, None] = None) -> si.BaseRecording:
+    """
+    Write an intermediate (e.g., preprocessed) recording to the scratch disk as float32
+    (make_float32_recording) or as int16 with per-channel gains (make_scaled_int16_recording,
+    half the size, read back as float32), as chosen by the scratch_dtype preprocessing
+    parameter, either as a raw binary or (scratch_compression) as a chunked, compressed
+    store that is read lazily (make_compressed_recording).
+    """
+    if dtype == 'float32':
+        return make_float32_recording(recording, dirname=dirname, channel_health_stats=channel_health_stats, compression=compression)
+    elif dtype == 'int16':
+        return make_scaled_int16_recording(recording, dirname=dirname, channel_health_stats=channel_health_stats, compression=compression)
+    else:
+        raise ValueError(f'Unexpected scratch dtype: {dtype}')
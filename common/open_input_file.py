@@ -0,0 +1,36 @@
+import os
+from typing import Any
+from common.IoAccountingFile import IoAccountingFile
+
+
+def open_input_file(inp: Any, *, label: str = 'input', download: bool = False) -> IoAccountingFile:
+    """
+    Open a dendro input file for reading (a remfile.File, or a local file) wrapped in an
+    IoAccountingFile so that the reads of the job can be summarized at the end of the run.
+
+    If the IO_TRACE_DIR environment variable is set, the reads are also traced to
+    $IO_TRACE_DIR/<label>.io_trace.csv for offline replay.
+
+    If the NWB_BLOCK_CACHE_DIR environment variable is set, remote inputs are read through
+    a SharedBlockCache in that directory (bounded to NWB_BLOCK_CACHE_SIZE_GB, default 20)
+    instead of a remfile.File, so that the jobs on a node that read the same file share the
+    fetched byte ranges.
+    """
+    trace_dir = os.environ.get('IO_TRACE_DIR', '')
+    trace_fname = None
+    if trace_dir:
+        if not os.path.exists(trace_dir):
+            os.makedirs(trace_dir)
+        trace_fname = f'{trace_dir}/{label}.io_trace.csv'
+    block_cache_dir = os.environ.get('NWB_BLOCK_CACHE_DIR', '')
+    if block_cache_dir and not download and inp.local_file_name is None:
+        from common.SharedBlockCache import SharedBlockCache
+        block_cache = SharedBlockCache(
+            block_cache_dir,
+            max_size_bytes=int(float(os.environ.get('NWB_BLOCK_CACHE_SIZE_GB', '20')) * 1e9)
+        )
+        # inp has a get_url() method, so that the url can renew as needed
+        file = block_cache.open(inp)
+    else:
+        file = inp.get_file(download=download)
+    return IoAccountingFile(file, label=label, trace_fname=trace_fname)
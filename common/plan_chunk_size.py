@@ -0,0 +1,64 @@
+from typing import Union
+import spikeinterface as si
+from common.get_available_memory_bytes import get_available_memory_bytes
+
+
+def plan_chunk_size(
+    recording: si.BaseRecording,
+    *,
+    target_duration_sec: float,
+    num_workers: int = 1,
+    memory_fraction: float = 0.25,
+    bytes_per_sample: int = 20
+) -> int:
+    """
+    Choose the number of frames per chunk for processing a (lazy) recording that is backed
+    by an HDF5 dataset, e.g., for write_recording or for the random chunks of whitening.
+
+    Starting from target_duration_sec, the chunk is limited so that num_workers chunks fit
+    in memory_fraction of the available memory, where bytes_per_sample accounts for the
+    copies held along the preprocessing chain (raw, filtered, scaled, whitened, ...). It is
+    then aligned to the time chunking of the underlying HDF5 dataset: rounded down to a
+    multiple of the storage chunk, or up to one whole storage chunk when the target is
+    smaller, so that chunks do not partially read (and download) the same storage chunks
+    more than once.
+    """
+    sampling_frequency = recording.get_sampling_frequency()
+    num_frames = recording.get_num_frames()
+    num_channels = recording.get_num_channels()
+
+    memory_budget_bytes = get_available_memory_bytes() * memory_fraction / max(num_workers, 1)
+    max_num_frames = max(int(memory_budget_bytes / (num_channels * bytes_per_sample)), 1)
+    chunk_size = min(int(target_duration_sec * sampling_frequency), max_num_frames)
+
+    storage_chunk_frames = get_storage_chunk_frames(recording)
+    if storage_chunk_frames is not None:
+        if chunk_size >= storage_chunk_frames:
+            chunk_size = (chunk_size // storage_chunk_frames) * storage_chunk_frames
+        elif storage_chunk_frames <= max_num_frames:
+            chunk_size = storage_chunk_frames
+        # otherwise a single storage chunk does not fit in the budget and partial reads are unavoidable
+
+    chunk_size = max(min(chunk_size, num_frames), 1)
+    print(f'Chunk size: {chunk_size} frames ({chunk_size / sampling_frequency:.2f} s; {num_channels} channels; storage chunk: {storage_chunk_frames} frames; {num_workers} workers)')
+    return chunk_size
+
+def get_storage_chunk_frames(recording: si.BaseRecording) -> Union[int, None]:
+    # find the HDF5 dataset at the root of the lazy preprocessing chain (e.g., NwbRecording)
+    dataset = _find_hdf5_dataset(recording)
+    if dataset is None or dataset.chunks is None:
+        return None
+    return int(dataset.chunks[0])
+
+def _find_hdf5_dataset(recording: si.BaseRecording):
+    for segment in recording._recording_segments:
+        dataset = getattr(segment, '_electrical_series_data', None)
+        if dataset is not None and hasattr(dataset, 'chunks'):
+            return dataset
+    # preprocessors and slices keep their parent recording in their kwargs
+    for v in recording._kwargs.values():
+        if isinstance(v, si.BaseRecording):
+            ret = _find_hdf5_dataset(v)
+            if ret is not None:
+                return ret
+    return None
@@ -0,0 +1,37 @@
+from typing import Union
+import spikeinterface as si
+import spikeinterface.preprocessing as spre
+from common._scale_recording_if_float_type import _scale_recording_if_float_type
+from common.plan_chunk_size import plan_chunk_size
+from common.PreviewWindows import PreviewWindows
+
+
+def preprocess_for_mountainsort5(recording: si.BaseRecording, *, preprocessing, preview_windows: Union[PreviewWindows, None] = None) -> si.BaseRecording:
+    """
+    Lazy bandpass filtering and whitening as configured by Mountainsort5PreprocessingParameters
+    (or any object with the same attributes).
+
+    If preview_windows is given, the filtered windows are concatenated before whitening.
+    """
+    if preprocessing.filter:
+        print('Filtering on')
+        recording_filtered = spre.bandpass_filter(recording, freq_min=preprocessing.freq_min, freq_max=preprocessing.freq_max)
+    else:
+        print('Filtering off')
+        recording_filtered = recording
+    if preview_windows is not None:
+        recording_filtered = preview_windows.concatenate(recording_filtered)
+    if preprocessing.whiten:
+        print('Whitening on')
+        # see comment below in _scale_recording_if_float_type
+        recording_scaled = _scale_recording_if_float_type(recording_filtered)
+        recording_preprocessed: si.BaseRecording = spre.whiten(
+            recording_scaled,
+            dtype='float32',
+            num_chunks_per_segment=1, # by default this is 20 which takes a long time to load depending on the chunking
+            chunk_size=plan_chunk_size(recording_scaled, target_duration_sec=int(1e5) / recording_scaled.get_sampling_frequency())
+        )
+    else:
+        print('Whitening off')
+        recording_preprocessed = recording_filtered
+    return recording_preprocessed
@@ -0,0 +1,98 @@
+import math
+import time
+from typing import List, Union
+import spikeinterface as si
+
+
+def run_mountainsort5_sorting(*, recording: si.BaseRecording, context, scheme_choices: Union[List[dict], None] = None) -> si.BaseSorting:
+    """
+    Run MountainSort5 on a preprocessed recording using the sorting scheme and parameters
+    of a Mountainsort5SortingParameters model (e.g., a processor context). Any object with
+    the same attributes will do for schemes 1 to 3, but scheme 0 copies the context with
+    model_copy.
+
+    Scheme 0 (auto) chooses the scheme, training duration and block duration with
+    choose_mountainsort5_scheme. The decision, with its predicted and actual runtime and
+    peak memory, is printed and appended to scheme_choices if given (e.g., to be included
+    in the profile of the job for calibrating the cost model).
+    """
+    if context.scheme == 0:
+        from common.choose_mountainsort5_scheme import choose_mountainsort5_scheme
+        from common.StageProfiler import _get_peak_rss_mb
+        choice = choose_mountainsort5_scheme(recording, context=context)
+        print(f'Auto scheme: {_describe_scheme(choice)}: {choice["reason"]}')
+        print(f'  {choice["duration_sec"]:.0f} s, {choice["num_channels"]} channels, estimated {choice["estimated_event_rate_hz"]:.0f} events/s, {choice["num_cores"]} cores, {choice["memory_budget_bytes"] / 1e9:.1f} GB budget')
+        for c in choice['candidates']:
+            print(f'  candidate {_describe_scheme(c)}: predicted {c["predicted_runtime_sec"]:.0f} s, {c["predicted_memory_bytes"] / 1e9:.2f} GB')
+        update = {'scheme': choice['scheme']}
+        if choice['scheme2_training_duration_sec'] is not None:
+            update['scheme2'] = context.scheme2.model_copy(update={'scheme2_training_duration_sec': int(math.ceil(choice['scheme2_training_duration_sec']))})
+        if choice['scheme3_block_duration_sec'] is not None:
+            update['scheme3_block_duration_sec'] = choice['scheme3_block_duration_sec']
+        timer = time.time()
+        sorting = run_mountainsort5_sorting(recording=recording, context=context.model_copy(update=update))
+        # the peak since the start of the enclosing profiler stage (or of the process)
+        choice['actual_runtime_sec'] = time.time() - timer
+        choice['actual_peak_rss_bytes'] = int(_get_peak_rss_mb() * 1024 * 1024)
+        print(f'Auto scheme: predicted {choice["predicted_runtime_sec"]:.0f} s and {choice["predicted_memory_bytes"] / 1e9:.2f} GB; actual {choice["actual_runtime_sec"]:.0f} s and {choice["actual_peak_rss_bytes"] / 1e9:.2f} GB peak RSS')
+        if scheme_choices is not None:
+            scheme_choices.append(choice)
+        return sorting
+
+    import mountainsort5 as ms5
+
+    print('Setting up sorting parameters')
+    scheme1_sorting_parameters = ms5.Scheme1SortingParameters(
+        detect_threshold=context.detect_threshold,
+        detect_channel_radius=context.scheme1_detect_channel_radius,
+        detect_time_radius_msec=context.detect_time_radius_msec,
+        detect_sign=context.detect_sign,
+        snippet_T1=context.snippet_T1,
+        snippet_T2=context.snippet_T2,
+        snippet_mask_radius=context.snippet_mask_radius,
+        npca_per_channel=context.npca_per_channel,
+        npca_per_subdivision=context.npca_per_subdivision
+    )
+
+    scheme2_sorting_parameters = ms5.Scheme2SortingParameters(
+        phase1_detect_channel_radius=context.scheme2.scheme2_phase1_detect_channel_radius,
+        detect_channel_radius=context.scheme2.scheme2_detect_channel_radius,
+        phase1_detect_threshold=context.detect_threshold,
+        phase1_detect_time_radius_msec=context.detect_time_radius_msec,
+        detect_time_radius_msec=context.detect_time_radius_msec,
+        phase1_npca_per_channel=context.npca_per_channel,
+        phase1_npca_per_subdivision=context.npca_per_subdivision,
+        detect_sign=context.detect_sign,
+        detect_threshold=context.detect_threshold,
+        snippet_T1=context.snippet_T1,
+        snippet_T2=context.snippet_T2,
+        snippet_mask_radius=context.snippet_mask_radius,
+        max_num_snippets_per_training_batch=context.scheme2.scheme2_max_num_snippets_per_training_batch,
+        classifier_npca=None,
+        training_duration_sec=context.scheme2.scheme2_training_duration_sec,
+        training_recording_sampling_mode=context.scheme2.scheme2_training_recording_sampling_mode # type: ignore
+    )
+
+    scheme3_sorting_parameters = ms5.Scheme3SortingParameters(
+        block_sorting_parameters=scheme2_sorting_parameters, block_duration_sec=context.scheme3_block_duration_sec
+    )
+
+    if context.scheme == 1:
+        print('Sorting scheme 1')
+        sorting = ms5.sorting_scheme1(recording=recording, sorting_parameters=scheme1_sorting_parameters)
+    elif context.scheme == 2:
+        print('Sorting scheme 2')
+        sorting = ms5.sorting_scheme2(recording=recording, sorting_parameters=scheme2_sorting_parameters)
+    elif context.scheme == 3:
+        print('Sorting scheme 3')
+        sorting = ms5.sorting_scheme3(recording=recording, sorting_parameters=scheme3_sorting_parameters)
+    else:
+        raise ValueError(f'Unexpected scheme: {context.scheme}')
+    return sorting
+
+def _describe_scheme(c: dict) -> str:
+    if c['scheme'] == 1:
+        return 'scheme 1'
+    if c['scheme'] == 2:
+        return f'scheme 2 with {c["scheme2_training_duration_sec"]:.0f} s training'
+    return f'scheme 3 with {c["scheme3_block_duration_sec"]:.0f} s blocks and {c["scheme2_training_duration_sec"]:.0f} s training'
@@ -0,0 +1,104 @@
+import os
+import sys
+import json
+import time
+import subprocess
+from typing import Union
+import numpy as np
+import spikeinterface as si
+
+
+def run_mountainsort5_subprocess(
+    *,
+    cache_dir: str,
+    key: str,
+    sorting_parameters: dict,
+    output_dir: str,
+    mountainsort5_path: Union[str, None] = None
+) -> dict:
+    """
+    Sort a binary recording of a BinaryRecordingCache with MountainSort5 in a separate
+    Python process, e.g., to compare builds of mountainsort5 (different package versions
+    cannot be imported in the same process) or to measure the runtime and peak memory of
+    the sorting in isolation.
+
+    sorting_parameters are the sorting fields of a Mountainsort5ProcessorContext (as
+    given by model_dump), with a concrete scheme (not 0). mountainsort5_path, if given, is
+    a directory with a mountainsort5 package (e.g., installed with pip install --target)
+    that takes precedence over the installed one.
+
+    Returns the sorting together with the runtime, the peak RSS and the version and
+    location of the mountainsort5 package that was used.
+    """
+    # the subprocess runs in the directory of the app
+    output_dir = os.path.abspath(output_dir)
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(f'{output_dir}/sorting_parameters.json', 'w') as f:
+        json.dump(sorting_parameters, f)
+    # the directory that contains the common package
+    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    python_path = [app_dir] + ([os.path.abspath(mountainsort5_path)] if mountainsort5_path else [])
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(python_path[::-1] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    timer = time.time()
+    r = subprocess.run([sys.executable, '-m', 'common.run_mountainsort5_subprocess', cache_dir, key, output_dir], env=env, cwd=app_dir)
+    elapsed_sec = time.time() - timer
+    if r.returncode != 0:
+        raise Exception(f'Sorting subprocess failed with return code {r.returncode}')
+    with open(f'{output_dir}/result.json', 'r') as f:
+        result = json.load(f)
+    spike_trains = np.load(f'{output_dir}/spike_trains.npz')
+    units = {unit_id: spike_trains[str(unit_id)] for unit_id in result['unit_ids']}
+    sorting = _numpy_sorting_from_dict([units], sampling_frequency=result['sampling_frequency'])
+    return {
+        **result,
+        'process_time_sec': elapsed_sec,
+        'sorting': sorting
+    }
+
+def _main(cache_dir: str, key: str, output_dir: str):
+    # runs in the subprocess
+    from types import SimpleNamespace
+    import mountainsort5 as ms5
+    from common.BinaryRecordingCache import BinaryRecordingCache
+    from common.run_mountainsort5_sorting import run_mountainsort5_sorting
+    from common.StageProfiler import _get_peak_rss_mb
+
+    print(f'Using mountainsort5 {getattr(ms5, "__version__", "(unknown version)")} from {os.path.dirname(ms5.__file__)}')
+    with open(f'{output_dir}/sorting_parameters.json', 'r') as f:
+        sorting_parameters = json.load(f)
+    context = SimpleNamespace(**{**sorting_parameters, 'scheme2': SimpleNamespace(**sorting_parameters['scheme2'])})
+    recording = BinaryRecordingCache(cache_dir).get(key)
+    if recording is None:
+        raise Exception(f'Binary recording not found in cache: {key}')
+    timer = time.time()
+    sorting = run_mountainsort5_sorting(recording=recording, context=context)
+    sort_time_sec = time.time() - timer
+    unit_ids = [int(x) for x in sorting.get_unit_ids()]
+    np.savez(f'{output_dir}/spike_trains.npz', **{str(unit_id): sorting.get_unit_spike_train(unit_id) for unit_id in unit_ids})
+    with open(f'{output_dir}/result.json', 'w') as f:
+        json.dump({
+            'mountainsort5_version': getattr(ms5, '__version__', None),
+            'mountainsort5_path': os.path.dirname(ms5.__file__),
+            'sampling_frequency': sorting.get_sampling_frequency(),
+            'unit_ids': unit_ids,
+            'sort_time_sec': sort_time_sec,
+            'peak_rss_mb': _get_peak_rss_mb()
+        }, f)
+
+def _numpy_sorting_from_dict(units_dict_list, *, sampling_frequency):
+    try:
+        # different versions of spikeinterface
+        # see: https://github.com/SpikeInterface/spikeinterface/issues/2083
+        sorting = si.NumpySorting.from_dict(
+            units_dict_list, sampling_frequency=sampling_frequency # type: ignore
+        )
+    except: # noqa
+        sorting = si.NumpySorting.from_unit_dict(
+            units_dict_list, sampling_frequency=sampling_frequency # type: ignore
+        )
+    return sorting
+
+if __name__ == '__main__':
+    _main(sys.argv[1], sys.argv[2], sys.argv[3])
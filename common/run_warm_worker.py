@@ -0,0 +1,174 @@
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import importlib
+import traceback
+from typing import Any, Iterator, List, Tuple, Union, get_args, get_origin, get_type_hints
+
+
+def run_warm_worker(*, processors: List[Any], preload_modules: List[str], jobs: str, work_dir: str = 'warm_worker_jobs'):
+    """
+    Run many jobs in a single long-lived process so that interpreter startup and the heavy
+    imports (spikeinterface, pynwb, h5py, the sorters, ...) are paid once rather than per job.
+
+    jobs is either a directory, whose *.json files are run in sorted order, or '-' to read one
+    JSON job per line from stdin. A job looks like
+        {"job_id": "job1", "processor": "mountainsort5", "context": {"input": "/data/rec.nwb", "output": "./sorting.nwb", ...}}
+    where, as when testing a processor locally with dendro, inputs are URLs or local paths
+    and outputs are local paths. Relative paths are relative to the job file (or to the
+    current directory for stdin).
+
+    Each job runs in its own fresh directory <work_dir>/<job_id>, where the processor writes
+    its scratch files, output/profile.json and the job log. Environment variables are restored after
+    each job, and a failing job is recorded in <work_dir>/<job_id>/job_result.json without
+    stopping the worker. The scratch files are deleted after a job completes (output/ and the
+    log are kept) and left in place for inspection when it fails.
+    """
+    print('Preloading modules')
+    timer = time.time()
+    for module_name in preload_modules:
+        try:
+            importlib.import_module(module_name)
+        except ImportError as e:
+            print(f'Warning: unable to preload {module_name}: {e}')
+    print(f'Preloaded {len(preload_modules)} modules in {time.time() - timer:.1f} s')
+
+    processors_by_name = {P.name: P for P in processors}
+    work_dir = os.path.abspath(work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    results = []
+    for job, base_dir in _iterate_jobs(jobs):
+        job_id = str(job.get('job_id', f'job_{len(results) + 1}'))
+        print(f'=== Running job {job_id}')
+        result = _run_job(job=job, job_id=job_id, base_dir=base_dir, processors_by_name=processors_by_name, work_dir=work_dir)
+        print(f'=== Job {job_id}: {result["status"]} ({result["elapsed_sec"]:.1f} s)')
+        results.append(result)
+    num_failed = len([r for r in results if r['status'] != 'completed'])
+    print(f'Ran {len(results)} jobs ({num_failed} failed) in {time.time() - timer:.1f} s')
+    with open(f'{work_dir}/worker_summary.json', 'w') as f:
+        json.dump(results, f, indent=2)
+
+def _iterate_jobs(jobs: str) -> Iterator[Tuple[dict, str]]:
+    if jobs == '-':
+        for line in sys.stdin:
+            if line.strip():
+                yield json.loads(line), os.getcwd()
+    elif os.path.isdir(jobs):
+        for fname in sorted(os.listdir(jobs)):
+            if fname.endswith('.json'):
+                with open(f'{jobs}/{fname}', 'r') as f:
+                    job = json.load(f)
+                job.setdefault('job_id', fname[:-len('.json')])
+                yield job, os.path.abspath(jobs)
+    else:
+        raise Exception(f'Jobs must be a directory or - for stdin: {jobs}')
+
+def _run_job(*, job: dict, job_id: str, base_dir: str, processors_by_name: dict, work_dir: str) -> dict:
+    job_dir = f'{work_dir}/{job_id}'
+    if os.path.exists(job_dir):
+        shutil.rmtree(job_dir)
+    os.makedirs(job_dir)
+    result = {
+        'job_id': job_id,
+        'processor': job.get('processor', None),
+        'status': 'failed',
+        'error': None,
+        'elapsed_sec': 0.0
+    }
+    original_cwd = os.getcwd()
+    original_environ = dict(os.environ)
+    original_stdout = sys.stdout
+    original_stderr = sys.stderr
+    timer = time.time()
+    with open(f'{job_dir}/job.log', 'w') as log_file:
+        sys.stdout = _Tee(original_stdout, log_file)
+        sys.stderr = _Tee(original_stderr, log_file)
+        try:
+            processor_class = processors_by_name.get(job.get('processor', None), None)
+            if processor_class is None:
+                raise Exception(f'Processor not found: {job.get("processor", None)}')
+            # resolve the paths before changing to the job directory
+            context = _create_context(processor_class, job.get('context', {}), base_dir=base_dir)
+            os.chdir(job_dir)
+            processor_class.run(context)
+            result['status'] = 'completed'
+        except Exception: # noqa
+            traceback.print_exc()
+            result['error'] = traceback.format_exc()
+        finally:
+            result['elapsed_sec'] = time.time() - timer
+            sys.stdout = original_stdout
+            sys.stderr = original_stderr
+            os.chdir(original_cwd)
+            # e.g., the kilosort processors set HOME
+            os.environ.clear()
+            os.environ.update(original_environ)
+            gc.collect()
+    if result['status'] == 'completed':
+        # the scratch files of hundreds of jobs would fill the disk; keep them for failed jobs
+        for fname in os.listdir(job_dir):
+            if fname not in ['job.log', 'output']:
+                path = f'{job_dir}/{fname}'
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+    with open(f'{job_dir}/job_result.json', 'w') as f:
+        json.dump(result, f, indent=2)
+    return result
+
+def _create_context(processor_class: Any, context: dict, *, base_dir: str):
+    from dendro.sdk import InputFile, OutputFile
+    context_type = get_type_hints(processor_class.run).get('context', None)
+    if context_type is None:
+        raise Exception(f'Processor does not have a context type: {processor_class.name}')
+    context = dict(context)
+    for name, field in context_type.model_fields.items():
+        if name not in context:
+            continue
+        annotation = field.annotation
+        if annotation is InputFile:
+            context[name] = _create_input_file(name, context[name], base_dir=base_dir)
+        elif get_origin(annotation) is list and get_args(annotation) == (InputFile,):
+            context[name] = [_create_input_file(name, v, base_dir=base_dir) for v in context[name]]
+        elif annotation is OutputFile:
+            value = context[name]
+            if value.startswith('http://') or value.startswith('https://'):
+                raise Exception(f'Output value for {name} cannot be a URL. Should be local file path. Got: {value}')
+            context[name] = OutputFile(name=name, output_file_name=os.path.join(base_dir, value))
+        elif getattr(annotation, '__name__', None) == 'OutputFolder':
+            # OutputFolder is only in newer versions of dendro
+            from dendro.sdk import OutputFolder
+            value = context[name]
+            if value.startswith('http://') or value.startswith('https://'):
+                raise Exception(f'Output folder value for {name} cannot be a URL. Should be local folder path. Got: {value}')
+            context[name] = OutputFolder(name=name, output_folder_name=os.path.join(base_dir, value))
+    return context_type(**context)
+
+def _create_input_file(name: str, value: Union[str, Any], *, base_dir: str):
+    from dendro.sdk import InputFile
+    if not isinstance(value, str):
+        return value
+    if value.startswith('http://') or value.startswith('https://'):
+        return InputFile(name=name, url=value)
+    return InputFile(name=name, local_file_name=os.path.join(base_dir, value))
+
+class _Tee:
+    def __init__(self, a, b):
+        self._a = a
+        self._b = b
+
+    def write(self, s):
+        self._a.write(s)
+        self._b.write(s)
+        return len(s)
+
+    def flush(self):
+        self._a.flush()
+        self._b.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._a, name)
@@ -0,0 +1,156 @@
+import os
+import shutil
+from typing import Dict, List, Tuple, Union
+import numpy as np
+import spikeinterface as si
+from common.make_scratch_recording import make_scratch_recording
+from common.run_mountainsort5_sorting import run_mountainsort5_sorting
+from common.StageProfiler import StageProfiler
+from common.ChannelHealthStats import ChannelHealthStats
+
+
+def run_windowed_mountainsort5_sorting(
+    *,
+    recording: si.BaseRecording,
+    context,
+    window_duration_sec: float,
+    window_overlap_sec: float,
+    link_threshold: float,
+    dirname: str,
+    profiler: StageProfiler,
+    channel_health_stats: Union[ChannelHealthStats, None] = None,
+    scheme_choices: Union[List[dict], None] = None
+) -> si.BaseSorting:
+    """
+    Sort a long (e.g., multi-day) lazily preprocessed recording in windows of
+    window_duration_sec that overlap by window_overlap_sec, so that the scratch disk and
+    memory are bounded by the window rather than by the whole recording.
+
+    Each window is converted to a binary file and sorted with run_mountainsort5_sorting.
+    At most two window binaries are on disk at any time (they alternate between
+    dirname/window_0 and dirname/window_1). The units of each window are linked to the
+    units found so far by the cosine similarity of their templates (the mean snippet on
+    the whitened window): the most similar pairs above link_threshold are linked one to
+    one, and the other units of the window start new units. Each window keeps the spikes
+    of the frames up to the middle of its overlaps with its neighbors, so that spikes in the
+    overlaps are neither lost nor counted twice, and spikes near the edges of the windows
+    (where the filter and the detection are less reliable) are taken from the neighbor.
+
+    Frames are int64 throughout, so there is no limit on the length of the recording.
+    """
+    if recording.get_num_segments() != 1:
+        raise NotImplementedError('Can only sort recordings with a single segment in windows')
+    sampling_frequency = recording.get_sampling_frequency()
+    num_frames = int(recording.get_num_frames())
+    windows = _get_windows(num_frames, window_num_frames=int(window_duration_sec * sampling_frequency), overlap_num_frames=int(window_overlap_sec * sampling_frequency))
+    print(f'Sorting in {len(windows)} windows of {window_duration_sec} s with {window_overlap_sec} s overlap')
+
+    os.makedirs(dirname, exist_ok=True)
+    spike_trains: Dict[int, List[np.ndarray]] = {}
+    templates: Dict[int, np.ndarray] = {}
+    for k, (start_frame, end_frame) in enumerate(windows):
+        # the frames whose spikes are kept from this window
+        keep_start = start_frame if k == 0 else (start_frame + windows[k - 1][1]) // 2
+        keep_end = end_frame if k == len(windows) - 1 else (windows[k + 1][0] + end_frame) // 2
+        num_samples = (end_frame - start_frame) * recording.get_num_channels()
+        with profiler.stage(f'window_{k}'):
+            print(f'Window {k + 1} of {len(windows)}: frames {start_frame} to {end_frame}')
+            with profiler.stage('convert', num_samples=num_samples, num_bytes=num_samples * 4):
+                recording_window = make_scratch_recording(
+                    recording.frame_slice(start_frame=start_frame, end_frame=end_frame),
+                    dirname=f'{dirname}/window_{k % 2}',
+                    dtype=context.preprocessing.scratch_dtype,
+                    compression=context.preprocessing.scratch_compression,
+                    channel_health_stats=channel_health_stats
+                )
+            with profiler.stage('sort', num_samples=num_samples, num_bytes=num_samples * 4):
+                sorting_window = run_mountainsort5_sorting(recording=recording_window, context=context, scheme_choices=scheme_choices)
+            with profiler.stage('link'):
+                window_templates = {}
+                window_spike_trains = {}
+                for unit_id in sorting_window.get_unit_ids():
+                    spike_train = sorting_window.get_unit_spike_train(unit_id).astype(np.int64)
+                    if len(spike_train) == 0:
+                        continue
+                    window_templates[unit_id] = _compute_template(recording_window, spike_train, T1=context.snippet_T1, T2=context.snippet_T2)
+                    spike_train = spike_train + start_frame
+                    window_spike_trains[unit_id] = spike_train[(spike_train >= keep_start) & (spike_train < keep_end)]
+                links = _link_units(window_templates, templates, threshold=link_threshold)
+                num_linked = 0
+                for unit_id, template in window_templates.items():
+                    if unit_id in links:
+                        global_unit_id = links[unit_id]
+                        num_linked += 1
+                    else:
+                        global_unit_id = len(spike_trains) + 1
+                        spike_trains[global_unit_id] = []
+                    spike_trains[global_unit_id].append(window_spike_trains[unit_id])
+                    # the most recent template, so that slowly drifting units stay linked
+                    templates[global_unit_id] = template
+                print(f'Window {k + 1}: {len(window_templates)} units, {num_linked} linked to earlier windows, {len(spike_trains)} units so far')
+    shutil.rmtree(dirname)
+
+    units = {unit_id: np.sort(np.concatenate(v)).astype(np.int64) for unit_id, v in spike_trains.items()}
+    return _numpy_sorting_from_dict([units], sampling_frequency=sampling_frequency)
+
+def _get_windows(num_frames: int, *, window_num_frames: int, overlap_num_frames: int) -> List[Tuple[int, int]]:
+    if window_num_frames <= overlap_num_frames:
+        raise ValueError('The window duration must be greater than the overlap')
+    if window_num_frames >= num_frames:
+        return [(0, num_frames)]
+    step = window_num_frames - overlap_num_frames
+    windows = []
+    start_frame = 0
+    while True:
+        end_frame = start_frame + window_num_frames
+        if end_frame >= num_frames - overlap_num_frames:
+            # the last window extends to the end rather than leaving a short one
+            windows.append((start_frame, num_frames))
+            break
+        windows.append((start_frame, end_frame))
+        start_frame += step
+    return windows
+
+def _compute_template(recording: si.BaseRecording, spike_train: np.ndarray, *, T1: int, T2: int, max_num_spikes: int = 200) -> np.ndarray:
+    num_frames = recording.get_num_frames()
+    times = spike_train[(spike_train >= T1) & (spike_train < num_frames - T2)]
+    if len(times) > max_num_spikes:
+        times = times[np.linspace(0, len(times) - 1, max_num_spikes).astype(np.int64)]
+    template = np.zeros((T1 + T2, recording.get_num_channels()), dtype=np.float64)
+    for t in times:
+        template += recording.get_traces(start_frame=int(t) - T1, end_frame=int(t) + T2)
+    return template / max(len(times), 1)
+
+def _link_units(window_templates: Dict, templates: Dict[int, np.ndarray], *, threshold: float) -> Dict:
+    # greedy one-to-one matching of the most similar pairs
+    pairs = []
+    for unit_id, template in window_templates.items():
+        for global_unit_id, global_template in templates.items():
+            similarity = _cosine_similarity(template, global_template)
+            if similarity >= threshold:
+                pairs.append((similarity, unit_id, global_unit_id))
+    links = {}
+    linked_global_unit_ids = set()
+    for similarity, unit_id, global_unit_id in sorted(pairs, key=lambda p: -p[0]):
+        if unit_id in links or global_unit_id in linked_global_unit_ids:
+            continue
+        links[unit_id] = global_unit_id
+        linked_global_unit_ids.add(global_unit_id)
+    return links
+
+def _cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    norm = np.linalg.norm(a) * np.linalg.norm(b)
+    return float(np.sum(a * b) / norm) if norm > 0 else 0.0
+
+def _numpy_sorting_from_dict(units_dict_list, *, sampling_frequency):
+    try:
+        # different versions of spikeinterface
+        # see: https://github.com/SpikeInterface/spikeinterface/issues/2083
+        sorting = si.NumpySorting.from_dict(
+            units_dict_list, sampling_frequency=sampling_frequency # type: ignore
+        )
+    except: # noqa
+        sorting = si.NumpySorting.from_unit_dict(
+            units_dict_list, sampling_frequency=sampling_frequency # type: ignore
+        )
+    return sorting
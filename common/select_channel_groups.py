@@ -0,0 +1,20 @@
+from typing import List
+import spikeinterface as si
+
+
+def select_channel_groups(recording: si.BaseRecording, *, channel_groups: List[int]) -> si.BaseRecording:
+    """
+    Slice a recording (e.g., an NwbRecording, before anything is read) to the channels of
+    the given channel groups, so that only the bytes of those channels are read (and
+    downloaded) from the input file. An empty list means all the channel groups.
+    """
+    if len(channel_groups) == 0:
+        return recording
+    groups = recording.get_channel_groups()
+    unique_groups = sorted(list(set(groups)))
+    for group in channel_groups:
+        if group not in unique_groups:
+            raise Exception(f'Channel group {group} not found in the recording (channel groups: {unique_groups})')
+    channel_ids = [ch for ch, group in zip(recording.get_channel_ids(), groups) if group in channel_groups]
+    print(f'Selected channel groups {sorted(channel_groups)}: {len(channel_ids)} of {recording.get_num_channels()} channels')
+    return recording.channel_slice(channel_ids=channel_ids)
@@ -0,0 +1,214 @@
+import json
+from typing import Dict, List, Union
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DandiApiClient:
+    """
+    Minimal client for the DANDI REST API.
+
+    A single requests.Session is shared by all calls so that connections are kept alive
+    and reused, and transient failures (connection errors, 429 and 5xx responses) are
+    retried with exponential backoff. api_url is the base url of the API, for example
+    https://api.dandiarchive.org/api (it can point to a local server for testing).
+    """
+    def __init__(self, *, api_url: str, api_key: str, max_workers: int = 8, max_retries: int = 5, backoff_factor: float = 1):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self._api_url = api_url.rstrip('/')
+        self._max_workers = max_workers
+        self._session = requests.Session()
+        self._session.headers.update({'Authorization': f'token {api_key}'})
+        # an asset PUT is not retried: if the response is lost, a second PUT would act on the
+        # asset that the first one has already replaced (asset ids change with each update)
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['HEAD', 'GET', 'DELETE', 'OPTIONS'],
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        # the upload part urls are presigned, so they must not get the Authorization header;
+        # a part PUT writes the same bytes to the same part each time, so it is retried
+        storage_retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['HEAD', 'GET', 'PUT', 'DELETE', 'OPTIONS'],
+            raise_on_status=False
+        )
+        storage_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=storage_retry)
+        self._storage_session = requests.Session()
+        self._storage_session.mount('http://', storage_adapter)
+        self._storage_session.mount('https://', storage_adapter)
+
+    @staticmethod
+    def get_api_url_for_instance(dandi_instance: str):
+        if dandi_instance == 'dandi':
+            return 'https://api.dandiarchive.org/api'
+        elif dandi_instance == 'dandi-staging':
+            return 'https://api-staging.dandiarchive.org/api'
+        else:
+            raise Exception(f'Unexpected dandi_instance: {dandi_instance}')
+
+    def close(self):
+        self._session.close()
+        self._storage_session.close()
+
+    def get_assets_by_path(self, *, dandiset_id: str, version: str, paths: List[str]) -> Dict[str, dict]:
+        """
+        Look up the assets for the given paths with a single paginated listing of the
+        dandiset version (restricted to the common prefix of the paths). Returns a
+        dict from path to asset record; paths that are not in the dandiset are omitted.
+        """
+        wanted = set(paths)
+        # a single path (e.g., one asset that was just uploaded) is its own prefix
+        prefix = paths[0] if len(paths) == 1 else _common_directory(paths)
+        url: Union[str, None] = f'{self._assets_url(dandiset_id, version)}/'
+        params: Union[dict, None] = {'page_size': 1000, 'metadata': 'true'}
+        if prefix:
+            params['path'] = prefix
+        assets: Dict[str, dict] = {}
+        while url is not None:
+            res = self._session.get(url, params=params, timeout=120)
+            _check_response(res, 'Failed to list assets')
+            x = res.json()
+            for asset in x['results']:
+                if asset['path'] in wanted:
+                    if asset['path'] in assets:
+                        print(f'More than one asset found for {asset["path"]}')
+                        continue
+                    assets[asset['path']] = asset
+            # the next url already includes the query parameters
+            url = x.get('next', None)
+            params = None
+        return assets
+
+    def get_asset_etag(self, *, dandiset_id: str, version: str, asset: dict) -> Union[str, None]:
+        """
+        The DANDI etag of the blob of an asset record returned by get_assets_by_path
+        """
+        metadata = asset.get('metadata', None)
+        if metadata is None:
+            metadata = self.get_asset_metadata(dandiset_id=dandiset_id, version=version, asset_id=asset['asset_id'])
+            asset['metadata'] = metadata
+        return metadata.get('digest', {}).get('dandi:dandi-etag', None)
+
+    def get_asset_metadata(self, *, dandiset_id: str, version: str, asset_id: str) -> dict:
+        res = self._session.get(f'{self._assets_url(dandiset_id, version)}/{asset_id}/', timeout=120)
+        _check_response(res, 'Failed to get metadata for asset')
+        return res.json()
+
+    def put_asset_metadata(self, *, dandiset_id: str, version: str, asset_id: str, blob_id: str, metadata: dict) -> dict:
+        put_json = {
+            "blob_id": blob_id,
+            "metadata": metadata
+        }
+        res = self._session.put(f'{self._assets_url(dandiset_id, version)}/{asset_id}/', json=put_json, timeout=120)
+        _check_response(res, 'Failed to update metadata for asset')
+        return res.json()
+
+    def create_asset(self, *, dandiset_id: str, version: str, blob_id: str, metadata: dict) -> dict:
+        put_json = {
+            "blob_id": blob_id,
+            "metadata": metadata
+        }
+        res = self._session.post(f'{self._assets_url(dandiset_id, version)}/', json=put_json, timeout=120)
+        _check_response(res, 'Failed to create asset')
+        return res.json()
+
+    def initialize_upload(self, *, dandiset_id: str, size: int, etag: str) -> dict:
+        """
+        Start a multipart upload of a blob. Returns the upload (upload_id and the presigned
+        url of each part), or {'blob_id': ...} if a blob with this digest already exists.
+        """
+        post_json = {
+            "contentSize": size,
+            "digest": {"algorithm": "dandi:dandi-etag", "value": etag},
+            "dandiset": dandiset_id
+        }
+        res = self._session.post(f'{self._api_url}/uploads/initialize/', json=post_json, timeout=120)
+        if res.status_code == 409:
+            return {'blob_id': res.headers['Location']}
+        _check_response(res, 'Failed to initialize upload')
+        return res.json()
+
+    def upload_part(self, *, upload_url: str, data: bytes) -> str:
+        """Upload one part to its presigned url and return the etag reported by the storage"""
+        res = self._storage_session.put(upload_url, data=data, timeout=60 * 60)
+        _check_response(res, 'Failed to upload part')
+        return res.headers['ETag'].strip('"')
+
+    def complete_upload(self, *, upload_id: str, parts: List[dict]) -> str:
+        """Complete a multipart upload and return the id of the new blob"""
+        res = self._session.post(f'{self._api_url}/uploads/{upload_id}/complete/', json={'parts': parts}, timeout=120)
+        _check_response(res, 'Failed to complete upload')
+        x = res.json()
+        res = self._storage_session.post(x['complete_url'], data=x['body'], timeout=60 * 60)
+        _check_response(res, 'Failed to complete multipart upload in storage')
+        res = self._session.post(f'{self._api_url}/uploads/{upload_id}/validate/', timeout=60 * 60)
+        _check_response(res, 'Failed to validate upload')
+        return res.json()['blob_id']
+
+    def append_was_generated_by(self, *, dandiset_id: str, version: str, was_generated_by_jsons: Dict[str, str]) -> List[str]:
+        """
+        Append a wasGeneratedBy entry to the metadata of each of the given assets (a dict
+        from path to the JSON of the entry). The asset ids are resolved with one listing and
+        the metadata updates run concurrently. Returns the paths of the assets that have the
+        entry (those that were not found are left out).
+        """
+        paths = list(was_generated_by_jsons.keys())
+        assets = self.get_assets_by_path(dandiset_id=dandiset_id, version=version, paths=paths)
+        for path in paths:
+            if path not in assets:
+                print(f'Asset not found: {path}')
+
+        def update(path: str):
+            asset = assets[path]
+            metadata = asset.get('metadata', None)
+            if metadata is None:
+                metadata = self.get_asset_metadata(dandiset_id=dandiset_id, version=version, asset_id=asset['asset_id'])
+            x = json.loads(was_generated_by_jsons[path])
+            if x in metadata.get('wasGeneratedBy', []):
+                # already there (e.g., set by an earlier run of the same job)
+                return
+            metadata['wasGeneratedBy'] = metadata.get('wasGeneratedBy', []) + [x]
+            self.put_asset_metadata(
+                dandiset_id=dandiset_id,
+                version=version,
+                asset_id=asset['asset_id'],
+                blob_id=asset['blob'],
+                metadata=metadata
+            )
+
+        found_paths = [p for p in paths if p in assets]
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            # list() so that the first exception is raised here
+            list(executor.map(update, found_paths))
+        return found_paths
+
+    def _assets_url(self, dandiset_id: str, version: str):
+        return f'{self._api_url}/dandisets/{dandiset_id}/versions/{version}/assets'
+
+def _check_response(res, msg: str):
+    if res.status_code not in [200, 201]:
+        print(res.status_code)
+        print(res.text)
+        raise Exception(msg)
+
+def _common_directory(paths: List[str]):
+    dirs = [p.split('/')[:-1] for p in paths]
+    if len(dirs) == 0:
+        return ''
+    common = dirs[0]
+    for d in dirs[1:]:
+        n = 0
+        while n < len(common) and n < len(d) and common[n] == d[n]:
+            n += 1
+        common = common[:n]
+    return '/'.join(common) + '/' if common else ''
@@ -0,0 +1,50 @@
+import hashlib
+from typing import List
+
+
+class DandiEtagHasher:
+    """
+    Incremental computation of the DANDI etag (the S3 multipart digest: md5 of the
+    concatenated md5 digests of the parts, followed by -<number of parts>) of a file of
+    known size. Data can be fed in blocks of any size; the part boundaries are the same
+    as the ones used by the dandi client (dandischema PartGenerator).
+    """
+    def __init__(self, file_size: int):
+        from dandischema.digests.dandietag import PartGenerator
+
+        self._parts = list(PartGenerator.for_file_size(file_size))
+        self._file_size = file_size
+        self._num_bytes = 0
+        self._part_index = 0
+        self._part_num_bytes = 0
+        self._part_md5 = hashlib.md5()
+        self._part_digests: List[bytes] = []
+
+    @property
+    def part_sizes(self) -> List[int]:
+        return [p.size for p in self._parts]
+
+    def update(self, data: bytes):
+        if self._num_bytes + len(data) > self._file_size:
+            raise Exception(f'More data than the expected file size: {self._file_size}')
+        offset = 0
+        while offset < len(data):
+            part_size = self._parts[self._part_index].size
+            n = min(part_size - self._part_num_bytes, len(data) - offset)
+            self._part_md5.update(data[offset:offset + n])
+            self._part_num_bytes += n
+            offset += n
+            if self._part_num_bytes == part_size:
+                self._part_digests.append(self._part_md5.digest())
+                self._part_index += 1
+                self._part_num_bytes = 0
+                self._part_md5 = hashlib.md5()
+        self._num_bytes += len(data)
+
+    def get_part_md5_hex(self, part_index: int) -> str:
+        return self._part_digests[part_index].hex()
+
+    def get_etag(self) -> str:
+        if self._num_bytes != self._file_size:
+            raise Exception(f'Only {self._num_bytes} of {self._file_size} bytes have been hashed')
+        return hashlib.md5(b''.join(self._part_digests)).hexdigest() + f'-{len(self._part_digests)}'
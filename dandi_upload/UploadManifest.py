@@ -0,0 +1,47 @@
+import os
+import json
+import threading
+from typing import Union
+
+
+class UploadManifest:
+    """
+    Local JSON record of the files that a dandi_upload job has completed, so that a
+    restarted job only processes what is left. Entries are keyed by destination name and
+    store the input uri and the DANDI etag of the uploaded blob, plus whether the
+    wasGeneratedBy metadata was set. The file is rewritten atomically after each change.
+    """
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self._entries = json.load(f)
+
+    def get(self, *, name: str, input_uri: str) -> Union[dict, None]:
+        with self._lock:
+            entry = self._entries.get(name, None)
+            if entry is None or entry['input_uri'] != input_uri:
+                return None
+            return dict(entry)
+
+    def set_uploaded(self, *, name: str, input_uri: str, etag: str):
+        with self._lock:
+            self._entries[name] = {
+                'input_uri': input_uri,
+                'etag': etag,
+                'was_generated_by_set': False
+            }
+            self._write()
+
+    def set_was_generated_by_set(self, *, name: str):
+        with self._lock:
+            self._entries[name]['was_generated_by_set'] = True
+            self._write()
+
+    def _write(self):
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._entries, f, indent=2)
+        os.replace(tmp_path, self._path)
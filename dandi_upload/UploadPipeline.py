@@ -0,0 +1,110 @@
+import threading
+from typing import Callable, List, Union
+from concurrent.futures import ThreadPoolExecutor, Future
+
+
+class UploadPipeline:
+    """
+    Run download -> upload for a list of items with the two stages overlapped.
+
+    Item i is downloaded while earlier items are still uploading. At most
+    max_concurrent_transfers downloads and max_concurrent_transfers uploads run at
+    the same time, and an item is only started when its size fits in the scratch
+    budget (max_scratch_bytes; 0 means no limit). The space of an item is released
+    when its upload has finished (the upload callback is expected to remove the
+    local file). An item larger than the whole budget is still processed, but only
+    when nothing else is on disk.
+    """
+    def __init__(
+        self,
+        *,
+        download: Callable[[int], None],
+        upload: Callable[[int], None],
+        max_concurrent_transfers: int,
+        max_scratch_bytes: int
+    ):
+        if max_concurrent_transfers < 1:
+            raise ValueError('max_concurrent_transfers must be at least 1')
+        self._download = download
+        self._upload = upload
+        self._max_concurrent_transfers = max_concurrent_transfers
+        self._max_scratch_bytes = max_scratch_bytes
+        self._condition = threading.Condition()
+        self._scratch_bytes_in_use = 0
+        self._num_items_in_flight = 0
+        self._error: Union[BaseException, None] = None
+        self._cancelled = False
+
+    def run(self, item_sizes: List[int]):
+        # downloaded files waiting for an upload slot also take scratch space,
+        # so the number of items between "download started" and "upload finished" is bounded too
+        max_items_in_flight = 2 * self._max_concurrent_transfers
+        upload_futures: List[Future] = []
+        with ThreadPoolExecutor(max_workers=self._max_concurrent_transfers) as download_executor, \
+                ThreadPoolExecutor(max_workers=self._max_concurrent_transfers) as upload_executor:
+            try:
+                for i, size in enumerate(item_sizes):
+                    with self._condition:
+                        while self._error is None and not self._can_start(size, max_items_in_flight):
+                            self._condition.wait()
+                        if self._error is not None:
+                            break
+                        self._scratch_bytes_in_use += size
+                        self._num_items_in_flight += 1
+                    download_future = download_executor.submit(self._run_download, i)
+                    download_future.add_done_callback(
+                        lambda f, i=i, size=size: self._on_downloaded(f, i, size, upload_executor, upload_futures)
+                    )
+            except BaseException:
+                # skip the pending transfers if we are exiting because of an exception in this thread
+                with self._condition:
+                    self._cancelled = True
+                raise
+            download_executor.shutdown(wait=True)
+            for f in list(upload_futures):
+                f.exception() # wait for completion
+        if self._error is not None:
+            raise self._error
+
+    def _can_start(self, size: int, max_items_in_flight: int):
+        if self._num_items_in_flight >= max_items_in_flight:
+            return False
+        if self._max_scratch_bytes <= 0 or self._num_items_in_flight == 0:
+            return True
+        return self._scratch_bytes_in_use + size <= self._max_scratch_bytes
+
+    def _on_downloaded(self, future: Future, i: int, size: int, upload_executor: ThreadPoolExecutor, upload_futures: List[Future]):
+        with self._condition:
+            exc = future.exception()
+            if exc is not None or self._error is not None:
+                if exc is not None and self._error is None:
+                    self._error = exc
+                self._release(size)
+                return
+            upload_future = upload_executor.submit(self._run_upload, i)
+            upload_future.add_done_callback(lambda f: self._on_uploaded(f, size))
+            upload_futures.append(upload_future)
+
+    def _run_download(self, i: int):
+        with self._condition:
+            if self._error is not None or self._cancelled:
+                return
+        self._download(i)
+
+    def _run_upload(self, i: int):
+        with self._condition:
+            if self._error is not None or self._cancelled:
+                return
+        self._upload(i)
+
+    def _on_uploaded(self, future: Future, size: int):
+        with self._condition:
+            exc = future.exception()
+            if exc is not None and self._error is None:
+                self._error = exc
+            self._release(size)
+
+    def _release(self, size: int):
+        self._scratch_bytes_in_use -= size
+        self._num_items_in_flight -= 1
+        self._condition.notify_all()
@@ -0,0 +1,50 @@
+import os
+from dendro.sdk import InputFile
+from DandiEtagHasher import DandiEtagHasher
+
+
+def download_with_dandi_etag(inp: InputFile, dest_path: str) -> str:
+    """
+    Download an input file to dest_path and return its DANDI etag, computed on the fly
+    so that the file does not need to be read a second time.
+    """
+    import requests
+
+    block_size = 1024 * 1024
+    local_file_name = inp.local_file_name
+    if local_file_name is not None:
+        # the input is already local, so copy it
+        print(f'Copying {local_file_name} to {dest_path}')
+        hasher = DandiEtagHasher(os.path.getsize(local_file_name))
+        with open(local_file_name, 'rb') as fin, open(dest_path, 'wb') as fout:
+            while True:
+                data = fin.read(block_size)
+                if not data:
+                    break
+                hasher.update(data)
+                fout.write(data)
+        return hasher.get_etag()
+
+    url = inp.get_url()
+    print(f'Downloading {url} to {dest_path}')
+    with requests.get(url, stream=True, timeout=60 * 60 * 24 * 7) as r:
+        if r.status_code != 200:
+            raise Exception(f'Error downloading file {url}: {r.status_code} {r.reason}')
+        content_length = r.headers.get('Content-Length', None)
+        # the part sizes depend on the file size, so without a Content-Length we hash after downloading
+        hasher = DandiEtagHasher(int(content_length)) if content_length is not None else None
+        with open(dest_path, 'wb') as f:
+            for data in r.iter_content(chunk_size=block_size):
+                if data:
+                    if hasher is not None:
+                        hasher.update(data)
+                    f.write(data)
+    if hasher is None:
+        hasher = DandiEtagHasher(os.path.getsize(dest_path))
+        with open(dest_path, 'rb') as f:
+            while True:
+                data = f.read(block_size)
+                if not data:
+                    break
+                hasher.update(data)
+    return hasher.get_etag()
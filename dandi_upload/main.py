@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 
 import os
-from typing import List
-import json
+import time
+from typing import Dict, List, Tuple
+import shlex
 import shutil
 import subprocess
 from dendro.sdk import App, ProcessorBase, BaseModel, Field, InputFile
+from UploadPipeline import UploadPipeline
+from DandiApiClient import DandiApiClient
+from UploadManifest import UploadManifest
+from download_with_dandi_etag import download_with_dandi_etag
+from stream_input_to_dandi import compute_input_dandi_etag, stream_input_to_dandi
+from common.StageProfiler import StageProfiler
 
 
 app = App(
@@ -26,6 +33,10 @@ class DandiUploadContext(BaseModel):
     dandi_api_key: str = Field(description='DANDI API key', json_schema_extra={'secret': True})
     names: List[str] = Field(description='Destination names in the dandiset')
     was_generated_by_jsons: List[str] = Field(description='The JSON strings containing the wasGeneratedBy metadata for each input file')
+    max_concurrent_transfers: int = Field(default=2, description='Maximum number of concurrent downloads (and of concurrent uploads). Downloads of the next files overlap the uploads of the previous ones.')
+    max_scratch_space_gb: float = Field(default=0, description='Maximum total size of the downloaded files that are waiting to be uploaded (0 means no limit)')
+    streaming: bool = Field(default=False, description='Stream each input to the archive part by part instead of downloading it to local disk first. The input is read twice (once for the checksum, once for the upload) and the asset metadata is not extracted from the NWB file.')
+    manifest_path: str = Field(default='', description='Local JSON file recording which files have been uploaded, so that a restarted job only processes what is left. It must be on storage that outlives the container. Defaults to dandi_upload_manifest_<dandiset_id>.json in the directory given by the DANDI_UPLOAD_STATE_DIR environment variable (a volume in the image), or in the working directory if it is not set.')
 
 class DandiUploadProcessor(ProcessorBase):
     name = 'dandi_upload'
@@ -39,6 +50,8 @@ class DandiUploadProcessor(ProcessorBase):
 
         if len(context.inputs) != len(context.names):
             raise Exception('Number of inputs does not match number of names')
+        if len(context.inputs) != len(context.was_generated_by_jsons):
+            raise Exception('Number of inputs does not match number of was_generated_by_jsons')
         if len(context.inputs) == 0:
             raise Exception('No inputs')
         if not context.dandiset_id:
@@ -47,6 +60,8 @@ class DandiUploadProcessor(ProcessorBase):
             raise Exception('dandi_instance is required')
         if not context.dandi_api_key:
             raise Exception('dandi_api_key is required')
+        if context.max_concurrent_transfers < 1:
+            raise Exception('max_concurrent_transfers must be at least 1')
 
         if context.dandi_instance == 'dandi':
             dandi_archive_url = 'https://dandiarchive.org'
@@ -57,102 +72,203 @@ class DandiUploadProcessor(ProcessorBase):
 
         dandiset_version = 'draft' # always going to be draft for uploading
         workdir = context.dandiset_id
+        profiler = StageProfiler('dandi_upload')
 
         try:
-            cmd = f'dandi download --dandi-instance {context.dandi_instance} --download dandiset.yaml {dandi_archive_url}/dandiset/{context.dandiset_id}/{dandiset_version}'
-            print(f'Running command: {cmd}')
-            env = {**os.environ, 'DANDI_API_KEY': context.dandi_api_key}
-            result = subprocess.run(cmd, shell=True, env=env)
-            if result.returncode != 0:
-                raise Exception(f'Error running dandi download: {result.stderr}')
-
-            for ii, inp in enumerate(context.inputs):
-                name = context.names[ii]
-                _make_sure_path_is_relative_and_is_safe(name)
-                dest_path = os.path.join(workdir, name)
-                # just to be extra safe, make sure dest_path is truly a subpath of workdir
-                if not os.path.abspath(dest_path).startswith(os.path.abspath(workdir)):
-                    raise Exception(f'Unexpected error: dest_path is not a subpath of workdir: {dest_path}')
-                print(f'Downloading input file {ii + 1} of {len(context.inputs)} to {name}')
-                # make sure parent directories of dest_path exist
-                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-                inp.download(dest_path)
-
-                print('Uploading file to DANDI')
-                # skip validation for now, but we'll want to support this later
-                cmd = f'dandi upload --dandi-instance {context.dandi_instance} --validation skip'
-                print('Running command: ' + cmd)
-                result = subprocess.run(cmd, shell=True, env=env, cwd=workdir)
+            with profiler.stage('open'):
+                cmd = f'dandi download --dandi-instance {context.dandi_instance} --download dandiset.yaml {dandi_archive_url}/dandiset/{context.dandiset_id}/{dandiset_version}'
+                print(f'Running command: {cmd}')
+                env = {**os.environ, 'DANDI_API_KEY': context.dandi_api_key}
+                result = subprocess.run(cmd, shell=True, env=env)
                 if result.returncode != 0:
-                    raise Exception(f'Error running dandi upload: {result.stderr}')
-
-                # set the wasGeneratedBy metadata
-                _set_was_generated_by(
-                    file_path=name,
-                    was_generated_by_json=context.was_generated_by_jsons[ii],
-                    staging=context.dandi_instance == 'dandi-staging',
-                    dandiset_id=context.dandiset_id,
+                    raise Exception(f'Error running dandi download: {result.stderr}')
+
+            client = DandiApiClient(
+                api_url=DandiApiClient.get_api_url_for_instance(context.dandi_instance),
+                api_key=context.dandi_api_key
+            )
+            try:
+                _upload_inputs(
+                    context=context,
+                    client=client,
+                    workdir=workdir,
                     dandiset_version=dandiset_version,
-                    dandi_api_key=context.dandi_api_key
+                    env=env,
+                    profiler=profiler
                 )
-
-                # remove the file
-                os.remove(dest_path)
+            finally:
+                client.close()
         finally:
             shutil.rmtree(workdir)
 
-def _set_was_generated_by(
-    file_path: str,
-    was_generated_by_json: str,
-    staging: bool,
-    dandiset_id: str,
-    dandiset_version: str,
-    dandi_api_key: str
-):
+        profiler.print_summary()
+        if not os.path.exists('output'):
+            os.mkdir('output')
+        profiler.write_json('output/profile.json')
+
+def _upload_inputs(*, context: DandiUploadContext, client: DandiApiClient, workdir: str, dandiset_version: str, env: dict, profiler: StageProfiler):
+    manifest = UploadManifest(_get_manifest_path(context))
+    input_uris = [_get_input_uri(inp) for inp in context.inputs]
+
+    dest_paths: List[str] = []
+    for ii, inp in enumerate(context.inputs):
+        name = context.names[ii]
+        _make_sure_path_is_relative_and_is_safe(name)
+        dest_path = os.path.join(workdir, name)
+        # just to be extra safe, make sure dest_path is truly a subpath of workdir
+        if not os.path.abspath(dest_path).startswith(os.path.abspath(workdir)):
+            raise Exception(f'Unexpected error: dest_path is not a subpath of workdir: {dest_path}')
+        dest_paths.append(dest_path)
+
+    # the digests of the blobs that are already in the dandiset
+    with profiler.stage('lookup'):
+        existing_assets = client.get_assets_by_path(dandiset_id=context.dandiset_id, version=dandiset_version, paths=context.names)
+        existing_etags = {
+            name: client.get_asset_etag(dandiset_id=context.dandiset_id, version=dandiset_version, asset=asset)
+            for name, asset in existing_assets.items()
+        }
+
+    def set_was_generated_by(indices: List[int]):
+        was_generated_by_jsons_to_set = {context.names[ii]: context.was_generated_by_jsons[ii] for ii in indices}
+        print(f'Setting wasGeneratedBy metadata for {", ".join(was_generated_by_jsons_to_set.keys())}')
+        names_set = client.append_was_generated_by(
+            dandiset_id=context.dandiset_id,
+            version=dandiset_version,
+            was_generated_by_jsons=was_generated_by_jsons_to_set
+        )
+        # an asset that was not found is retried by the next run
+        for name in names_set:
+            manifest.set_was_generated_by_set(name=name)
+
+    # skip the files that a previous run of this job has already uploaded (as long as they are still in the dandiset)
+    to_upload: List[int] = []
+    # uploaded by a previous run that stopped before setting their wasGeneratedBy metadata, and then the files uploaded by this run
+    to_set_was_generated_by: List[int] = []
+    for ii, name in enumerate(context.names):
+        entry = manifest.get(name=name, input_uri=input_uris[ii])
+        if entry is not None and entry['etag'] == existing_etags.get(name, None):
+            print(f'Skipping {name}: already uploaded by a previous run')
+            if not entry['was_generated_by_set']:
+                to_set_was_generated_by.append(ii)
+        else:
+            to_upload.append(ii)
+
+    etags: Dict[int, str] = {}
+    # streaming mode: size and md5 of each part, from the first pass over the input
+    stream_infos: Dict[int, Tuple[int, List[str]]] = {}
+    # the downloads and uploads of different files overlap, so they are timed per file
+    # (in the report metadata) rather than as stages
+    transfers: Dict[str, dict] = {}
+
+    def download(jj: int):
+        ii = to_upload[jj]
+        inp = context.inputs[ii]
+        name = context.names[ii]
+        t0 = time.time()
+        if context.streaming:
+            print(f'Computing checksum of input file {ii + 1} of {len(context.inputs)} ({name})')
+            size, etags[ii], part_md5s = compute_input_dandi_etag(inp)
+            stream_infos[ii] = (size, part_md5s)
+        else:
+            dest_path = dest_paths[ii]
+            print(f'Downloading input file {ii + 1} of {len(context.inputs)} to {name}')
+            # make sure parent directories of dest_path exist
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            etags[ii] = download_with_dandi_etag(inp, dest_path)
+            size = os.path.getsize(dest_path)
+        transfers[name] = {'bytes': size, 'download_sec': time.time() - t0}
+
+    def upload(jj: int):
+        ii = to_upload[jj]
+        name = context.names[ii]
+        t0 = time.time()
+        transfers[name]['skipped'] = etags[ii] == existing_etags.get(name, None)
+        if etags[ii] == existing_etags.get(name, None):
+            print(f'Skipping upload of {name}: identical file is already in the dandiset')
+        elif context.streaming:
+            print(f'Streaming file {ii + 1} of {len(context.inputs)} to DANDI: {name}')
+            size, part_md5s = stream_infos[ii]
+            stream_input_to_dandi(
+                inp=context.inputs[ii],
+                size=size,
+                etag=etags[ii],
+                part_md5s=part_md5s,
+                client=client,
+                dandiset_id=context.dandiset_id,
+                version=dandiset_version,
+                name=name,
+                existing_asset=existing_assets.get(name, None)
+            )
+        else:
+            print(f'Uploading file {ii + 1} of {len(context.inputs)} to DANDI: {name}')
+            # only upload this file (other files in the workdir may still be downloading)
+            # skip validation for now, but we'll want to support this later
+            cmd = f'dandi upload --dandi-instance {context.dandi_instance} --validation skip {shlex.quote(name)}'
+            print('Running command: ' + cmd)
+            result = subprocess.run(cmd, shell=True, env=env, cwd=workdir)
+            if result.returncode != 0:
+                raise Exception(f'Error running dandi upload: {result.stderr}')
+        manifest.set_uploaded(name=name, input_uri=input_uris[ii], etag=etags[ii])
+        transfers[name]['upload_sec'] = time.time() - t0
+        to_set_was_generated_by.append(ii)
+
+        # remove the file
+        if not context.streaming:
+            os.remove(dest_paths[ii])
+
+    pipeline = UploadPipeline(
+        download=download,
+        upload=upload,
+        max_concurrent_transfers=context.max_concurrent_transfers,
+        # nothing is staged on disk in streaming mode
+        max_scratch_bytes=int(context.max_scratch_space_gb * 1e9) if not context.streaming else 0
+    )
+    try:
+        with profiler.stage('transfer'):
+            pipeline.run([_get_input_size(context.inputs[ii]) if not context.streaming else 0 for ii in to_upload])
+    finally:
+        profiler.record_metadata('transfers', transfers)
+        profiler.record_metadata('num_skipped_by_manifest', len(context.inputs) - len(to_upload))
+        # one listing and concurrent updates for all of the completed assets (also when another file failed);
+        # the manifest records which ones are done, so an interrupted job sets the rest when it is resumed
+        if len(to_set_was_generated_by) > 0:
+            with profiler.stage('was_generated_by'):
+                set_was_generated_by(sorted(to_set_was_generated_by))
+
+def _get_manifest_path(context: DandiUploadContext) -> str:
+    if context.manifest_path:
+        path = context.manifest_path
+    else:
+        state_dir = os.environ.get('DANDI_UPLOAD_STATE_DIR', '')
+        if not state_dir:
+            print('Warning: DANDI_UPLOAD_STATE_DIR is not set, so the upload manifest is written to the working directory and will not survive a restart of the container')
+            state_dir = '.'
+        path = os.path.join(state_dir, f'dandi_upload_manifest_{context.dandiset_id}.json')
+    parent_dir = os.path.dirname(path)
+    if parent_dir:
+        os.makedirs(parent_dir, exist_ok=True)
+    print(f'Using upload manifest {path}')
+    return path
+
+def _get_input_uri(inp: InputFile) -> str:
+    # identifies the input in the manifest across runs: the signature of a download url
+    # changes with each request, so only the url without its query is kept
+    if inp.local_file_name is not None:
+        return 'file://' + os.path.abspath(inp.local_file_name)
+    return inp.get_url().split('?')[0]
+
+def _get_input_size(inp: InputFile) -> int:
+    # used for the scratch space budget; 0 if the size cannot be determined
+    if inp.local_file_name is not None:
+        return os.path.getsize(inp.local_file_name)
     import requests
-    headers = {
-        'Authorization': f'token {dandi_api_key}'
-    }
-    assets_base_url = f'https://api{"-staging" if staging else ""}.dandiarchive.org/api/dandisets/{dandiset_id}/versions/{dandiset_version}/assets'
-    assets_url = f'{assets_base_url}/?path={file_path}'
-
-    # Get the asset from the dandi api
-    res = requests.get(assets_url, headers=headers)
-    if res.status_code != 200:
-        print(res.status_code)
-        print(res.json())
-        raise Exception('Failed to get assets')
-    assets = res.json()['results']
-    if len(assets) == 0:
-        print('Asset not found')
-        return
-    if len(assets) > 1:
-        print('More than one asset found')
-    asset = assets[0]
-
-    # Get the asset metadata from the dandi api
-    asset_url = f'{assets_base_url}/{asset["asset_id"]}/'
-    res = requests.get(asset_url, headers=headers)
-    if res.status_code != 200:
-        print(res.status_code)
-        print(res.json())
-        raise Exception('Failed to get metadata for asset')
-    metadata = res.json()
-
-    # Add the wasGeneratedBy metadata
-    x = metadata['wasGeneratedBy']
-    x.append(json.loads(was_generated_by_json))
-
-    # Replace the asset with a new asset with the updated metadata
-    put_json = {
-        "blob_id": asset["blob"],
-        "metadata": metadata
-    }
-    res = requests.put(asset_url, headers=headers, json=put_json)
+    try:
+        res = requests.head(inp.get_url(), allow_redirects=True, timeout=60)
+    except requests.RequestException:
+        return 0
     if res.status_code != 200:
-        print(res.status_code)
-        print(res.json())
-        raise Exception('Failed to update metadata for asset')
+        return 0
+    return int(res.headers.get('Content-Length', 0))
 
 def _make_sure_path_is_relative_and_is_safe(path):
     if path.startswith('/'):
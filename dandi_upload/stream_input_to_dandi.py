@@ -0,0 +1,140 @@
+import os
+import hashlib
+from typing import List, Tuple, Union
+from dendro.sdk import InputFile
+from DandiApiClient import DandiApiClient
+from DandiEtagHasher import DandiEtagHasher
+
+
+# asset metadata fields that the archive fills in from the blob
+_blob_metadata_keys = ['id', 'identifier', 'digest', 'contentSize', 'contentUrl', 'dateModified', 'blobDateModified']
+
+def compute_input_dandi_etag(inp: InputFile) -> Tuple[int, str, List[str]]:
+    """
+    First pass of a streamed upload: read the input once, without writing it to disk, and
+    return its size, its DANDI etag and the md5 of each part. The archive needs the digest
+    before the upload starts, which is why the input is read twice.
+    """
+    block_size = 1024 * 1024
+    local_file_name = inp.local_file_name
+    if local_file_name is not None:
+        size = os.path.getsize(local_file_name)
+        hasher = DandiEtagHasher(size)
+        with open(local_file_name, 'rb') as f:
+            while True:
+                data = f.read(block_size)
+                if not data:
+                    break
+                hasher.update(data)
+    else:
+        import requests
+        url = inp.get_url()
+        with requests.get(url, stream=True, timeout=60 * 60 * 24 * 7) as r:
+            if r.status_code != 200:
+                raise Exception(f'Error reading file {url}: {r.status_code} {r.reason}')
+            content_length = r.headers.get('Content-Length', None)
+            if content_length is None:
+                raise Exception(f'Streaming mode requires the size of the input, but there is no Content-Length for {url}')
+            size = int(content_length)
+            hasher = DandiEtagHasher(size)
+            for data in r.iter_content(chunk_size=block_size):
+                if data:
+                    hasher.update(data)
+    etag = hasher.get_etag()
+    return size, etag, [hasher.get_part_md5_hex(i) for i in range(len(hasher.part_sizes))]
+
+def stream_input_to_dandi(
+    *,
+    inp: InputFile,
+    size: int,
+    etag: str,
+    part_md5s: List[str],
+    client: DandiApiClient,
+    dandiset_id: str,
+    version: str,
+    name: str,
+    existing_asset: Union[dict, None]
+):
+    """
+    Second pass of a streamed upload: read the input part by part (range requests for a
+    remote input) and upload each part as soon as it has been read, so that at most one
+    part is held in memory and nothing is written to disk. Then create the asset at name,
+    or point the existing asset to the new blob.
+    """
+    upload = client.initialize_upload(dandiset_id=dandiset_id, size=size, etag=etag)
+    if 'upload_id' in upload:
+        reader = _InputPartReader(inp)
+        try:
+            completed_parts = []
+            offset = 0
+            for part in upload['parts']:
+                part_number = part['part_number']
+                part_size = part['size']
+                print(f'Uploading part {part_number} of {len(upload["parts"])} of {name}')
+                data = reader.read(offset, part_size)
+                # make sure the input did not change since the etag was computed
+                if hashlib.md5(data).hexdigest() != part_md5s[part_number - 1]:
+                    raise Exception(f'Part {part_number} of {name} changed since its digest was computed')
+                part_etag = client.upload_part(upload_url=part['upload_url'], data=data)
+                completed_parts.append({'part_number': part_number, 'size': part_size, 'etag': part_etag})
+                offset += part_size
+        finally:
+            reader.close()
+        if offset != size:
+            raise Exception(f'Unexpected: the upload parts of {name} cover {offset} of {size} bytes')
+        blob_id = client.complete_upload(upload_id=upload['upload_id'], parts=completed_parts)
+    else:
+        print(f'Blob of {name} is already in the archive')
+        blob_id = upload['blob_id']
+
+    if existing_asset is not None:
+        metadata = existing_asset.get('metadata', None)
+        if metadata is None:
+            metadata = client.get_asset_metadata(dandiset_id=dandiset_id, version=version, asset_id=existing_asset['asset_id'])
+        metadata = {k: v for k, v in metadata.items() if k not in _blob_metadata_keys}
+        client.put_asset_metadata(dandiset_id=dandiset_id, version=version, asset_id=existing_asset['asset_id'], blob_id=blob_id, metadata=metadata)
+    else:
+        # the NWB file is never on local disk, so the metadata is not extracted from it as dandi upload would do
+        metadata = {
+            'schemaKey': 'Asset',
+            'path': name,
+            'encodingFormat': 'application/x-nwb' if name.endswith('.nwb') else 'application/octet-stream'
+        }
+        client.create_asset(dandiset_id=dandiset_id, version=version, blob_id=blob_id, metadata=metadata)
+
+class _InputPartReader:
+    def __init__(self, inp: InputFile):
+        self._local_file = None
+        self._session = None
+        local_file_name = inp.local_file_name
+        if local_file_name is not None:
+            self._local_file = open(local_file_name, 'rb')
+        else:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            self._inp = inp
+            self._session = requests.Session()
+            retry = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+            self._session.mount('http://', HTTPAdapter(max_retries=retry))
+            self._session.mount('https://', HTTPAdapter(max_retries=retry))
+
+    def read(self, offset: int, size: int) -> bytes:
+        if self._local_file is not None:
+            self._local_file.seek(offset)
+            return self._local_file.read(size)
+        assert self._session is not None
+        # get the url each time because it may be renewed
+        url = self._inp.get_url()
+        res = self._session.get(url, headers={'Range': f'bytes={offset}-{offset + size - 1}'}, timeout=60 * 60)
+        if res.status_code != 206:
+            raise Exception(f'Error reading bytes {offset}-{offset + size - 1} of {url}: {res.status_code} {res.reason}')
+        if len(res.content) != size:
+            raise Exception(f'Unexpected number of bytes in range request for {url}: {len(res.content)} != {size}')
+        return res.content
+
+    def close(self):
+        if self._local_file is not None:
+            self._local_file.close()
+        if self._session is not None:
+            self._session.close()
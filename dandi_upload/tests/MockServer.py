@@ -0,0 +1,86 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse
+
+
+class MockServer:
+    """
+    Local http server for the tests, standing in for the archive, its storage and the
+    servers of the input files. Each (method, path) has a list of responses (status,
+    headers, body) that are returned in order, the last one repeating. Files added with
+    add_file are served for GET (with Range requests) and HEAD. All requests are recorded.
+    """
+    def __init__(self):
+        self.responses = {}
+        self.files: Dict[str, bytes] = {}
+        self.requests: List[dict] = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                parsed = urlparse(self.path)
+                with server._lock:
+                    server.requests.append({
+                        'method': self.command,
+                        'path': parsed.path,
+                        'query': parsed.query,
+                        'headers': dict(self.headers),
+                        'body': body
+                    })
+                    if self.command in ['GET', 'HEAD'] and parsed.path in server.files:
+                        status, headers, data = _file_response(server.files[parsed.path], self.headers.get('Range', None))
+                    else:
+                        responses = server.responses.get((self.command, parsed.path), None)
+                        if responses is None:
+                            status, headers, data = 404, {}, {'detail': 'not found'}
+                        else:
+                            status, headers, data = responses[0] if len(responses) == 1 else responses.pop(0)
+                if callable(data):
+                    data = data(parsed.query)
+                out = json.dumps(data).encode('utf-8') if not isinstance(data, bytes) else data
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                if 'Content-Length' not in headers:
+                    self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(out)
+
+            do_GET = _handle
+            do_HEAD = _handle
+            do_PUT = _handle
+            do_POST = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self._httpd.server_address[1]}'
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def add(self, method: str, path: str, *responses: Tuple[int, dict, object]):
+        self.responses[(method, path)] = list(responses)
+
+    def add_file(self, path: str, data: bytes):
+        self.files[path] = data
+
+    def get_requests(self, method: str, path: str) -> List[dict]:
+        return [r for r in self.requests if r['method'] == method and r['path'] == path]
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+def _file_response(data: bytes, range_header):
+    if range_header is None:
+        return 200, {'Content-Length': str(len(data))}, data
+    # only the bytes=<start>-<end> form used by the uploader
+    start, end = [int(x) for x in range_header[len('bytes='):].split('-')]
+    part = data[start:end + 1]
+    return 206, {'Content-Range': f'bytes {start}-{start + len(part) - 1}/{len(data)}'}, part
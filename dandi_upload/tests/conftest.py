@@ -0,0 +1,22 @@
+import os
+import sys
+import pytest
+
+# the modules of the app are imported from the app directory, as in the container
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from MockServer import MockServer # noqa: E402
+from DandiApiClient import DandiApiClient # noqa: E402
+
+
+@pytest.fixture
+def server():
+    s = MockServer()
+    yield s
+    s.close()
+
+@pytest.fixture
+def client(server: MockServer):
+    c = DandiApiClient(api_url=f'{server.url}/api', api_key='test-key', max_retries=3, backoff_factor=0)
+    yield c
+    c.close()
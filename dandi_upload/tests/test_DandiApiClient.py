@@ -0,0 +1,116 @@
+import json
+import pytest
+from DandiApiClient import DandiApiClient
+from MockServer import MockServer
+
+
+_assets_path = '/api/dandisets/000001/versions/draft/assets/'
+
+def _asset(path: str, asset_id: str, etag: str = 'abc-1'):
+    return {
+        'asset_id': asset_id,
+        'path': path,
+        'blob': f'blob-{asset_id}',
+        'metadata': {'path': path, 'digest': {'dandi:dandi-etag': etag}}
+    }
+
+def test_get_is_retried(server: MockServer, client: DandiApiClient):
+    server.add('GET', '/api/dandisets/000001/versions/draft/assets/a1/',
+        (503, {}, {'detail': 'unavailable'}),
+        (503, {}, {'detail': 'unavailable'}),
+        (200, {}, {'path': 'sub-1/a.nwb'})
+    )
+    metadata = client.get_asset_metadata(dandiset_id='000001', version='draft', asset_id='a1')
+    assert metadata == {'path': 'sub-1/a.nwb'}
+    requests = server.get_requests('GET', '/api/dandisets/000001/versions/draft/assets/a1/')
+    assert len(requests) == 3
+    assert all(r['headers']['Authorization'] == 'token test-key' for r in requests)
+
+def test_asset_put_is_not_retried(server: MockServer, client: DandiApiClient):
+    server.add('PUT', '/api/dandisets/000001/versions/draft/assets/a1/',
+        (503, {}, {'detail': 'unavailable'}),
+        (200, {}, {'asset_id': 'a2'})
+    )
+    with pytest.raises(Exception, match='Failed to update metadata for asset'):
+        client.put_asset_metadata(dandiset_id='000001', version='draft', asset_id='a1', blob_id='b1', metadata={})
+    assert len(server.get_requests('PUT', '/api/dandisets/000001/versions/draft/assets/a1/')) == 1
+
+def test_get_assets_by_path_follows_pagination(server: MockServer, client: DandiApiClient):
+    def page(query: str):
+        if 'page=2' in query:
+            return {'next': None, 'results': [_asset('sub-1/b.nwb', 'a2'), _asset('sub-1/other.nwb', 'a3')]}
+        return {'next': f'{server.url}{_assets_path}?page=2&page_size=1000&metadata=true&path=sub-1/', 'results': [_asset('sub-1/a.nwb', 'a1')]}
+    server.add('GET', _assets_path, (200, {}, page))
+    assets = client.get_assets_by_path(dandiset_id='000001', version='draft', paths=['sub-1/a.nwb', 'sub-1/b.nwb', 'sub-1/c.nwb'])
+    assert sorted(assets.keys()) == ['sub-1/a.nwb', 'sub-1/b.nwb']
+    assert assets['sub-1/b.nwb']['asset_id'] == 'a2'
+    requests = server.get_requests('GET', _assets_path)
+    assert len(requests) == 2
+    # the listing is restricted to the common directory of the paths
+    assert 'path=sub-1%2F' in requests[0]['query']
+
+def test_get_assets_by_path_single_path_prefix(server: MockServer, client: DandiApiClient):
+    server.add('GET', _assets_path, (200, {}, {'next': None, 'results': [_asset('sub-1/a.nwb', 'a1')]}))
+    assets = client.get_assets_by_path(dandiset_id='000001', version='draft', paths=['sub-1/a.nwb'])
+    assert list(assets.keys()) == ['sub-1/a.nwb']
+    assert 'path=sub-1%2Fa.nwb' in server.get_requests('GET', _assets_path)[0]['query']
+
+def test_multipart_upload(server: MockServer, client: DandiApiClient):
+    server.add('POST', '/api/uploads/initialize/', (200, {}, {
+        'upload_id': 'u1',
+        'parts': [
+            {'part_number': 1, 'size': 4, 'upload_url': f'{server.url}/storage/u1/1?signature=x'},
+            {'part_number': 2, 'size': 2, 'upload_url': f'{server.url}/storage/u1/2?signature=x'}
+        ]
+    }))
+    server.add('PUT', '/storage/u1/1', (200, {'ETag': '"etag-1"'}, b''))
+    # a part PUT is retried (it writes the same bytes to the same part)
+    server.add('PUT', '/storage/u1/2', (503, {}, b''), (200, {'ETag': '"etag-2"'}, b''))
+    server.add('POST', '/api/uploads/u1/complete/', (200, {}, {'complete_url': f'{server.url}/storage/u1/complete?signature=x', 'body': '<CompleteMultipartUpload/>'}))
+    server.add('POST', '/storage/u1/complete', (200, {}, b''))
+    server.add('POST', '/api/uploads/u1/validate/', (200, {}, {'blob_id': 'b1'}))
+
+    upload = client.initialize_upload(dandiset_id='000001', size=6, etag='abc-2')
+    assert json.loads(server.get_requests('POST', '/api/uploads/initialize/')[0]['body']) == {
+        'contentSize': 6,
+        'digest': {'algorithm': 'dandi:dandi-etag', 'value': 'abc-2'},
+        'dandiset': '000001'
+    }
+    data = b'abcdef'
+    parts = []
+    offset = 0
+    for part in upload['parts']:
+        part_etag = client.upload_part(upload_url=part['upload_url'], data=data[offset:offset + part['size']])
+        parts.append({'part_number': part['part_number'], 'size': part['size'], 'etag': part_etag})
+        offset += part['size']
+    assert [p['etag'] for p in parts] == ['etag-1', 'etag-2']
+    assert client.complete_upload(upload_id='u1', parts=parts) == 'b1'
+
+    assert [r['body'] for r in server.get_requests('PUT', '/storage/u1/1')] == [b'abcd']
+    assert [r['body'] for r in server.get_requests('PUT', '/storage/u1/2')] == [b'ef', b'ef']
+    assert json.loads(server.get_requests('POST', '/api/uploads/u1/complete/')[0]['body']) == {'parts': parts}
+    assert server.get_requests('POST', '/storage/u1/complete')[0]['body'] == b'<CompleteMultipartUpload/>'
+    # the presigned storage urls must not get the api key
+    for r in server.requests:
+        if r['path'].startswith('/storage/'):
+            assert 'Authorization' not in r['headers']
+        else:
+            assert r['headers']['Authorization'] == 'token test-key'
+
+def test_initialize_upload_existing_blob(server: MockServer, client: DandiApiClient):
+    server.add('POST', '/api/uploads/initialize/', (409, {'Location': 'b0'}, {'detail': 'blob exists'}))
+    assert client.initialize_upload(dandiset_id='000001', size=6, etag='abc-2') == {'blob_id': 'b0'}
+
+def test_append_was_generated_by(server: MockServer, client: DandiApiClient):
+    server.add('GET', _assets_path, (200, {}, {'next': None, 'results': [_asset('sub-1/a.nwb', 'a1')]}))
+    server.add('PUT', '/api/dandisets/000001/versions/draft/assets/a1/', (200, {}, {'asset_id': 'a2'}))
+    found_paths = client.append_was_generated_by(dandiset_id='000001', version='draft', was_generated_by_jsons={
+        'sub-1/a.nwb': json.dumps({'name': 'job-1'}),
+        'sub-1/missing.nwb': json.dumps({'name': 'job-1'})
+    })
+    assert found_paths == ['sub-1/a.nwb']
+    requests = server.get_requests('PUT', '/api/dandisets/000001/versions/draft/assets/a1/')
+    assert len(requests) == 1
+    x = json.loads(requests[0]['body'])
+    assert x['blob_id'] == 'blob-a1'
+    assert x['metadata']['wasGeneratedBy'] == [{'name': 'job-1'}]
@@ -0,0 +1,154 @@
+import os
+import json
+import shlex
+import time
+import threading
+from typing import List
+import pytest
+from UploadPipeline import UploadPipeline
+from MockServer import MockServer
+
+
+class _Transfers:
+    """Records what the download and upload callbacks of a pipeline are doing"""
+    def __init__(self, item_sizes: List[int], *, sleep_sec: float = 0.02):
+        self.item_sizes = item_sizes
+        self.sleep_sec = sleep_sec
+        self._lock = threading.Lock()
+        self.num_downloading = 0
+        self.num_uploading = 0
+        self.max_downloading = 0
+        self.max_uploading = 0
+        self.overlapped = False
+        # the items between the start of their download and the end of their upload
+        self.on_disk = set()
+        self.on_disk_snapshots = []
+        self.uploaded = []
+
+    def download(self, i: int):
+        with self._lock:
+            self.num_downloading += 1
+            self.max_downloading = max(self.max_downloading, self.num_downloading)
+            self.overlapped = self.overlapped or self.num_uploading > 0
+            self.on_disk.add(i)
+            self.on_disk_snapshots.append(set(self.on_disk))
+        time.sleep(self.sleep_sec)
+        with self._lock:
+            self.num_downloading -= 1
+
+    def upload(self, i: int):
+        with self._lock:
+            self.num_uploading += 1
+            self.max_uploading = max(self.max_uploading, self.num_uploading)
+            self.overlapped = self.overlapped or self.num_downloading > 0
+        time.sleep(self.sleep_sec)
+        with self._lock:
+            self.num_uploading -= 1
+            self.on_disk.remove(i)
+            self.uploaded.append(i)
+
+def test_concurrency_is_bounded():
+    t = _Transfers([0] * 8)
+    UploadPipeline(download=t.download, upload=t.upload, max_concurrent_transfers=2, max_scratch_bytes=0).run(t.item_sizes)
+    assert sorted(t.uploaded) == list(range(8))
+    assert t.max_downloading == 2
+    assert t.max_uploading <= 2
+    # downloads of the next items overlap the uploads of the previous ones
+    assert t.overlapped
+    # downloaded items waiting for an upload slot are bounded too
+    assert max(len(s) for s in t.on_disk_snapshots) <= 4
+
+def test_scratch_cap():
+    item_sizes = [40, 40, 40, 150, 10, 60]
+    t = _Transfers(item_sizes)
+    UploadPipeline(download=t.download, upload=t.upload, max_concurrent_transfers=2, max_scratch_bytes=100).run(item_sizes)
+    assert sorted(t.uploaded) == list(range(len(item_sizes)))
+    for s in t.on_disk_snapshots:
+        if 3 in s:
+            # larger than the whole budget, so only processed alone
+            assert s == {3}
+        else:
+            assert sum(item_sizes[i] for i in s) <= 100
+
+def test_error_is_raised():
+    t = _Transfers([0] * 6)
+
+    def upload(i: int):
+        if i == 1:
+            raise Exception('upload failed')
+        t.upload(i)
+    with pytest.raises(Exception, match='upload failed'):
+        UploadPipeline(download=t.download, upload=upload, max_concurrent_transfers=1, max_scratch_bytes=0).run(t.item_sizes)
+    # the pending transfers are skipped
+    assert len(t.uploaded) < 5
+
+def test_upload_inputs_uploads_only_its_own_path(server: MockServer, tmp_path, monkeypatch):
+    from dendro.sdk import InputFile
+    from DandiApiClient import DandiApiClient
+    from common.StageProfiler import StageProfiler
+    import main
+
+    names = ['sub-1/a.nwb', 'sub-1/b.nwb', 'sub-2/c.nwb', 'sub-2/d.nwb']
+    for ii, name in enumerate(names):
+        server.add_file(f'/files/{ii}.nwb', bytes([ii]) * (1000 + ii))
+    assets_path = '/api/dandisets/000001/versions/draft/assets/'
+    # all of the assets exist with another blob, so each input is uploaded
+    server.add('GET', assets_path, (200, {}, {'next': None, 'results': [
+        {'asset_id': f'a{ii}', 'path': name, 'blob': f'blob-{ii}', 'metadata': {'path': name, 'digest': {'dandi:dandi-etag': 'old-1'}}}
+        for ii, name in enumerate(names)
+    ]}))
+    for ii in range(len(names)):
+        server.add('PUT', f'{assets_path}a{ii}/', (200, {}, {'asset_id': f'a{ii}'}))
+
+    workdir = str(tmp_path / '000001')
+    os.makedirs(workdir)
+    uploads = []
+
+    def run(cmd, shell, env, cwd):
+        # stands in for the dandi cli
+        assert cmd.startswith('dandi upload')
+        name = shlex.split(cmd)[-1]
+        with open(os.path.join(cwd, name), 'rb') as f:
+            data = f.read()
+        uploads.append({'cwd': cwd, 'name': name, 'num_bytes': len(data)})
+
+        class Result:
+            returncode = 0
+            stderr = None
+        return Result()
+    monkeypatch.setattr(main.subprocess, 'run', run)
+
+    context = main.DandiUploadContext(
+        inputs=[InputFile(url=f'{server.url}/files/{ii}.nwb') for ii in range(len(names))],
+        dandiset_id='000001',
+        dandi_api_key='test-key',
+        names=names,
+        was_generated_by_jsons=[json.dumps({'name': f'job-{ii}'}) for ii in range(len(names))],
+        max_concurrent_transfers=2,
+        max_scratch_space_gb=2500 / 1e9,
+        manifest_path=str(tmp_path / 'manifest.json')
+    )
+    client = DandiApiClient(api_url=f'{server.url}/api', api_key='test-key', backoff_factor=0)
+    try:
+        main._upload_inputs(context=context, client=client, workdir=workdir, dandiset_version='draft', env={}, profiler=StageProfiler('test'))
+    finally:
+        client.close()
+
+    # each upload names only its own file, in the dandiset directory
+    assert sorted(u['name'] for u in uploads) == names
+    assert all(u['cwd'] == workdir for u in uploads)
+    assert {u['name']: u['num_bytes'] for u in uploads} == {name: 1000 + ii for ii, name in enumerate(names)}
+    # the sizes for the scratch budget come from HEAD requests
+    assert len([r for r in server.requests if r['method'] == 'HEAD']) == len(names)
+    # the downloaded files are removed once uploaded
+    assert [f for _, _, fnames in os.walk(workdir) for f in fnames] == []
+    with open(tmp_path / 'manifest.json', 'r') as f:
+        manifest = json.load(f)
+    assert sorted(manifest.keys()) == names
+    assert all(entry['was_generated_by_set'] for entry in manifest.values())
+    # one listing to look up the existing assets, and one for all of the wasGeneratedBy updates
+    assert len(server.get_requests('GET', assets_path)) == 2
+    for ii in range(len(names)):
+        requests = server.get_requests('PUT', f'{assets_path}a{ii}/')
+        assert len(requests) == 1
+        assert json.loads(requests[0]['body'])['metadata']['wasGeneratedBy'] == [{'name': f'job-{ii}'}]
@@ -0,0 +1,132 @@
+import json
+import hashlib
+import pytest
+from dendro.sdk import InputFile
+from DandiApiClient import DandiApiClient
+from MockServer import MockServer
+from stream_input_to_dandi import compute_input_dandi_etag, stream_input_to_dandi
+
+
+_assets_path = '/api/dandisets/000001/versions/draft/assets/'
+
+@pytest.fixture(autouse=True)
+def small_parts(monkeypatch):
+    # parts of 1000 bytes instead of 64 MB, so that small inputs have several parts
+    from dandischema.digests.dandietag import PartGenerator
+    monkeypatch.setattr(PartGenerator, 'DEFAULT_PART_SIZE', 1000)
+    monkeypatch.setattr(PartGenerator, 'MIN_PART_SIZE', 1)
+
+def _make_data(size: int) -> bytes:
+    return bytes((i * 7) % 251 for i in range(size))
+
+def _expected_etag(data: bytes, part_size: int) -> str:
+    part_digests = [hashlib.md5(data[i:i + part_size]).digest() for i in range(0, len(data), part_size)]
+    return hashlib.md5(b''.join(part_digests)).hexdigest() + f'-{len(part_digests)}'
+
+def _add_upload(server: MockServer, data: bytes, part_size: int):
+    parts = [
+        {'part_number': j + 1, 'size': len(data[i:i + part_size]), 'upload_url': f'{server.url}/storage/u1/{j + 1}?signature=x'}
+        for j, i in enumerate(range(0, len(data), part_size))
+    ]
+    server.add('POST', '/api/uploads/initialize/', (200, {}, {'upload_id': 'u1', 'parts': parts}))
+    for p in parts:
+        server.add('PUT', f'/storage/u1/{p["part_number"]}', (200, {'ETag': f'"etag-{p["part_number"]}"'}, b''))
+    server.add('POST', '/api/uploads/u1/complete/', (200, {}, {'complete_url': f'{server.url}/storage/u1/complete?signature=x', 'body': '<CompleteMultipartUpload/>'}))
+    server.add('POST', '/storage/u1/complete', (200, {}, b''))
+    server.add('POST', '/api/uploads/u1/validate/', (200, {}, {'blob_id': 'b1'}))
+    return parts
+
+def test_two_pass_etag_of_remote_and_local_input(server: MockServer, tmp_path):
+    data = _make_data(2500)
+    server.add_file('/files/x.nwb', data)
+    size, etag, part_md5s = compute_input_dandi_etag(InputFile(url=f'{server.url}/files/x.nwb'))
+    assert size == 2500
+    assert etag == _expected_etag(data, 1000)
+    assert part_md5s == [hashlib.md5(data[i:i + 1000]).hexdigest() for i in range(0, 2500, 1000)]
+    # the first pass reads the input once, without range requests
+    assert ['Range' in r['headers'] for r in server.get_requests('GET', '/files/x.nwb')] == [False]
+
+    local_file_name = str(tmp_path / 'x.nwb')
+    with open(local_file_name, 'wb') as f:
+        f.write(data)
+    assert compute_input_dandi_etag(InputFile(local_file_name=local_file_name)) == (size, etag, part_md5s)
+
+def test_streamed_upload_creates_asset(server: MockServer, client: DandiApiClient):
+    data = _make_data(2500)
+    server.add_file('/files/x.nwb', data)
+    parts = _add_upload(server, data, 1000)
+    server.add('POST', _assets_path, (200, {}, {'asset_id': 'a1'}))
+    inp = InputFile(url=f'{server.url}/files/x.nwb')
+    size, etag, part_md5s = compute_input_dandi_etag(inp)
+    stream_input_to_dandi(inp=inp, size=size, etag=etag, part_md5s=part_md5s, client=client, dandiset_id='000001', version='draft', name='sub-1/x.nwb', existing_asset=None)
+
+    assert json.loads(server.get_requests('POST', '/api/uploads/initialize/')[0]['body'])['digest']['value'] == etag
+    # the second pass reads each part with a range request and uploads it
+    ranges = [r['headers'].get('Range', None) for r in server.get_requests('GET', '/files/x.nwb')]
+    assert ranges == [None, 'bytes=0-999', 'bytes=1000-1999', 'bytes=2000-2499']
+    for p in parts:
+        offset = (p['part_number'] - 1) * 1000
+        assert [r['body'] for r in server.get_requests('PUT', f'/storage/u1/{p["part_number"]}')] == [data[offset:offset + p['size']]]
+    assert json.loads(server.get_requests('POST', '/api/uploads/u1/complete/')[0]['body']) == {'parts': [
+        {'part_number': p['part_number'], 'size': p['size'], 'etag': f'etag-{p["part_number"]}'} for p in parts
+    ]}
+    x = json.loads(server.get_requests('POST', _assets_path)[0]['body'])
+    assert x['blob_id'] == 'b1'
+    assert x['metadata'] == {'schemaKey': 'Asset', 'path': 'sub-1/x.nwb', 'encodingFormat': 'application/x-nwb'}
+
+def test_changed_input_is_detected(server: MockServer, client: DandiApiClient):
+    data = _make_data(2500)
+    server.add_file('/files/x.nwb', data)
+    _add_upload(server, data, 1000)
+    inp = InputFile(url=f'{server.url}/files/x.nwb')
+    size, etag, part_md5s = compute_input_dandi_etag(inp)
+    # the input changes (same size) between the two passes
+    server.add_file('/files/x.nwb', data[:1500] + b'x' + data[1501:])
+    with pytest.raises(Exception, match='Part 2 of sub-1/x.nwb changed since its digest was computed'):
+        stream_input_to_dandi(inp=inp, size=size, etag=etag, part_md5s=part_md5s, client=client, dandiset_id='000001', version='draft', name='sub-1/x.nwb', existing_asset=None)
+    assert len(server.get_requests('PUT', '/storage/u1/2')) == 0
+    assert len(server.get_requests('POST', '/api/uploads/u1/complete/')) == 0
+
+def test_existing_blob_is_reused_and_asset_metadata_is_kept(server: MockServer, client: DandiApiClient):
+    data = _make_data(2500)
+    server.add_file('/files/x.nwb', data)
+    server.add('POST', '/api/uploads/initialize/', (409, {'Location': 'b0'}, {'detail': 'blob exists'}))
+    server.add('PUT', f'{_assets_path}a1/', (200, {}, {'asset_id': 'a2'}))
+    existing_asset = {
+        'asset_id': 'a1',
+        'path': 'sub-1/x.nwb',
+        'blob': 'b-old',
+        'metadata': {
+            'schemaKey': 'Asset',
+            'path': 'sub-1/x.nwb',
+            'encodingFormat': 'application/x-nwb',
+            'wasGeneratedBy': [{'name': 'earlier-job'}],
+            'keywords': ['ecephys'],
+            'id': 'dandiasset:a1',
+            'identifier': 'a1',
+            'digest': {'dandi:dandi-etag': 'old-1'},
+            'contentSize': 10,
+            'contentUrl': ['https://example.org/b-old'],
+            'dateModified': '2024-01-01T00:00:00Z',
+            'blobDateModified': '2024-01-01T00:00:00Z'
+        }
+    }
+    inp = InputFile(url=f'{server.url}/files/x.nwb')
+    size, etag, part_md5s = compute_input_dandi_etag(inp)
+    stream_input_to_dandi(inp=inp, size=size, etag=etag, part_md5s=part_md5s, client=client, dandiset_id='000001', version='draft', name='sub-1/x.nwb', existing_asset=existing_asset)
+
+    # nothing is uploaded or read a second time
+    assert [r for r in server.requests if r['path'].startswith('/storage/')] == []
+    assert len(server.get_requests('GET', '/files/x.nwb')) == 1
+    requests = server.get_requests('PUT', f'{_assets_path}a1/')
+    assert len(requests) == 1
+    x = json.loads(requests[0]['body'])
+    assert x['blob_id'] == 'b0'
+    # the metadata of the asset is kept, except for what the archive fills in from the new blob
+    assert x['metadata'] == {
+        'schemaKey': 'Asset',
+        'path': 'sub-1/x.nwb',
+        'encodingFormat': 'application/x-nwb',
+        'wasGeneratedBy': [{'name': 'earlier-job'}],
+        'keywords': ['ecephys']
+    }
@@ -18,27 +18,36 @@ class Kilosort2_5HamilosLabProcessor(ProcessorBase):
         from common.create_sorting_out_nwb_file import create_sorting_out_nwb_file
         from run_kilosort2_5 import run_kilosort2_5
         from common.make_int16_recording import make_int16_recording
-        from common.print_elapsed_time import print_elapsed_time, start_timer
+        from common.StageProfiler import StageProfiler
+        from common.open_input_file import open_input_file
+        from common.select_channel_groups import select_channel_groups
 
         print('Starting kilosort 2.5 Hamilos lab processor')
-        start_timer()
+        profiler = StageProfiler('kilosort2_5-hamiloslab')
 
-        print('Creating input recording')
-        recording = NwbRecording(
-            file=context.input.get_file(),
-            electrical_series_path=context.electrical_series_path
-        )
-        print_elapsed_time()
+        with profiler.stage('open'):
+            print('Opening input file')
+            input_file = open_input_file(context.input)
+
+            print('Creating input recording')
+            recording = NwbRecording(
+                file=input_file,
+                electrical_series_path=context.electrical_series_path
+            )
 
-        if context.test_duration_sec > 0:
-            recording = recording.frame_slice(0, int(recording.get_sampling_frequency() * context.test_duration_sec))
+            if context.test_duration_sec > 0:
+                recording = recording.frame_slice(0, int(recording.get_sampling_frequency() * context.test_duration_sec))
+
+            # only the channels of the selected groups are read from the input file
+            recording = select_channel_groups(recording, channel_groups=context.channel_groups)
+        num_samples = recording.get_num_frames() * recording.get_num_channels()
 
         # important to make a binary recording so that it can be serialized in the format expected by kilosort
         # it's important that it's a single segment with int16 dtype
         # during this step, the entire recording will be downloaded to disk
-        print('Creating binary recording')
-        recording_binary = make_int16_recording(recording, dirname='int16_recording')
-        print_elapsed_time()
+        with profiler.stage('convert', num_samples=num_samples, num_bytes=num_samples * 2):
+            print('Creating binary recording')
+            recording_binary = make_int16_recording(recording, dirname='int16_recording')
 
         channel_groups = recording.get_channel_groups() # get this from recording, not recording_binary
         unique_channel_groups = sorted(list(set(channel_groups)))
@@ -74,38 +83,46 @@ class Kilosort2_5HamilosLabProcessor(ProcessorBase):
             print(f'Channels: {channel_ids_in_group}')
             recording_group = recording_binary.channel_slice(channel_ids=channel_ids_in_group)
 
-            # important to prepare this for kilosort
-            recording_group_binary = make_int16_recording(recording_group, dirname=f'/int16_recording_group_{group}')
+            num_samples_group = recording_group.get_num_frames() * recording_group.get_num_channels()
+            with profiler.stage(f'group_{group}'):
+                with profiler.stage('convert', num_samples=num_samples_group, num_bytes=num_samples_group * 2):
+                    # important to prepare this for kilosort
+                    recording_group_binary = make_int16_recording(recording_group, dirname=f'/int16_recording_group_{group}')
 
-            print(f'Running kilosort 2.5 on group {group}')
-            sorting = run_kilosort2_5(
-                recording=recording_group_binary,
-                sorting_params=sorting_params,
-                output_folder=f'sorting_output_group_{group}'
-            )
-            print_elapsed_time()
+                with profiler.stage('sort', num_samples=num_samples_group, num_bytes=num_samples_group * 2):
+                    print(f'Running kilosort 2.5 on group {group}')
+                    sorting = run_kilosort2_5(
+                        recording=recording_group_binary,
+                        sorting_params=sorting_params,
+                        output_folder=f'sorting_output_group_{group}'
+                    )
 
             sortings.append(sorting)
 
-        print('Combining sortings')
-        sorting = _combine_sortings(sortings, group_ids=unique_channel_groups)
-        print_elapsed_time()
+        with profiler.stage('combine'):
+            print('Combining sortings')
+            sorting = _combine_sortings(sortings, group_ids=unique_channel_groups)
+
+        with profiler.stage('write'):
+            print('Writing output NWB file')
+            h5_file = h5py.File(input_file, 'r')
+            with pynwb.NWBHDF5IO(file=h5_file, mode='r', load_namespaces=True) as io:
+                nwbfile_rec = io.read()
 
-        print('Writing output NWB file')
-        h5_file = h5py.File(context.input.get_file(), 'r')
-        with pynwb.NWBHDF5IO(file=h5_file, mode='r', load_namespaces=True) as io:
-            nwbfile_rec = io.read()
+                if not os.path.exists('output'):
+                    os.mkdir('output')
+                sorting_out_fname = 'output/sorting.nwb'
 
-            if not os.path.exists('output'):
-                os.mkdir('output')
-            sorting_out_fname = 'output/sorting.nwb'
+                create_sorting_out_nwb_file(nwbfile_rec=nwbfile_rec, sorting=sorting, sorting_out_fname=sorting_out_fname)
 
-            create_sorting_out_nwb_file(nwbfile_rec=nwbfile_rec, sorting=sorting, sorting_out_fname=sorting_out_fname)
-        print_elapsed_time()
+        with profiler.stage('upload'):
+            print('Uploading output NWB file')
+            context.output.upload(sorting_out_fname)
 
-        print('Uploading output NWB file')
-        context.output.upload(sorting_out_fname)
-        print_elapsed_time()
+        input_file.print_summary()
+        profiler.record_io(input_file.get_summary())
+        profiler.print_summary()
+        profiler.write_json('output/profile.json')
 
 def _combine_sortings(sortings, group_ids):
     from typing import Dict
@@ -28,6 +28,7 @@ class Kilosort2_5Context(BaseModel):
     scaleproc: int = Field(default=-1, description="int16 scaling of whitened data, if -1 set to 200.")
     test_duration_sec: float = Field(default=0, description='For testing purposes: duration of the recording in seconds (0 means all)')
     lazy_read_input: bool = Field(default=True, description='If True (default and recommended) the input is read lazily, otherwise the entire nwb file is downloaded upfront.')
+    exclude_bad_channels: bool = Field(default=False, description='Exclude the channels flagged by the channel health statistics (flat, saturated, dead or noisy) from sorting. The statistics are written to the output NWB file either way.')
 
 class Kilosort2_5HamilosLabContext(BaseModel):
     input: InputFile = Field(description='input .nwb file')
@@ -54,3 +55,4 @@ class Kilosort2_5HamilosLabContext(BaseModel):
     skip_kilosort_preprocessing: bool = Field(default=False, description="Can optionally skip the internal kilosort preprocessing")
     scaleproc: int = Field(default=-1, description="int16 scaling of whitened data, if -1 set to 200.")
     test_duration_sec: float = Field(default=0, description='For testing purposes: duration of the recording in seconds (0 means all)')
+    channel_groups: List[int] = Field(default=[], description='Channel groups to sort (empty means all). Only the channels of these groups are read from the input file.')
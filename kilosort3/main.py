@@ -33,79 +33,133 @@ class Kilosort3Processor(ProcessorBase):
         from common.create_sorting_out_nwb_file import create_sorting_out_nwb_file
         from run_kilosort3 import run_kilosort3
         from common.make_int16_recording import make_int16_recording
-        from common.print_elapsed_time import print_elapsed_time, start_timer
+        from common.StageProfiler import StageProfiler
+        from common.open_input_file import open_input_file
+        from common.ChannelHealthStats import ChannelHealthStats
 
         print('Starting kilosort3 processor')
-        start_timer()
+        profiler = StageProfiler('kilosort3')
 
-        print('Creating input recording')
-        recording = NwbRecording(
-            file=context.input.get_file(),
-            electrical_series_path=context.electrical_series_path
-        )
-        print_elapsed_time()
+        with profiler.stage('open'):
+            print('Opening input file')
+            input_file = open_input_file(context.input)
+
+            print('Creating input recording')
+            recording = NwbRecording(
+                file=input_file,
+                electrical_series_path=context.electrical_series_path
+            )
 
-        if context.test_duration_sec > 0:
-            recording = recording.frame_slice(0, int(recording.get_sampling_frequency() * context.test_duration_sec))
+            if context.test_duration_sec > 0:
+                recording = recording.frame_slice(0, int(recording.get_sampling_frequency() * context.test_duration_sec))
+        num_samples = recording.get_num_frames() * recording.get_num_channels()
 
         # important to make a binary recording so that it can be serialized in the format expected by kilosort
         # it's important that it's a single segment with int16 dtype
         # during this step, the entire recording will be downloaded to disk
-        print('Creating binary recording')
-        recording_binary = make_int16_recording(recording, dirname='int16_recording')
-        print_elapsed_time()
-
-        # run kilosort3
-        print('Preparing kilosort3')
-        sorting_params = {
-            'detect_threshold': context.detect_threshold,
-            'projection_threshold': context.projection_threshold,
-            'preclust_threshold': context.preclust_threshold,
-            'car': context.car,
-            'minFR': context.minFR,
-            'minfr_goodchannels': context.minfr_goodchannels,
-            'nblocks': context.nblocks,
-            'sig': context.sig,
-            'freq_min': context.freq_min,
-            'sigmaMask': context.sigmaMask,
-            'nPCs': context.nPCs,
-            'ntbuff': context.ntbuff,
-            'nfilt_factor': context.nfilt_factor,
-            'do_correction': context.do_correction,
-            'NT': context.NT if context.NT >= 0 else None,
-            'AUCsplit': context.AUCsplit,
-            'wave_length': context.wave_length,
-            'keep_good_only': context.keep_good_only,
-            'skip_kilosort_preprocessing': context.skip_kilosort_preprocessing,
-            'scaleproc': context.scaleproc if context.scaleproc >= 0 else None
-        }
-
-        print('Running kilosort3')
-        sorting = run_kilosort3(
-            recording=recording_binary,
-            sorting_params=sorting_params,
-            output_folder='sorting_output'
-        )
-        print_elapsed_time()
-
-        print('Writing output NWB file')
-        h5_file = h5py.File(context.input.get_file(), 'r')
-        with pynwb.NWBHDF5IO(file=h5_file, mode='r', load_namespaces=True) as io:
-            nwbfile_rec = io.read()
-
-            if not os.path.exists('output'):
-                os.mkdir('output')
-            sorting_out_fname = 'output/sorting.nwb'
-
-            create_sorting_out_nwb_file(nwbfile_rec=nwbfile_rec, sorting=sorting, sorting_out_fname=sorting_out_fname)
-        print_elapsed_time()
-
-        print('Uploading output NWB file')
-        context.output.upload(sorting_out_fname)
-        print_elapsed_time()
+        with profiler.stage('convert', num_samples=num_samples, num_bytes=num_samples * 2):
+            print('Creating binary recording')
+            channel_health_stats = ChannelHealthStats(recording)
+            recording_binary = make_int16_recording(channel_health_stats.recording, dirname='int16_recording', channel_health_stats=channel_health_stats)
+        bad_channels = channel_health_stats.get_bad_channels()
+        channel_health_stats.print_summary(bad_channels)
+        excluded_channels = bad_channels if context.exclude_bad_channels else {}
+        if len(excluded_channels) > 0:
+            good_channel_ids = [ch for ch in recording.get_channel_ids() if ch not in excluded_channels]
+            if len(good_channel_ids) == 0:
+                raise Exception('All channels were flagged as bad')
+            print(f'Excluding {len(excluded_channels)} of {recording.get_num_channels()} channels')
+            # kilosort needs a binary file with only the sorted channels (this is a local copy, no extra input reads)
+            num_samples = recording.get_num_frames() * len(good_channel_ids)
+            with profiler.stage('exclude_channels', num_samples=num_samples, num_bytes=num_samples * 2):
+                recording_binary = make_int16_recording(recording_binary.channel_slice(channel_ids=good_channel_ids), dirname='int16_recording_good_channels')
+
+        with profiler.stage('sort', num_samples=num_samples, num_bytes=num_samples * 2):
+            # run kilosort3
+            print('Preparing kilosort3')
+            sorting_params = {
+                'detect_threshold': context.detect_threshold,
+                'projection_threshold': context.projection_threshold,
+                'preclust_threshold': context.preclust_threshold,
+                'car': context.car,
+                'minFR': context.minFR,
+                'minfr_goodchannels': context.minfr_goodchannels,
+                'nblocks': context.nblocks,
+                'sig': context.sig,
+                'freq_min': context.freq_min,
+                'sigmaMask': context.sigmaMask,
+                'nPCs': context.nPCs,
+                'ntbuff': context.ntbuff,
+                'nfilt_factor': context.nfilt_factor,
+                'do_correction': context.do_correction,
+                'NT': context.NT if context.NT >= 0 else None,
+                'AUCsplit': context.AUCsplit,
+                'wave_length': context.wave_length,
+                'keep_good_only': context.keep_good_only,
+                'skip_kilosort_preprocessing': context.skip_kilosort_preprocessing,
+                'scaleproc': context.scaleproc if context.scaleproc >= 0 else None
+            }
+
+            print('Running kilosort3')
+            sorting = run_kilosort3(
+                recording=recording_binary,
+                sorting_params=sorting_params,
+                output_folder='sorting_output'
+            )
+
+        with profiler.stage('write'):
+            print('Writing output NWB file')
+            h5_file = h5py.File(input_file, 'r')
+            with pynwb.NWBHDF5IO(file=h5_file, mode='r', load_namespaces=True) as io:
+                nwbfile_rec = io.read()
+
+                if not os.path.exists('output'):
+                    os.mkdir('output')
+                sorting_out_fname = 'output/sorting.nwb'
+
+                create_sorting_out_nwb_file(
+                    nwbfile_rec=nwbfile_rec,
+                    sorting=sorting,
+                    sorting_out_fname=sorting_out_fname,
+                    channel_health={**channel_health_stats.get_stats(), 'flagged': bad_channels, 'excluded': list(excluded_channels)}
+                )
+
+        with profiler.stage('upload'):
+            print('Uploading output NWB file')
+            context.output.upload(sorting_out_fname)
+
+        input_file.print_summary()
+        profiler.record_io(input_file.get_summary())
+        profiler.print_summary()
+        profiler.write_json('output/profile.json')
 
 app.add_processor(Kilosort3Processor)
 app.add_processor(Kilosort3HamilosLabProcessor)
 
 if __name__ == '__main__':
-    app.run()
+    if os.environ.get('WARM_WORKER_JOBS', None) is not None:
+        # run many local jobs in this process (see common/run_warm_worker.py)
+        from common.run_warm_worker import run_warm_worker
+        run_warm_worker(
+            processors=[Kilosort3Processor, Kilosort3HamilosLabProcessor],
+            preload_modules=[
+                'numpy',
+                'h5py',
+                'pynwb',
+                'remfile',
+                'spikeinterface',
+                'spikeinterface.preprocessing',
+                'spikeinterface.sorters',
+                'common.NwbRecording',
+                'common.NwbSorting',
+                'common.create_sorting_out_nwb_file',
+                'common.StageProfiler',
+                'common.open_input_file',
+                'common.make_int16_recording',
+                'run_kilosort3'
+            ],
+            jobs=os.environ['WARM_WORKER_JOBS'],
+            work_dir=os.environ.get('WARM_WORKER_DIR', 'warm_worker_jobs')
+        )
+    else:
+        app.run()
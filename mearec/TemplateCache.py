@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import shutil
+import fcntl
+import hashlib
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Union, List, Set
+
+
+class TemplateCache:
+    """
+    Local content-addressed cache for the intermediate results of MEArec template generation.
+
+    Two kinds of entries are stored, each in a folder named after the hash of the parameters that determine it:
+      - intracellular/<key>: NEURON simulation results (imem/vmem files) for all cell models simulated with a given set of intracellular parameters
+      - eap/<key>: extracellular templates (eap, pos, rot files) for a single (cell model, probe, rotation, seed, ...) combination
+
+    A manifest.json file at the root of the cache keeps track of the parameters, size and last use of every entry.
+    Entries are evicted least-recently-used first when the total size exceeds max_size_gb.
+
+    The cache may be shared by concurrent jobs on the same node. A job holds the lock of an intracellular entry
+    (lock_intracellular) while it uses the entry and the eap entries derived from it, so two jobs never simulate into
+    the same folder at once, and eviction skips the entries whose lock is held by another job.
+    """
+    def __init__(self, cache_folder: str, *, max_size_gb: float) -> None:
+        self._cache_folder = Path(cache_folder).resolve()
+        self._max_size_bytes = int(max_size_gb * 1e9)
+        os.makedirs(self._cache_folder / 'intracellular', exist_ok=True)
+        os.makedirs(self._cache_folder / 'eap', exist_ok=True)
+        self._manifest_path = self._cache_folder / 'manifest.json'
+        self._lock_path = self._cache_folder / '.lock'
+        self.num_hits = 0
+        self.num_misses = 0
+
+    @staticmethod
+    def compute_key(params: dict) -> str:
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @contextmanager
+    def lock_intracellular(self, key: str):
+        """Hold the lock of the intracellular entry with the given key (waiting for any other job using it)"""
+        with open(self._get_entry_lock_path(key), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_intracellular_folder(self, key: str, *, params: dict) -> Path:
+        """Return the folder for the intracellular simulations with the given key, creating the entry if needed.
+        Cell models are simulated directly into this folder, so it fills up incrementally across runs. The caller
+        must hold lock_intracellular(key)."""
+        folder = self._cache_folder / 'intracellular' / key
+        with self._locked_manifest() as manifest:
+            os.makedirs(folder, exist_ok=True)
+            entry = manifest['entries'].get(key, None)
+            if entry is None:
+                entry = {'kind': 'intracellular', 'params': params, 'created': time.time()}
+                manifest['entries'][key] = entry
+            entry['last_used'] = time.time()
+            entry['size_bytes'] = _get_folder_size(folder)
+        return folder
+
+    def update_intracellular_size(self, key: str):
+        folder = self._cache_folder / 'intracellular' / key
+        with self._locked_manifest() as manifest:
+            if key in manifest['entries']:
+                manifest['entries'][key]['size_bytes'] = _get_folder_size(folder)
+
+    def get_eap_folder(self, key: str) -> Union[Path, None]:
+        """Return the folder holding the cached eap files for the given key, or None if not cached."""
+        folder = self._cache_folder / 'eap' / key
+        with self._locked_manifest() as manifest:
+            entry = manifest['entries'].get(key, None)
+            if entry is None or not folder.is_dir():
+                self.num_misses += 1
+                return None
+            entry['last_used'] = time.time()
+        self.num_hits += 1
+        return folder
+
+    def put_eap_files(self, key: str, *, files: List[Path], params: dict):
+        folder = self._cache_folder / 'eap' / key
+        tmp_folder = self._cache_folder / 'eap' / f'{key}.tmp.{os.getpid()}'
+        if tmp_folder.exists():
+            shutil.rmtree(tmp_folder)
+        os.makedirs(tmp_folder)
+        for f in files:
+            shutil.copyfile(f, tmp_folder / f.name)
+        with self._locked_manifest() as manifest:
+            if folder.exists():
+                # another job stored it in the meantime
+                shutil.rmtree(tmp_folder)
+            else:
+                os.rename(tmp_folder, folder)
+            manifest['entries'][key] = {
+                'kind': 'eap',
+                'params': params,
+                'created': time.time(),
+                'last_used': time.time(),
+                'size_bytes': _get_folder_size(folder)
+            }
+
+    def evict(self, *, keep: Set[str]):
+        """Remove least-recently-used entries until the cache fits in max_size_gb. Entries in keep, and entries that
+        another job is using, are never removed. The caller must not hold any lock_intracellular."""
+        with self._locked_manifest() as manifest:
+            entries = manifest['entries']
+            total_size = sum(e['size_bytes'] for e in entries.values())
+            candidates = sorted(
+                [k for k in entries.keys() if k not in keep],
+                key=lambda k: entries[k]['last_used']
+            )
+            for key in candidates:
+                if total_size <= self._max_size_bytes:
+                    break
+                entry = entries[key]
+                # the eap entries are used under the lock of their intracellular entry
+                lock_key = key if entry['kind'] == 'intracellular' else entry['params']['intracellular_key']
+                with open(self._get_entry_lock_path(lock_key), 'w') as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        print(f'Not evicting {entry["kind"]} cache entry {key}: in use by another job')
+                        continue
+                    try:
+                        print(f'Evicting {entry["kind"]} cache entry {key} ({entry["size_bytes"] / 1e6:.1f} MB)')
+                        shutil.rmtree(self._cache_folder / entry['kind'] / key, ignore_errors=True)
+                        total_size -= entry['size_bytes']
+                        del entries[key]
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+            print(f'Template cache size: {total_size / 1e9:.3f} GB in {len(entries)} entries')
+
+    def _get_entry_lock_path(self, intracellular_key: str) -> Path:
+        # next to the folder (not in it), so that it is not counted in the size and survives eviction
+        return self._cache_folder / 'intracellular' / f'{intracellular_key}.lock'
+
+    @contextmanager
+    def _locked_manifest(self):
+        # The cache may be shared by concurrent jobs on the same node
+        with open(self._lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if self._manifest_path.exists():
+                    with open(self._manifest_path, 'r') as f:
+                        manifest = json.load(f)
+                else:
+                    manifest = {'entries': {}}
+                yield manifest
+                tmp_path = self._manifest_path.with_suffix('.json.tmp')
+                with open(tmp_path, 'w') as f:
+                    json.dump(manifest, f, indent=2)
+                os.replace(tmp_path, self._manifest_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _get_folder_size(folder: Path) -> int:
+    return sum(f.stat().st_size for f in folder.rglob('*') if f.is_file())
@@ -0,0 +1,165 @@
+import os
+import sys
+import shutil
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Union
+import numpy as np
+from TemplateCache import TemplateCache
+
+
+# Parameters that determine the intracellular (NEURON) simulation results.
+# As in MEArec itself, the seed is not included: existing intracellular
+# simulations are reused across seeds.
+_intracellular_keys = ['sim_time', 'target_spikes', 'cut_out', 'dt', 'delay', 'weights']
+
+def gen_templates_cached(
+    *,
+    cell_models_folder: str,
+    params: dict,
+    cache: Union[TemplateCache, None],
+    shard_index: int = 0,
+    shard_count: int = 1,
+    n_jobs: Union[int, None] = None,
+    verbose: bool = False
+):
+    """
+    Equivalent to mr.gen_templates(cell_models_folder=..., params=..., parallel=True, n_jobs=...)
+    except that the intracellular simulations and the per-cell-model extracellular templates
+    are looked up in the cache and only the missing pieces are computed.
+
+    The seed used for cell model i (in sorted order) is seed + i, exactly as in MEArec, so the
+    result does not depend on which pieces were cached.
+
+    If shard_count > 1, only the cell models with index i such that i % shard_count == shard_index
+    are simulated. The shard outputs can be combined with merge_template_generators, which
+    produces the same templates as an unsharded run with the same seed.
+
+    If cache is None, nothing is cached and all cell models in the shard are simulated.
+
+    The extracellular templates are keyed on the seed. Without a seed (params['seed'] is None), a random
+    seed is drawn for each run as in MEArec, so only the intracellular simulations are reused from the cache.
+    """
+    import yaml
+    import MEArec as mr
+    import MEAutility as mu
+    from joblib import Parallel, cpu_count, delayed
+    from MEArec.generators.templategenerator import simulate_cell_templates
+    from MEArec.tools import load_tmp_eap, clean_dict_for_yaml
+
+    params = {**mr.get_default_templates_params(), **params}
+    if params['seed'] is None:
+        if shard_count > 1:
+            raise Exception('A seed must be specified when generating templates in shards')
+        params['seed'] = int(np.random.randint(1, 10000))
+        if cache is not None:
+            print(f'No seed specified (using {params["seed"]}): the cached extracellular templates cannot be reused, only the intracellular simulations')
+    if not 0 <= shard_index < shard_count:
+        raise Exception(f'Invalid shard index {shard_index} for shard count {shard_count}')
+    cell_models_folder_path = Path(cell_models_folder).resolve()
+
+    # sorted list of cell models, as in MEArec TemplateGenerator
+    cell_models = sorted(
+        [f.name for f in cell_models_folder_path.iterdir() if 'mods' not in f.name and not f.name.startswith('.')]
+    )
+    if len(cell_models) == 0:
+        raise Exception(f'{cell_models_folder} contains no cell models')
+    # keep the index in the full list of cell models because it determines the seed
+    shard_cell_models = [(i, cell_model) for i, cell_model in enumerate(cell_models) if i % shard_count == shard_index]
+    if shard_count > 1:
+        print(f'Shard {shard_index} of {shard_count}: {len(shard_cell_models)} of {len(cell_models)} cell models')
+
+    simulate_script = str(Path(mr.__file__).parent / 'simulate_cells.py')
+    if not (cell_models_folder_path / 'mods').is_dir():
+        print('Compiling NEURON models')
+        os.system(f'{sys.executable} {simulate_script} compile {cell_models_folder_path}')
+
+    intracellular_params = {
+        **{k: params[k] for k in _intracellular_keys},
+        'cell_models_folder': str(cell_models_folder_path),
+        'mearec_version': mr.__version__
+    }
+    intracellular_key = TemplateCache.compute_key(intracellular_params)
+
+    # MEArec reads the intracellular simulations from <templates_folder>/intracellular and
+    # writes the extracellular templates to <templates_folder>/<rot>/tmp_<n>_<probe>
+    templates_folder = Path('templates_tmp').resolve()
+    if templates_folder.exists():
+        shutil.rmtree(templates_folder)
+    os.makedirs(templates_folder)
+    # the intracellular entry (and the eap entries derived from it) is locked while it is used, so that concurrent
+    # jobs with the same intracellular parameters do not simulate into the same folder, and it is not evicted
+    with (cache.lock_intracellular(intracellular_key) if cache is not None else nullcontext()):
+        if cache is not None:
+            intracellular_folder = cache.get_intracellular_folder(intracellular_key, params=intracellular_params)
+            os.symlink(intracellular_folder, templates_folder / 'intracellular')
+        eap_folder = templates_folder / params['rot'] / f'tmp_{params["n"]}_{params["probe"]}'
+        os.makedirs(eap_folder)
+        params['templates_folder'] = str(templates_folder)
+        params['cell_models_folder'] = str(cell_models_folder_path)
+        params['shard_index'] = shard_index
+        params['shard_count'] = shard_count
+
+        eap_keys = {}
+        eap_params = {}
+        missing = []
+        for i, cell_model in shard_cell_models:
+            p = {
+                **{k: v for k, v in params.items() if k not in ['seed', 'templates_folder', 'cell_models_folder', 'shard_index', 'shard_count']},
+                'cell_model': cell_model,
+                'cell_seed': params['seed'] + i,
+                'intracellular_key': intracellular_key,
+                'mearec_version': mr.__version__
+            }
+            eap_keys[cell_model] = TemplateCache.compute_key(p)
+            eap_params[cell_model] = p
+            cached_folder = cache.get_eap_folder(eap_keys[cell_model]) if cache is not None else None
+            if cached_folder is not None:
+                for f in cached_folder.iterdir():
+                    shutil.copyfile(f, eap_folder / f.name)
+            else:
+                missing.append((i, cell_model))
+        if cache is not None:
+            print(f'Templates cache: {len(shard_cell_models) - len(missing)} of {len(shard_cell_models)} cell models found in cache')
+
+        if len(missing) > 0:
+            params_path = templates_folder / 'params.yaml'
+            with open(params_path, 'w') as f:
+                yaml.dump(clean_dict_for_yaml(params), f)
+            if n_jobs is None:
+                n_jobs = cpu_count()
+            print(f'Simulating {len(missing)} cell models using {n_jobs} jobs')
+            Parallel(n_jobs=n_jobs, backend='loky')(
+                delayed(simulate_cell_templates)(
+                    i, simulate_script, len(cell_models), cell_model, cell_models_folder_path, False, params_path, verbose
+                )
+                for i, cell_model in missing
+            )
+            if cache is not None:
+                cache.update_intracellular_size(intracellular_key)
+            for i, cell_model in missing:
+                files = [eap_folder / f'{prefix}-{cell_model}.npy' for prefix in ['eap', 'pos', 'rot']]
+                if not all(f.is_file() for f in files):
+                    print(f'Warning: no templates were generated for cell model {cell_model}')
+                elif cache is not None:
+                    cache.put_eap_files(eap_keys[cell_model], files=files, params=eap_params[cell_model])
+
+    print('Aggregating templates')
+    templates, locations, rotations, celltypes = load_tmp_eap(eap_folder)
+    tempgen = mr.TemplateGenerator(
+        temp_dict={
+            'templates': templates,
+            'locations': locations,
+            'rotations': rotations,
+            'celltypes': celltypes
+        },
+        info={
+            'params': params,
+            'electrodes': mu.return_mea_info(params['probe'])
+        }
+    )
+    shutil.rmtree(templates_folder)
+
+    if cache is not None:
+        cache.evict(keep=set([intracellular_key, *eap_keys.values()]))
+    return tempgen
@@ -0,0 +1,259 @@
+import os
+from uuid import uuid4
+from datetime import datetime
+from fractions import Fraction
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+
+
+def generate_recording_nwb(
+    *,
+    templates_fname: str,
+    output_fname: str,
+    duration_sec: float,
+    sampling_frequency: float,
+    num_units: int,
+    min_firing_rate_hz: float,
+    max_firing_rate_hz: float,
+    refractory_period_ms: float,
+    min_amplitude_uv: float,
+    min_distance_um: float,
+    noise_level_uv: float,
+    gain_to_uv: float,
+    chunk_duration_sec: float,
+    n_jobs: int,
+    seed: int
+):
+    """
+    Generate a ground-truth recording from a MEArec template generator and stream it into an NWB file.
+
+    The traces are never held in memory as a whole: they are generated in time chunks (templates
+    convolved with the spike trains plus noise) on a process pool and each chunk is written to a
+    chunked, compressed ElectricalSeries as soon as it is ready. The ground-truth spike trains are
+    written to the units table, so the output can be read with NwbRecording and NwbSorting.
+    """
+    import h5py
+    import pynwb
+    import MEAutility as mu
+    from pynwb.ecephys import ElectricalSeries
+    from hdmf.backends.hdf5.h5_utils import H5DataIO
+
+    rng = np.random.default_rng(seed)
+
+    print('Loading templates')
+    with h5py.File(templates_fname, 'r') as f:
+        templates = np.array(f['templates'])
+        locations = np.array(f['locations'])
+        celltypes = np.array([c.decode('utf-8') for c in f['celltypes']])
+        dt_ms = float(f['info/params/dt'][()])
+        cut_out_ms = [float(x) for x in f['info/params/cut_out'][()]]
+        probe_name = f['info/params/probe'][()].decode('utf-8')
+    if templates.ndim != 3:
+        raise NotImplementedError('Drifting templates are not supported')
+    # (num_templates, num_channels, num_samples) -> (num_templates, num_samples, num_channels)
+    templates = np.transpose(templates, (0, 2, 1))
+
+    print('Selecting templates')
+    selected = _select_templates(
+        templates=templates,
+        locations=locations,
+        num_units=num_units,
+        min_amplitude_uv=min_amplitude_uv,
+        min_distance_um=min_distance_um,
+        rng=rng
+    )
+    unit_templates = _resample_templates(templates[selected], fs_in=1000 / dt_ms, fs_out=sampling_frequency)
+    peak_index = int(round(cut_out_ms[0] / 1000 * sampling_frequency))
+
+    print('Generating spike trains')
+    num_frames = int(duration_sec * sampling_frequency)
+    firing_rates = rng.uniform(min_firing_rate_hz, max_firing_rate_hz, size=num_units)
+    unit_spike_frames = [
+        _generate_spike_frames(rate_hz=r, num_frames=num_frames, sampling_frequency=sampling_frequency, refractory_period_ms=refractory_period_ms, rng=rng)
+        for r in firing_rates
+    ]
+    spike_frames = np.concatenate(unit_spike_frames)
+    spike_labels = np.concatenate([np.full(len(s), i, dtype=np.int32) for i, s in enumerate(unit_spike_frames)])
+    sort_inds = np.argsort(spike_frames, kind='stable')
+    spike_frames = spike_frames[sort_inds]
+    spike_labels = spike_labels[sort_inds]
+
+    num_channels = unit_templates.shape[2]
+    mea = mu.return_mea(probe_name)
+    channel_locations = mea.positions[:, 1:3] # the probe plane is y-z in MEArec
+
+    nwbfile = pynwb.NWBFile(
+        session_description=f'MEArec synthetic recording with {num_units} ground-truth units',
+        identifier=str(uuid4()),
+        session_start_time=datetime.now().astimezone(),
+        subject=pynwb.file.Subject(
+            subject_id='synthetic',
+            species='Mus musculus',
+            description='MEArec synthetic recording'
+        ),
+        keywords=['synthetic', 'ground-truth', 'mearec']
+    )
+    device = nwbfile.create_device(name=probe_name, description='MEArec probe')
+    electrode_group = nwbfile.create_electrode_group(name='probe', description=probe_name, location='synthetic', device=device)
+    for i in range(num_channels):
+        nwbfile.add_electrode(
+            group=electrode_group,
+            location='synthetic',
+            rel_x=float(channel_locations[i, 0]),
+            rel_y=float(channel_locations[i, 1])
+        )
+    electrodes = nwbfile.create_electrode_table_region(region=list(range(num_channels)), description='all electrodes')
+
+    chunk_size = int(chunk_duration_sec * sampling_frequency)
+    data_iterator = _GeneratedTracesIterator(
+        num_frames=num_frames,
+        num_channels=num_channels,
+        chunk_size=chunk_size,
+        n_jobs=n_jobs if n_jobs > 0 else os.cpu_count() or 1,
+        worker_state={
+            'templates': unit_templates,
+            'peak_index': peak_index,
+            'spike_frames': spike_frames,
+            'spike_labels': spike_labels,
+            'noise_level_uv': noise_level_uv,
+            'gain_to_uv': gain_to_uv,
+            'seed': seed
+        }
+    )
+    electrical_series = ElectricalSeries(
+        name='ElectricalSeries',
+        data=H5DataIO(
+            data=data_iterator,
+            chunks=(min(num_frames, int(sampling_frequency)), min(num_channels, 64)),
+            compression='gzip'
+        ),
+        electrodes=electrodes,
+        starting_time=0.0,
+        rate=float(sampling_frequency),
+        conversion=gain_to_uv * 1e-6
+    )
+    nwbfile.add_acquisition(electrical_series)
+
+    nwbfile.add_unit_column(name='celltype', description='Cell model of the template')
+    nwbfile.add_unit_column(name='firing_rate_hz', description='Target firing rate')
+    for i in range(num_units):
+        nwbfile.add_unit(
+            id=i + 1,
+            spike_times=unit_spike_frames[i] / sampling_frequency,
+            celltype=str(celltypes[selected[i]]),
+            firing_rate_hz=float(firing_rates[i])
+        )
+
+    print(f'Writing {num_frames} frames x {num_channels} channels in chunks of {chunk_size} frames')
+    with pynwb.NWBHDF5IO(output_fname, 'w') as io: # type: ignore
+        io.write(nwbfile, cache_spec=True) # type: ignore
+
+def _select_templates(*, templates: np.ndarray, locations: np.ndarray, num_units: int, min_amplitude_uv: float, min_distance_um: float, rng: np.random.Generator) -> List[int]:
+    amplitudes = np.max(np.max(templates, axis=1) - np.min(templates, axis=1), axis=1)
+    candidates = rng.permutation(np.nonzero(amplitudes >= min_amplitude_uv)[0])
+    selected: List[int] = []
+    for c in candidates:
+        if all(np.linalg.norm(locations[c] - locations[s]) >= min_distance_um for s in selected):
+            selected.append(int(c))
+            if len(selected) == num_units:
+                return selected
+    raise Exception(f'Could only select {len(selected)} of {num_units} templates with amplitude >= {min_amplitude_uv} uV and distance >= {min_distance_um} um')
+
+def _resample_templates(templates: np.ndarray, *, fs_in: float, fs_out: float) -> np.ndarray:
+    if fs_in == fs_out:
+        return templates.astype(np.float32)
+    import scipy.signal
+    ratio = Fraction(fs_out / fs_in).limit_denominator(1000)
+    return scipy.signal.resample_poly(templates, ratio.numerator, ratio.denominator, axis=1).astype(np.float32)
+
+def _generate_spike_frames(*, rate_hz: float, num_frames: int, sampling_frequency: float, refractory_period_ms: float, rng: np.random.Generator) -> np.ndarray:
+    duration_sec = num_frames / sampling_frequency
+    refractory_sec = refractory_period_ms / 1000
+    # Poisson process with a dead time: exponential intervals shifted by the refractory period
+    mean_isi_sec = 1 / rate_hz - refractory_sec
+    if mean_isi_sec <= 0:
+        raise Exception(f'Firing rate {rate_hz} Hz is incompatible with a refractory period of {refractory_period_ms} ms')
+    num_expected = int(duration_sec * rate_hz * 1.2) + 10
+    isis = refractory_sec + rng.exponential(mean_isi_sec, size=num_expected)
+    times = np.cumsum(isis)
+    while times[-1] < duration_sec:
+        more = refractory_sec + rng.exponential(mean_isi_sec, size=num_expected)
+        times = np.concatenate([times, times[-1] + np.cumsum(more)])
+    times = times[times < duration_sec]
+    return np.floor(times * sampling_frequency).astype(np.int64)
+
+_worker_state: dict = {}
+
+def _init_worker(worker_state: dict):
+    _worker_state.update(worker_state)
+
+def _generate_chunk(start_frame: int, end_frame: int) -> np.ndarray:
+    templates: np.ndarray = _worker_state['templates']
+    peak_index: int = _worker_state['peak_index']
+    spike_frames: np.ndarray = _worker_state['spike_frames']
+    spike_labels: np.ndarray = _worker_state['spike_labels']
+    T = templates.shape[1]
+    M = templates.shape[2]
+    # seed per chunk so the output does not depend on scheduling
+    chunk_rng = np.random.default_rng([_worker_state['seed'], start_frame])
+    traces = chunk_rng.normal(0, _worker_state['noise_level_uv'], size=(end_frame - start_frame, M)).astype(np.float32)
+    # spikes whose template overlaps this chunk
+    i1 = np.searchsorted(spike_frames, start_frame - (T - peak_index), side='right')
+    i2 = np.searchsorted(spike_frames, end_frame + peak_index, side='left')
+    for j in range(i1, i2):
+        t1 = spike_frames[j] - peak_index - start_frame
+        t2 = t1 + T
+        a1 = max(t1, 0)
+        a2 = min(t2, end_frame - start_frame)
+        if a2 > a1:
+            traces[a1:a2] += templates[spike_labels[j], a1 - t1:a2 - t1]
+    return np.clip(np.round(traces / _worker_state['gain_to_uv']), -32768, 32767).astype(np.int16)
+
+class _GeneratedTracesIterator(AbstractDataChunkIterator):
+    def __init__(self, *, num_frames: int, num_channels: int, chunk_size: int, n_jobs: int, worker_state: dict):
+        self._num_frames = num_frames
+        self._num_channels = num_channels
+        self._chunk_size = chunk_size
+        self._n_jobs = n_jobs
+        self._worker_state = worker_state
+        self._chunks = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._chunks is None:
+            self._chunks = self._generate_chunks()
+        return next(self._chunks)
+
+    def _generate_chunks(self):
+        starts = list(range(0, self._num_frames, self._chunk_size))
+        with ProcessPoolExecutor(max_workers=self._n_jobs, initializer=_init_worker, initargs=(self._worker_state,)) as executor:
+            # keep a bounded number of chunks in flight so memory does not grow with the duration
+            max_in_flight = 2 * self._n_jobs
+            futures = []
+            next_index = 0
+            for i, start in enumerate(starts):
+                while next_index < len(starts) and len(futures) < max_in_flight:
+                    s = starts[next_index]
+                    futures.append(executor.submit(_generate_chunk, s, min(s + self._chunk_size, self._num_frames)))
+                    next_index += 1
+                data = futures.pop(0).result()
+                print(f'Generated chunk {i + 1} of {len(starts)}')
+                yield DataChunk(data=data, selection=np.s_[start:start + data.shape[0], :])
+
+    def recommended_chunk_shape(self):
+        return None
+
+    def recommended_data_shape(self):
+        return (self._num_frames, self._num_channels)
+
+    @property
+    def dtype(self):
+        return np.dtype('int16')
+
+    @property
+    def maxshape(self):
+        return (self._num_frames, self._num_channels)
@@ -2,7 +2,7 @@
 
 import os
 from dendro.sdk import App, ProcessorBase
-from models import MearecGenerateTemplatesContext
+from models import MearecGenerateTemplatesContext, MearecMergeTemplatesContext, MearecGenerateRecordingContext
 
 
 description = 'Fast and customuzable biophysical simulation of extracellular recordings.'
@@ -25,12 +25,12 @@ class MearecGenerateTemplatesProcessor(ProcessorBase):
     @staticmethod
     def run(context: MearecGenerateTemplatesContext):
         import MEArec as mr
-        from print_elapsed_time import print_elapsed_time, start_timer
+        from common.StageProfiler import StageProfiler
 
         output = context.output
 
         print('Starting MEArec generate templates')
-        start_timer()
+        profiler = StageProfiler('mearec_generate_templates')
 
         home_dir = os.path.expanduser('~')
         cell_models_folder = f'{home_dir}/.config/mearec/{mr.__version__}/cell_models/bbp'
@@ -41,30 +41,175 @@ class MearecGenerateTemplatesProcessor(ProcessorBase):
             **context.drift.dict()
         }
 
-        print('Generating templates')
-        tempgen = mr.gen_templates(
-            cell_models_folder=cell_models_folder,
-            params=params,
-            templates_tmp_folder=None,
-            intraonly=False,
-            parallel=True,
-            recompile=False,
-            n_jobs=None,
-            delete_tmp=True,
-            verbose=False
-        )
-        print_elapsed_time()
+        with profiler.stage('generate'):
+            if context.cache.enabled or context.shard_count > 1:
+                from TemplateCache import TemplateCache
+                from gen_templates_cached import gen_templates_cached
+                if context.cache.enabled:
+                    cache_folder = context.cache.cache_folder or f'{home_dir}/.cache/mearec_templates'
+                    print(f'Using template cache: {cache_folder}')
+                    cache = TemplateCache(cache_folder, max_size_gb=context.cache.max_size_gb)
+                else:
+                    cache = None
+                print('Generating templates')
+                tempgen = gen_templates_cached(
+                    cell_models_folder=cell_models_folder,
+                    params=params,
+                    cache=cache,
+                    shard_index=context.shard_index,
+                    shard_count=context.shard_count,
+                    n_jobs=None,
+                    verbose=False
+                )
+            else:
+                print('Generating templates')
+                tempgen = mr.gen_templates(
+                    cell_models_folder=cell_models_folder,
+                    params=params,
+                    templates_tmp_folder=None,
+                    intraonly=False,
+                    parallel=True,
+                    recompile=False,
+                    n_jobs=None,
+                    delete_tmp=True,
+                    verbose=False
+                )
+
+        with profiler.stage('write'):
+            print('Saving template generator')
+            output_fname = 'output.templates.h5'
+            mr.save_template_generator(tempgen, output_fname)
+
+        with profiler.stage('upload'):
+            print('Uploading output file')
+            output.upload(output_fname)
+
+        profiler.print_summary()
+        if not os.path.exists('output'):
+            os.mkdir('output')
+        profiler.write_json('output/profile.json')
+
+class MearecMergeTemplatesProcessor(ProcessorBase):
+    name = 'mearec_merge_templates'
+    label = 'MEArec merge templates'
+    description = 'Merge the outputs of a sharded mearec_generate_templates run into a single template generator'
+    tags = ['spike_sorting', 'mearec_merge_templates']
+    attributes = {
+    }
+
+    @staticmethod
+    def run(context: MearecMergeTemplatesContext):
+        import MEArec as mr
+        from common.StageProfiler import StageProfiler
+        from merge_template_generators import merge_template_generators
+
+        print('Starting MEArec merge templates')
+        profiler = StageProfiler('mearec_merge_templates')
+
+        if len(context.inputs) == 0:
+            raise Exception('No inputs')
+
+        with profiler.stage('open'):
+            template_fnames = []
+            for ii, inp in enumerate(context.inputs):
+                print(f'Downloading input file {ii + 1} of {len(context.inputs)}')
+                fname = f'shard_{ii}.templates.h5'
+                inp.download(fname)
+                template_fnames.append(fname)
 
-        print('Saving template generator')
-        output_fname = 'output.templates.h5'
-        mr.save_template_generator(tempgen, output_fname)
-        print_elapsed_time()
+        with profiler.stage('combine'):
+            print('Merging templates')
+            tempgen = merge_template_generators(template_fnames)
+            print(f'Num. templates: {len(tempgen.templates)}')
 
-        print('Uploading output file')
-        output.upload(output_fname)
-        print_elapsed_time()
+        with profiler.stage('write'):
+            print('Saving template generator')
+            output_fname = 'output.templates.h5'
+            mr.save_template_generator(tempgen, output_fname)
+
+        with profiler.stage('upload'):
+            print('Uploading output file')
+            context.output.upload(output_fname)
+
+        profiler.print_summary()
+        if not os.path.exists('output'):
+            os.mkdir('output')
+        profiler.write_json('output/profile.json')
+
+class MearecGenerateRecordingProcessor(ProcessorBase):
+    name = 'mearec_generate_recording'
+    label = 'MEArec generate recording'
+    description = 'Generate a ground-truth recording from MEArec templates and write it to an NWB file'
+    tags = ['spike_sorting', 'mearec_generate_recording']
+    attributes = {
+    }
+
+    @staticmethod
+    def run(context: MearecGenerateRecordingContext):
+        from common.StageProfiler import StageProfiler
+        from generate_recording_nwb import generate_recording_nwb
+
+        print('Starting MEArec generate recording')
+        profiler = StageProfiler('mearec_generate_recording')
+
+        with profiler.stage('open'):
+            print('Downloading templates')
+            templates_fname = 'input.templates.h5'
+            context.templates.download(templates_fname)
+
+        with profiler.stage('generate'):
+            print('Generating recording')
+            output_fname = 'output.nwb'
+            generate_recording_nwb(
+                templates_fname=templates_fname,
+                output_fname=output_fname,
+                duration_sec=context.duration_sec,
+                sampling_frequency=context.sampling_frequency,
+                num_units=context.num_units,
+                min_firing_rate_hz=context.min_firing_rate_hz,
+                max_firing_rate_hz=context.max_firing_rate_hz,
+                refractory_period_ms=context.refractory_period_ms,
+                min_amplitude_uv=context.min_amplitude_uv,
+                min_distance_um=context.min_distance_um,
+                noise_level_uv=context.noise_level_uv,
+                gain_to_uv=context.gain_to_uv,
+                chunk_duration_sec=context.chunk_duration_sec,
+                n_jobs=context.n_jobs,
+                seed=context.seed
+            )
+
+        with profiler.stage('upload'):
+            print('Uploading output file')
+            context.output.upload(output_fname)
+
+        profiler.print_summary()
+        if not os.path.exists('output'):
+            os.mkdir('output')
+        profiler.write_json('output/profile.json')
 
 app.add_processor(MearecGenerateTemplatesProcessor)
+app.add_processor(MearecMergeTemplatesProcessor)
+app.add_processor(MearecGenerateRecordingProcessor)
 
 if __name__ == '__main__':
-    app.run()
+    if os.environ.get('WARM_WORKER_JOBS', None) is not None:
+        # run many local jobs in this process (see common/run_warm_worker.py)
+        from common.run_warm_worker import run_warm_worker
+        run_warm_worker(
+            processors=[MearecGenerateTemplatesProcessor, MearecMergeTemplatesProcessor, MearecGenerateRecordingProcessor],
+            preload_modules=[
+                'numpy',
+                'scipy.signal',
+                'h5py',
+                'pynwb',
+                'MEArec',
+                'MEAutility',
+                'common.StageProfiler',
+                'generate_recording_nwb',
+                'merge_template_generators'
+            ],
+            jobs=os.environ['WARM_WORKER_JOBS'],
+            work_dir=os.environ.get('WARM_WORKER_DIR', 'warm_worker_jobs')
+        )
+    else:
+        app.run()
@@ -0,0 +1,59 @@
+from typing import List
+import numpy as np
+
+
+_shard_keys = ['shard_index', 'shard_count', 'templates_folder']
+
+def merge_template_generators(template_fnames: List[str]):
+    """
+    Concatenate the .templates.h5 outputs of a sharded mearec_generate_templates run into a single
+    template generator. Templates are ordered by cell model as in an unsharded run.
+    """
+    import MEArec as mr
+
+    tempgens = [mr.load_templates(fname, return_h5_objects=False) for fname in template_fnames]
+
+    params0 = tempgens[0].info['params']
+    shard_count = int(params0.get('shard_count', 1))
+    shard_indices = sorted([int(tg.info['params'].get('shard_index', 0)) for tg in tempgens])
+    if shard_indices != list(range(shard_count)):
+        raise Exception(f'Expected exactly one input for each of the {shard_count} shards. Got shard indices: {shard_indices}')
+    for tg in tempgens[1:]:
+        for k in set(params0.keys()) | set(tg.info['params'].keys()):
+            if k in _shard_keys:
+                continue
+            if _normalize(params0.get(k, None)) != _normalize(tg.info['params'].get(k, None)):
+                raise Exception(f'Parameter {k} differs between shards')
+
+    templates = np.concatenate([tg.templates for tg in tempgens if len(tg.templates) > 0], axis=0)
+    locations = np.concatenate([tg.locations for tg in tempgens if len(tg.locations) > 0], axis=0)
+    rotations = np.concatenate([tg.rotations for tg in tempgens if len(tg.rotations) > 0], axis=0)
+    celltypes = np.concatenate([tg.celltypes for tg in tempgens if len(tg.celltypes) > 0], axis=0)
+
+    # MEArec aggregates templates in the sorted order of the eap-<cell model>.npy files
+    sort_inds = np.argsort(np.array([f'eap-{c}.npy' for c in celltypes]), kind='stable')
+
+    params = {k: v for k, v in params0.items() if k not in ['shard_index', 'shard_count']}
+    return mr.TemplateGenerator(
+        temp_dict={
+            'templates': templates[sort_inds],
+            'locations': locations[sort_inds],
+            'rotations': rotations[sort_inds],
+            'celltypes': celltypes[sort_inds]
+        },
+        info={
+            **tempgens[0].info,
+            'params': params
+        }
+    )
+
+def _normalize(v):
+    if isinstance(v, np.ndarray):
+        return [_normalize(x) for x in v.tolist()]
+    if isinstance(v, (list, tuple)):
+        return [_normalize(x) for x in v]
+    if isinstance(v, dict):
+        return {k: _normalize(x) for k, x in v.items()}
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
@@ -1,5 +1,5 @@
 from typing import List, Optional
-from dendro.sdk import BaseModel, Field, OutputFile
+from dendro.sdk import BaseModel, Field, InputFile, OutputFile
 
 
 class IntracellularSettings(BaseModel):
@@ -21,7 +21,7 @@ class ExtracellularSettings(BaseModel):
     zlim: Optional[List[int]] = Field(default=None, description='limits ( low high ) for neuron locations in the z-axis')
     det_thresh: float = Field(default=30, description='detection threshold for EAPs')
     n: int = Field(default=50, description='number of EAPs per cell model')
-    seed: Optional[int] = Field(default=None, description='random seed for positions and rotations')
+    seed: Optional[int] = Field(default=None, description='random seed for positions and rotations (if not set, a random seed is drawn for each run, so the cached extracellular templates are not reused)')
 
 class DriftingSettings(BaseModel):
     drifting: bool = Field(default=False, description='if True, drifting templates are simulated')
@@ -32,8 +32,37 @@ class DriftingSettings(BaseModel):
     drift_y_lim: List[int] = Field(default=[-10, 10], description='drift limits in the y-direction')
     drift_z_lim: List[int] = Field(default=[20, 80], description='drift limits in the z-direction')
 
+class TemplateCacheSettings(BaseModel):
+    enabled: bool = Field(default=True, description='If True, intracellular simulations and extracellular templates are cached locally and reused across runs')
+    cache_folder: str = Field(default='', description='Folder for the template cache (empty means ~/.cache/mearec_templates)')
+    max_size_gb: float = Field(default=20, description='Maximum size of the template cache in GB. Least recently used entries are evicted beyond this size')
+
 class MearecGenerateTemplatesContext(BaseModel):
     output: OutputFile = Field(description='Output .templates.h5 file')
     intracellular: IntracellularSettings = Field(description='Intracellular simulation settings')
     extracellular: ExtracellularSettings = Field(description='Extracellular simulation settings')
     drift: DriftingSettings = Field(description='Drifting settings')
+    cache: TemplateCacheSettings = Field(description='Template cache settings')
+    shard_index: int = Field(default=0, description='Index of the shard of cell models to simulate (0 <= shard_index < shard_count)')
+    shard_count: int = Field(default=1, description='Number of shards the cell models are split into. Use mearec_merge_templates to combine the shard outputs. A seed must be specified when shard_count > 1')
+
+class MearecMergeTemplatesContext(BaseModel):
+    inputs: List[InputFile] = Field(description='The .templates.h5 files generated by the shards of a sharded mearec_generate_templates run')
+    output: OutputFile = Field(description='Output .templates.h5 file')
+
+class MearecGenerateRecordingContext(BaseModel):
+    templates: InputFile = Field(description='Input .templates.h5 file')
+    output: OutputFile = Field(description='Output .nwb file with the recording and the ground-truth units')
+    duration_sec: float = Field(default=600, description='Duration of the recording in seconds')
+    sampling_frequency: float = Field(default=30000, description='Sampling frequency in Hz (templates are resampled if needed)')
+    num_units: int = Field(default=20, description='Number of ground-truth units')
+    min_firing_rate_hz: float = Field(default=1, description='Minimum firing rate of the units in Hz')
+    max_firing_rate_hz: float = Field(default=15, description='Maximum firing rate of the units in Hz')
+    refractory_period_ms: float = Field(default=2, description='Refractory period of the units in ms')
+    min_amplitude_uv: float = Field(default=50, description='Minimum peak-to-peak amplitude of the selected templates in uV')
+    min_distance_um: float = Field(default=25, description='Minimum distance between the selected neurons in um')
+    noise_level_uv: float = Field(default=10, description='Standard deviation of the additive gaussian noise in uV')
+    gain_to_uv: float = Field(default=0.195, description='Scale of the stored int16 samples in uV')
+    chunk_duration_sec: float = Field(default=10, description='Duration of the chunks that are generated in parallel and streamed to the output')
+    n_jobs: int = Field(default=0, description='Number of worker processes (0 means all CPUs)')
+    seed: int = Field(default=0, description='Random seed')
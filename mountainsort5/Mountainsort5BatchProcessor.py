@@ -0,0 +1,265 @@
+import os
+import json
+import shutil
+from dendro.sdk import ProcessorBase
+from models import Mountainsort5BatchProcessorContext
+
+
+class Mountainsort5BatchProcessor(ProcessorBase):
+    name = 'mountainsort5_batch'
+    label = 'MountainSort 5 batch'
+    description = 'Sort many NWB files (and several electrical series per file) with MountainSort 5 in a single job, on a local process pool'
+    tags = ['spike_sorting', 'mountainsort5']
+    attributes = {
+        'wip': True
+    }
+
+    @staticmethod
+    def run(context: Mountainsort5BatchProcessorContext):
+        import h5py
+        import pynwb
+        from common.NwbRecording import NwbRecording
+        from common.create_sorting_out_nwb_file import create_sorting_out_nwb_file
+        from common.StageProfiler import StageProfiler
+        from common.open_input_file import open_input_file
+        from common.BatchScheduler import BatchScheduler
+        from common.BinaryRecordingCache import BinaryRecordingCache
+        from common.get_available_memory_bytes import get_available_memory_bytes
+
+        print('Starting mountainsort5 batch processor')
+        profiler = StageProfiler('mountainsort5_batch')
+
+        if len(context.inputs) == 0:
+            raise Exception('No inputs')
+        if len(context.electrical_series_paths) == 0:
+            raise Exception('No electrical series paths')
+
+        binary_cache = BinaryRecordingCache(context.binary_cache_dir or 'binary_cache')
+        bytes_per_sample = 2 if context.preprocessing.scratch_dtype == 'int16' else 4
+
+        # one task per (input, electrical series); identical tasks (same input listed twice) are sorted once
+        with profiler.stage('open'):
+            input_files = []
+            tasks = []
+            task_index_by_key = {}
+            input_task_indices = []
+            planning_errors = {}
+            for ii, inp in enumerate(context.inputs):
+                print(f'Opening input {ii + 1} of {len(context.inputs)}')
+                input_file = open_input_file(inp, label=f'input_{ii}')
+                input_files.append(input_file)
+                task_indices = []
+                for electrical_series_path in context.electrical_series_paths:
+                    key = BinaryRecordingCache.get_key({
+                        'input': _get_input_identity(inp),
+                        'electrical_series_path': electrical_series_path,
+                        'preprocessing': context.preprocessing.dict(),
+                        'test_duration_sec': context.test_duration_sec
+                    })
+                    if key not in task_index_by_key:
+                        try:
+                            recording = NwbRecording(file=input_file, electrical_series_path=electrical_series_path)
+                        except Exception as e: # noqa
+                            # e.g., a session without this electrical series; the other inputs are still sorted
+                            print(f'Error opening {electrical_series_path} in input {ii}: {e}')
+                            planning_errors.setdefault(ii, []).append(f'{electrical_series_path}: {e}')
+                            continue
+                        num_frames = recording.get_num_frames()
+                        if context.test_duration_sec > 0:
+                            num_frames = min(num_frames, int(recording.get_sampling_frequency() * context.test_duration_sec))
+                        task_index_by_key[key] = len(tasks)
+                        tasks.append({
+                            'label': f'input {ii} {electrical_series_path}',
+                            'key': key,
+                            'kwargs': {
+                                'stage_name': f'input_{ii}_' + electrical_series_path.strip('/').replace('/', '_'),
+                                'inp': inp,
+                                'electrical_series_path': electrical_series_path,
+                                'context': context,
+                                'cache_dir': binary_cache.cache_dir,
+                                'key': key
+                            },
+                            'memory_bytes': _estimate_memory_bytes(
+                                num_frames=num_frames,
+                                num_channels=recording.get_num_channels(),
+                                sampling_frequency=recording.get_sampling_frequency(),
+                                context=context
+                            ),
+                            # nothing new is written when the binary is already in the cache
+                            # (with scratch_compression, this is an upper bound)
+                            'disk_bytes': num_frames * recording.get_num_channels() * bytes_per_sample if binary_cache.get(key) is None else 0
+                        })
+                    task_indices.append(task_index_by_key[key])
+                input_task_indices.append(task_indices)
+
+        memory_budget_bytes = int(context.memory_budget_gb * 1e9) if context.memory_budget_gb > 0 else int(get_available_memory_bytes() * 0.8)
+        # the binaries already in the cache directory are part of the disk budget
+        disk_budget_bytes = int(context.disk_budget_gb * 1e9) if context.disk_budget_gb > 0 else int((shutil.disk_usage(binary_cache.cache_dir).free + binary_cache.get_total_size()) * 0.8)
+        print(f'Sorting {len(tasks)} recordings with {context.max_workers} workers, {memory_budget_bytes / 1e9:.1f} GB memory budget and {disk_budget_bytes / 1e9:.1f} GB disk budget')
+
+        unfinished = set(range(len(tasks)))
+
+        def evict_binary_cache():
+            # the binaries kept in the cache directory, plus what the unfinished tasks may still
+            # write, must fit in the disk budget; the least recently used binaries are removed first
+            cached_keys = set(binary_cache.get_keys())
+            pending_disk_bytes = sum(tasks[j]['disk_bytes'] for j in unfinished if tasks[j]['key'] not in cached_keys)
+            removed = binary_cache.evict(max_bytes=max(disk_budget_bytes - pending_disk_bytes, 0), keep=[tasks[j]['key'] for j in unfinished])
+            for key in removed:
+                print(f'Removed cached binary recording {key} to stay within the disk budget')
+
+        def on_done(i: int, result):
+            unfinished.discard(i)
+            if context.binary_cache_dir:
+                evict_binary_cache()
+            else:
+                # without a persistent cache directory, a binary is only needed until it is sorted
+                binary_cache.remove(tasks[i]['key'])
+
+        if context.binary_cache_dir:
+            evict_binary_cache()
+
+        with profiler.stage('sort'):
+            scheduler = BatchScheduler(max_workers=context.max_workers, max_memory_bytes=memory_budget_bytes, max_disk_bytes=disk_budget_bytes)
+            results = scheduler.run(_sort_recording, tasks, on_done=on_done)
+
+        with profiler.stage('write'):
+            output_dirname = 'batch_output'
+            if os.path.exists(output_dirname):
+                shutil.rmtree(output_dirname)
+            os.mkdir(output_dirname)
+            manifest = []
+            for ii, inp in enumerate(context.inputs):
+                item = {
+                    'input_index': ii,
+                    'input': _get_input_identity(inp),
+                    'electrical_series_paths': context.electrical_series_paths,
+                    'output': None,
+                    'num_units': None,
+                    'errors': planning_errors.get(ii, []) + [str(results[j]) for j in input_task_indices[ii] if isinstance(results[j], BaseException)]
+                }
+                manifest.append(item)
+                if len(item['errors']) > 0:
+                    continue
+                print(f'Writing output NWB file for input {ii + 1} of {len(context.inputs)}')
+                sorting, electrical_series_column = _combine_sortings([results[j] for j in input_task_indices[ii]], electrical_series_paths=context.electrical_series_paths)
+                h5_file = h5py.File(input_files[ii], 'r')
+                with pynwb.NWBHDF5IO(file=h5_file, mode='r', load_namespaces=True) as io:
+                    nwbfile_rec = io.read()
+                    sorting_out_fname = f'sorting_{ii}.nwb'
+                    create_sorting_out_nwb_file(
+                        nwbfile_rec=nwbfile_rec,
+                        sorting=sorting,
+                        sorting_out_fname=f'{output_dirname}/{sorting_out_fname}',
+                        unit_columns=[{'name': 'electrical_series_path', 'description': 'Electrical series that the unit was sorted from', 'data': electrical_series_column}]
+                    )
+                item['output'] = sorting_out_fname
+                item['num_units'] = len(sorting.get_unit_ids())
+            with open(f'{output_dirname}/batch_manifest.json', 'w') as f:
+                json.dump(manifest, f, indent=2)
+
+        with profiler.stage('upload'):
+            print('Uploading output folder')
+            context.output.upload(output_dirname)
+
+        for input_file in input_files:
+            profiler.record_io(input_file.get_summary())
+        scheme_choices = []
+        for r in results:
+            if not isinstance(r, BaseException):
+                profiler.stages.extend(r['stages'])
+                scheme_choices.extend(r['scheme_choices'])
+        if len(scheme_choices) > 0:
+            profiler.record_metadata('scheme_choices', scheme_choices)
+        profiler.print_summary()
+        profiler.write_json('output/profile.json')
+
+        failed = [m for m in manifest if len(m['errors']) > 0]
+        if len(failed) > 0:
+            raise Exception(f'Sorting failed for {len(failed)} of {len(manifest)} inputs: ' + '; '.join(f'input {m["input_index"]}: {m["errors"][0]}' for m in failed))
+
+def _sort_recording(*, stage_name: str, inp, electrical_series_path: str, context: Mountainsort5BatchProcessorContext, cache_dir: str, key: str) -> dict:
+    # runs in a worker process
+    from common.NwbRecording import NwbRecording
+    from common.make_scratch_recording import make_scratch_recording
+    from common.StageProfiler import StageProfiler
+    from common.open_input_file import open_input_file
+    from common.preprocess_for_mountainsort5 import preprocess_for_mountainsort5
+    from common.run_mountainsort5_sorting import run_mountainsort5_sorting
+    from common.BinaryRecordingCache import BinaryRecordingCache
+
+    profiler = StageProfiler(stage_name)
+    binary_cache = BinaryRecordingCache(cache_dir)
+    scheme_choices = []
+
+    def make_binary(dirname: str):
+        with profiler.stage('open'):
+            recording = NwbRecording(
+                file=open_input_file(inp),
+                electrical_series_path=electrical_series_path
+            )
+            if context.test_duration_sec > 0:
+                recording = recording.frame_slice(0, min(recording.get_num_frames(), int(recording.get_sampling_frequency() * context.test_duration_sec)))
+        with profiler.stage('preprocess'):
+            recording_preprocessed = preprocess_for_mountainsort5(recording, preprocessing=context.preprocessing)
+        num_samples = recording.get_num_frames() * recording.get_num_channels()
+        with profiler.stage('convert', num_samples=num_samples, num_bytes=num_samples * 4):
+            return make_scratch_recording(recording_preprocessed, dirname=dirname, dtype=context.preprocessing.scratch_dtype, compression=context.preprocessing.scratch_compression)
+
+    with profiler.stage(stage_name):
+        recording_binary = binary_cache.get_or_create(key, make_binary)
+        num_samples = recording_binary.get_num_frames() * recording_binary.get_num_channels()
+        with profiler.stage('sort', num_samples=num_samples, num_bytes=num_samples * 4):
+            sorting = run_mountainsort5_sorting(recording=recording_binary, context=context, scheme_choices=scheme_choices)
+    return {
+        'sampling_frequency': sorting.get_sampling_frequency(),
+        'units': {unit_id: sorting.get_unit_spike_train(unit_id) for unit_id in sorting.get_unit_ids()},
+        'stages': profiler.stages,
+        'scheme_choices': [{**c, 'stage_name': stage_name} for c in scheme_choices]
+    }
+
+def _get_input_identity(inp) -> str:
+    # the url of a dendro input may be a signed url that changes between jobs
+    if inp.local_file_name is not None:
+        return os.path.abspath(inp.local_file_name)
+    if inp.url is not None:
+        return inp.url
+    return inp.get_project_file_uri()
+
+def _estimate_memory_bytes(*, num_frames: int, num_channels: int, sampling_frequency: float, context: Mountainsort5BatchProcessorContext) -> int:
+    duration_sec = num_frames / sampling_frequency
+    # the converter processes 20 second chunks (filtered and whitened copies)
+    conversion_sec = min(duration_sec, 20) * 3
+    # scheme 1 loads the whole recording; scheme 2 loads the training data; scheme 3 sorts blocks with scheme 2
+    # (auto chooses a scheme that fits in the memory available when it runs, so it is estimated as scheme 2)
+    if context.scheme == 1:
+        sorting_sec = duration_sec
+    elif context.scheme in [0, 2]:
+        sorting_sec = min(duration_sec, context.scheme2.scheme2_training_duration_sec)
+    else:
+        sorting_sec = min(duration_sec, context.scheme3_block_duration_sec, context.scheme2.scheme2_training_duration_sec)
+    # float32 traces, with a factor 2 for the snippets and features
+    return int((conversion_sec + sorting_sec * 2) * sampling_frequency * num_channels * 4)
+
+def _combine_sortings(results, *, electrical_series_paths):
+    units = {}
+    electrical_series_column = []
+    for r, electrical_series_path in zip(results, electrical_series_paths):
+        for unit_id, spike_train in r['units'].items():
+            units[len(units) + 1] = spike_train
+            electrical_series_column.append(electrical_series_path)
+    return _numpy_sorting_from_dict([units], sampling_frequency=results[0]['sampling_frequency']), electrical_series_column
+
+def _numpy_sorting_from_dict(units_dict_list, *, sampling_frequency):
+    import spikeinterface as si
+    try:
+        # different versions of spikeinterface
+        # see: https://github.com/SpikeInterface/spikeinterface/issues/2083
+        sorting = si.NumpySorting.from_dict(
+            units_dict_list, sampling_frequency=sampling_frequency # type: ignore
+        )
+    except: # noqa
+        sorting = si.NumpySorting.from_unit_dict(
+            units_dict_list, sampling_frequency=sampling_frequency # type: ignore
+        )
+    return sorting
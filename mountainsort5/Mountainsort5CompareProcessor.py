@@ -0,0 +1,185 @@
+import os
+import json
+import math
+import shutil
+from dendro.sdk import ProcessorBase
+from models import Mountainsort5CompareProcessorContext, Mountainsort5SortingParameters
+
+
+# the fields of the context that are passed to run_mountainsort5_sorting
+SORTING_FIELDS = list(Mountainsort5SortingParameters.model_fields.keys())
+
+class Mountainsort5CompareProcessor(ProcessorBase):
+    name = 'mountainsort5_compare'
+    label = 'MountainSort 5 build comparison'
+    description = 'Sort an electrical series with two builds of MountainSort 5 on the same preprocessed recording and compare their runtime, peak memory and units'
+    tags = ['spike_sorting', 'mountainsort5']
+    attributes = {
+        'wip': True
+    }
+
+    @staticmethod
+    def run(context: Mountainsort5CompareProcessorContext):
+        import h5py
+        import pynwb
+        import spikeinterface.comparison as sc
+        from common.NwbRecording import NwbRecording
+        from common.create_sorting_out_nwb_file import create_sorting_out_nwb_file
+        from common.make_scratch_recording import make_scratch_recording
+        from common.StageProfiler import StageProfiler
+        from common.open_input_file import open_input_file
+        from common.preprocess_for_mountainsort5 import preprocess_for_mountainsort5
+        from common.BinaryRecordingCache import BinaryRecordingCache
+        from common.run_mountainsort5_subprocess import run_mountainsort5_subprocess
+
+        print('Starting mountainsort5 compare processor')
+        if context.build_a_path == context.build_b_path:
+            raise Exception(f'Build A and build B are the same build: {context.build_a_path or "installed mountainsort5"}')
+        for build_path in [context.build_a_path, context.build_b_path]:
+            # otherwise the subprocess would silently import the installed mountainsort5
+            if build_path and not os.path.isdir(os.path.join(build_path, 'mountainsort5')):
+                raise Exception(f'No mountainsort5 package in {build_path}')
+        profiler = StageProfiler('mountainsort5_compare')
+
+        with profiler.stage('open'):
+            print('Opening input file')
+            input_file = open_input_file(context.input)
+
+            print('Creating input recording')
+            recording = NwbRecording(
+                file=input_file,
+                electrical_series_path=context.electrical_series_path
+            )
+
+            if context.test_duration_sec > 0:
+                recording = recording.frame_slice(0, int(recording.get_sampling_frequency() * context.test_duration_sec))
+        num_samples = recording.get_num_frames() * recording.get_num_channels()
+
+        # preprocessed once for both builds
+        binary_cache = BinaryRecordingCache('binary_cache')
+        key = 'preprocessed_recording'
+
+        def make_binary(dirname: str):
+            with profiler.stage('preprocess'):
+                recording_preprocessed = preprocess_for_mountainsort5(recording, preprocessing=context.preprocessing)
+            with profiler.stage('convert', num_samples=num_samples, num_bytes=num_samples * 4):
+                print('Creating binary recording')
+                return make_scratch_recording(recording_preprocessed, dirname=dirname, dtype=context.preprocessing.scratch_dtype, compression=context.preprocessing.scratch_compression)
+        binary_cache.remove(key)
+        recording_binary = binary_cache.get_or_create(key, make_binary)
+
+        sorting_parameters = context.model_dump(include=set(SORTING_FIELDS))
+        if context.scheme == 0:
+            # chosen once, so that both builds sort with the same parameters
+            from common.choose_mountainsort5_scheme import choose_mountainsort5_scheme
+            choice = choose_mountainsort5_scheme(recording_binary, context=context)
+            print(f'Auto scheme: scheme {choice["scheme"]} ({choice["reason"]})')
+            sorting_parameters['scheme'] = choice['scheme']
+            if choice['scheme2_training_duration_sec'] is not None:
+                sorting_parameters['scheme2']['scheme2_training_duration_sec'] = int(math.ceil(choice['scheme2_training_duration_sec']))
+            if choice['scheme3_block_duration_sec'] is not None:
+                sorting_parameters['scheme3_block_duration_sec'] = choice['scheme3_block_duration_sec']
+            profiler.record_metadata('scheme_choices', [choice])
+
+        # one build at a time, so that the runtime and peak memory of each are measured in isolation
+        results = {}
+        for build, build_path in [('a', context.build_a_path), ('b', context.build_b_path)]:
+            num_samples = recording_binary.get_num_frames() * recording_binary.get_num_channels()
+            with profiler.stage(f'sort_{build}', num_samples=num_samples, num_bytes=num_samples * 4):
+                print(f'Sorting with build {build} ({build_path or "installed mountainsort5"})')
+                results[build] = run_mountainsort5_subprocess(
+                    cache_dir=binary_cache.cache_dir,
+                    key=key,
+                    sorting_parameters=sorting_parameters,
+                    output_dir=f'sort_{build}',
+                    mountainsort5_path=build_path or None
+                )
+        binary_cache.remove(key)
+
+        with profiler.stage('compare'):
+            sorting_a = results['a']['sorting']
+            sorting_b = results['b']['sorting']
+            comparison = sc.compare_two_sorters(sorting_a, sorting_b, sorting1_name='a', sorting2_name='b', delta_time=context.match_delta_msec)
+            units = []
+            num_matched_spikes = 0
+            for unit_id in sorting_a.get_unit_ids():
+                matched_unit_id = comparison.hungarian_match_12[unit_id]
+                num_spikes = len(sorting_a.get_unit_spike_train(unit_id))
+                if matched_unit_id == -1:
+                    units.append({'unit_id_a': int(unit_id), 'unit_id_b': None, 'num_spikes_a': num_spikes, 'num_spikes_b': None, 'num_matched_spikes': 0, 'agreement': 0})
+                    continue
+                n = int(comparison.match_event_count.at[unit_id, matched_unit_id])
+                num_matched_spikes += n
+                units.append({
+                    'unit_id_a': int(unit_id),
+                    'unit_id_b': int(matched_unit_id),
+                    'num_spikes_a': num_spikes,
+                    'num_spikes_b': len(sorting_b.get_unit_spike_train(matched_unit_id)),
+                    'num_matched_spikes': n,
+                    'agreement': float(comparison.agreement_scores.at[unit_id, matched_unit_id])
+                })
+            num_spikes_a = sum(len(sorting_a.get_unit_spike_train(u)) for u in sorting_a.get_unit_ids())
+            num_spikes_b = sum(len(sorting_b.get_unit_spike_train(u)) for u in sorting_b.get_unit_ids())
+            report = {
+                'sorting_parameters': sorting_parameters,
+                'match_delta_msec': context.match_delta_msec,
+                'builds': {
+                    build: {
+                        'path': r['mountainsort5_path'],
+                        'version': r['mountainsort5_version'],
+                        'num_units': len(r['unit_ids']),
+                        'sort_time_sec': r['sort_time_sec'],
+                        'process_time_sec': r['process_time_sec'],
+                        'peak_rss_mb': r['peak_rss_mb']
+                    }
+                    for build, r in results.items()
+                },
+                'num_matched_units': len([u for u in units if u['unit_id_b'] is not None]),
+                # the fraction of the spikes of each sorting that are in matched units and matched in time
+                'matched_spike_fraction_a': num_matched_spikes / num_spikes_a if num_spikes_a > 0 else None,
+                'matched_spike_fraction_b': num_matched_spikes / num_spikes_b if num_spikes_b > 0 else None,
+                'units': units
+            }
+            _print_report(report)
+
+        with profiler.stage('write'):
+            output_dirname = 'compare_output'
+            if os.path.exists(output_dirname):
+                shutil.rmtree(output_dirname)
+            os.mkdir(output_dirname)
+            h5_file = h5py.File(input_file, 'r')
+            with pynwb.NWBHDF5IO(file=h5_file, mode='r', load_namespaces=True) as io:
+                nwbfile_rec = io.read()
+                for build in ['a', 'b']:
+                    print(f'Writing output NWB file for build {build}')
+                    create_sorting_out_nwb_file(
+                        nwbfile_rec=nwbfile_rec,
+                        sorting=results[build]['sorting'],
+                        sorting_out_fname=f'{output_dirname}/sorting_{build}.nwb'
+                    )
+            with open(f'{output_dirname}/comparison.json', 'w') as f:
+                json.dump(report, f, indent=2)
+
+        with profiler.stage('upload'):
+            print('Uploading output folder')
+            context.output.upload(output_dirname)
+
+        input_file.print_summary()
+        profiler.record_io(input_file.get_summary())
+        profiler.record_metadata('comparison', {k: v for k, v in report.items() if k != 'units'})
+        profiler.print_summary()
+        profiler.write_json('output/profile.json')
+
+def _print_report(report: dict):
+    print('Comparison:')
+    for build, b in report['builds'].items():
+        print(f'  build {build}: mountainsort5 {b["version"]} ({b["path"]}): {b["num_units"]} units, {b["sort_time_sec"]:.1f} s sorting, {b["peak_rss_mb"]:.0f} MB peak RSS')
+    print(f'  {report["num_matched_units"]} matched units; matched spike fraction: {_format_fraction(report["matched_spike_fraction_a"])} of build a, {_format_fraction(report["matched_spike_fraction_b"])} of build b')
+    for u in report['units']:
+        if u['unit_id_b'] is None:
+            print(f'  unit {u["unit_id_a"]} of a ({u["num_spikes_a"]} spikes): no match')
+        else:
+            print(f'  unit {u["unit_id_a"]} of a ({u["num_spikes_a"]} spikes) ~ unit {u["unit_id_b"]} of b ({u["num_spikes_b"]} spikes): agreement {u["agreement"]:.3f}')
+
+def _format_fraction(x):
+    return f'{x:.3f}' if x is not None else 'n/a'
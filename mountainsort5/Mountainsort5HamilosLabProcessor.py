@@ -14,138 +14,149 @@ class Mountainsort5HamilosLabProcessor(ProcessorBase):
     def run(context: Mountainsort5ProcessorContext):
         import h5py
         import pynwb
-        import mountainsort5 as ms5
         import spikeinterface as si
         import spikeinterface.preprocessing as spre
         from common.NwbRecording import NwbRecording
-        from common.make_float32_recording import make_float32_recording
+        from common.make_scratch_recording import make_scratch_recording
         from common._scale_recording_if_float_type import _scale_recording_if_float_type
+        from common.plan_chunk_size import plan_chunk_size
         from common.create_sorting_out_nwb_file import create_sorting_out_nwb_file
-        from common.print_elapsed_time import print_elapsed_time, start_timer
+        from common.StageProfiler import StageProfiler
+        from common.open_input_file import open_input_file
+        from common.select_channel_groups import select_channel_groups
+        from common.run_mountainsort5_sorting import run_mountainsort5_sorting
+        from common.ChannelHealthStats import ChannelHealthStats
+        from common.PreviewWindows import PreviewWindows
 
         print('Starting MountainSort5 Hamilos lab processor')
-        start_timer()
+        profiler = StageProfiler('mountainsort5-hamiloslab')
 
-        print('Creating input recording')
-        recording = NwbRecording(
-            file=context.input.get_file(),
-            electrical_series_path=context.electrical_series_path
-        )
-        print_elapsed_time()
+        if context.window_duration_sec > 0:
+            # the groups are whitened from the binary of the whole filtered recording
+            raise Exception('Windowed mode is not supported by the Hamilos lab processor')
 
-        if context.test_duration_sec > 0:
-            recording = recording.frame_slice(0, int(recording.get_sampling_frequency() * context.test_duration_sec))
+        with profiler.stage('open'):
+            print('Opening input file')
+            input_file = open_input_file(context.input)
 
-        # bandpass filter
-        if context.preprocessing.filter:
-            print('Filtering on')
-            recording_filtered = spre.bandpass_filter(recording, freq_min=context.preprocessing.freq_min, freq_max=context.preprocessing.freq_max, dtype=np.float32) # important to specify dtype here
-        else:
-            print('Filtering off')
-            recording_filtered = recording
+            print('Creating input recording')
+            recording = NwbRecording(
+                file=input_file,
+                electrical_series_path=context.electrical_series_path
+            )
+
+            if context.test_duration_sec > 0:
+                recording = recording.frame_slice(0, int(recording.get_sampling_frequency() * context.test_duration_sec))
+
+            # only the channels of the selected groups are read from the input file
+            recording = select_channel_groups(recording, channel_groups=context.channel_groups)
+
+            # a quick look: windows spread across the session instead of the whole recording
+            preview_windows = PreviewWindows(recording, num_windows=context.preview_num_windows, window_duration_sec=context.preview_window_duration_sec) if context.preview_num_windows > 0 else None
+        num_frames = preview_windows.get_num_frames() if preview_windows is not None else recording.get_num_frames()
+        num_samples = num_frames * recording.get_num_channels()
 
-        print('Creating binary recording')
-        recording_binary = make_float32_recording(recording_filtered, dirname='float32_recording')
-        print_elapsed_time()
+        # statistics accumulated while the recording is converted
+        channel_health_stats = ChannelHealthStats(recording)
+
+        # bandpass filter
+        with profiler.stage('preprocess'):
+            if context.preprocessing.filter:
+                print('Filtering on')
+                recording_filtered = spre.bandpass_filter(channel_health_stats.recording, freq_min=context.preprocessing.freq_min, freq_max=context.preprocessing.freq_max, dtype=np.float32) # important to specify dtype here
+            else:
+                print('Filtering off')
+                recording_filtered = channel_health_stats.recording
+            if preview_windows is not None:
+                recording_filtered = preview_windows.concatenate(recording_filtered)
+
+        with profiler.stage('convert', num_samples=num_samples, num_bytes=num_samples * 4):
+            print('Creating binary recording')
+            recording_binary = make_scratch_recording(recording_filtered, dirname='filtered_recording', dtype=context.preprocessing.scratch_dtype, compression=context.preprocessing.scratch_compression, channel_health_stats=channel_health_stats)
+        bad_channels = channel_health_stats.get_bad_channels()
+        channel_health_stats.print_summary(bad_channels)
+        # the groups are whitened after the conversion, so the bad channels can be left out of the whitening
+        excluded_channels = bad_channels if context.exclude_bad_channels else {}
 
         channel_groups = recording.get_channel_groups() # get this from recording, not recording_binary
         unique_channel_groups = sorted(list(set(channel_groups)))
         print(f'Channel groups: {unique_channel_groups}')
 
         sortings = []
+        sorted_channel_groups = []
+        scheme_choices = []
         for group in unique_channel_groups:
             print(f'Processing group {group}')
-            channel_ids_in_group = [ch for ch in recording.get_channel_ids() if recording.get_channel_property(ch, 'group') == group] # get this from recording, not recording_binary
+            channel_ids_in_group = [ch for ch in recording.get_channel_ids() if recording.get_channel_property(ch, 'group') == group and ch not in excluded_channels] # get this from recording, not recording_binary
             print(f'Channels: {channel_ids_in_group}')
+            if len(channel_ids_in_group) == 0:
+                print(f'Skipping group {group}: all channels were excluded')
+                continue
             recording_group = recording_binary.channel_slice(channel_ids=channel_ids_in_group)
-
-            # whiten
-            if context.preprocessing.whiten:
-                print('Whitening on')
-                # see comment below in _scale_recording_if_float_type
-                recording_scaled = _scale_recording_if_float_type(recording_group)
-                recording_group_preprocessed: si.BaseRecording = spre.whiten(
-                    recording_scaled,
-                    dtype='float32',
-                    num_chunks_per_segment=1, # by default this is 20 which takes a long time to load depending on the chunking
-                    chunk_size=int(1e5)
-                )
-            else:
-                print('Whitening off')
-                recording_group_preprocessed = recording_group
-
-            recording_group_preprocessed = make_float32_recording(recording_group_preprocessed, dirname=f'preprocessed_recording_group_{group}')
-
-            print('Setting up sorting parameters')
-            scheme1_sorting_parameters = ms5.Scheme1SortingParameters(
-                detect_threshold=context.detect_threshold,
-                detect_channel_radius=context.scheme1_detect_channel_radius,
-                detect_time_radius_msec=context.detect_time_radius_msec,
-                detect_sign=context.detect_sign,
-                snippet_T1=context.snippet_T1,
-                snippet_T2=context.snippet_T2,
-                snippet_mask_radius=context.snippet_mask_radius,
-                npca_per_channel=context.npca_per_channel,
-                npca_per_subdivision=context.npca_per_subdivision
-            )
-
-            scheme2_sorting_parameters = ms5.Scheme2SortingParameters(
-                phase1_detect_channel_radius=context.scheme2.scheme2_phase1_detect_channel_radius,
-                detect_channel_radius=context.scheme2.scheme2_detect_channel_radius,
-                phase1_detect_threshold=context.detect_threshold,
-                phase1_detect_time_radius_msec=context.detect_time_radius_msec,
-                detect_time_radius_msec=context.detect_time_radius_msec,
-                phase1_npca_per_channel=context.npca_per_channel,
-                phase1_npca_per_subdivision=context.npca_per_subdivision,
-                detect_sign=context.detect_sign,
-                detect_threshold=context.detect_threshold,
-                snippet_T1=context.snippet_T1,
-                snippet_T2=context.snippet_T2,
-                snippet_mask_radius=context.snippet_mask_radius,
-                max_num_snippets_per_training_batch=context.scheme2.scheme2_max_num_snippets_per_training_batch,
-                classifier_npca=None,
-                training_duration_sec=context.scheme2.scheme2_training_duration_sec,
-                training_recording_sampling_mode=context.scheme2.scheme2_training_recording_sampling_mode # type: ignore
-            )
-
-            scheme3_sorting_parameters = ms5.Scheme3SortingParameters(
-                block_sorting_parameters=scheme2_sorting_parameters, block_duration_sec=context.scheme3_block_duration_sec
-            )
-
-            if context.scheme == 1:
-                print('Sorting scheme 1')
-                sorting = ms5.sorting_scheme1(recording=recording_group_preprocessed, sorting_parameters=scheme1_sorting_parameters)
-            elif context.scheme == 2:
-                print('Sorting scheme 2')
-                sorting = ms5.sorting_scheme2(recording=recording_group_preprocessed, sorting_parameters=scheme2_sorting_parameters)
-            elif context.scheme == 3:
-                print('Sorting scheme 3')
-                sorting = ms5.sorting_scheme3(recording=recording_group_preprocessed, sorting_parameters=scheme3_sorting_parameters)
-            else:
-                raise ValueError(f'Unexpected scheme: {context.scheme}')
-            print_elapsed_time()
+            num_samples_group = recording_group.get_num_frames() * recording_group.get_num_channels()
+
+            with profiler.stage(f'group_{group}'):
+                # whiten
+                with profiler.stage('preprocess', num_samples=num_samples_group, num_bytes=num_samples_group * 4):
+                    if context.preprocessing.whiten:
+                        print('Whitening on')
+                        # see comment below in _scale_recording_if_float_type
+                        recording_scaled = _scale_recording_if_float_type(recording_group)
+                        recording_group_preprocessed: si.BaseRecording = spre.whiten(
+                            recording_scaled,
+                            dtype='float32',
+                            num_chunks_per_segment=1, # by default this is 20 which takes a long time to load depending on the chunking
+                            chunk_size=plan_chunk_size(recording_scaled, target_duration_sec=int(1e5) / recording_scaled.get_sampling_frequency())
+                        )
+                    else:
+                        print('Whitening off')
+                        recording_group_preprocessed = recording_group
+
+                    recording_group_preprocessed = make_scratch_recording(recording_group_preprocessed, dirname=f'preprocessed_recording_group_{group}', dtype=context.preprocessing.scratch_dtype, compression=context.preprocessing.scratch_compression)
+
+                with profiler.stage('sort', num_samples=num_samples_group, num_bytes=num_samples_group * 4):
+                    # the concatenated windows of a preview are short, so there is nothing to gain from the blocks of scheme 3
+                    sorting = run_mountainsort5_sorting(recording=recording_group_preprocessed, context=context.model_copy(update={'scheme': 2}) if preview_windows is not None and context.scheme == 3 else context, scheme_choices=scheme_choices)
 
             sortings.append(sorting)
+            sorted_channel_groups.append(group)
+
+        with profiler.stage('combine'):
+            print('Combining sortings')
+            if len(sortings) == 0:
+                raise Exception('All channels were excluded')
+            sorting = _combine_sortings(sortings, group_ids=sorted_channel_groups)
+            if preview_windows is not None:
+                sorting = preview_windows.map_sorting(sorting)
+        if len(scheme_choices) > 0:
+            profiler.record_metadata('scheme_choices', scheme_choices)
+
+        with profiler.stage('write'):
+            print('Writing output NWB file')
+            h5_file = h5py.File(input_file, 'r')
+            with pynwb.NWBHDF5IO(file=h5_file, mode='r', load_namespaces=True) as io:
+                nwbfile_rec = io.read()
+
+                if not os.path.exists('output'):
+                    os.mkdir('output')
+                sorting_out_fname = 'output/sorting.nwb'
+
+                create_sorting_out_nwb_file(
+                    nwbfile_rec=nwbfile_rec,
+                    sorting=sorting,
+                    sorting_out_fname=sorting_out_fname,
+                    channel_health={**channel_health_stats.get_stats(), 'flagged': bad_channels, 'excluded': list(excluded_channels)},
+                    preview_intervals_sec=preview_windows.get_intervals_sec() if preview_windows is not None else None
+                )
 
-        print('Combining sortings')
-        sorting = _combine_sortings(sortings, group_ids=unique_channel_groups)
-        print_elapsed_time()
-
-        print('Writing output NWB file')
-        h5_file = h5py.File(context.input.get_file(), 'r')
-        with pynwb.NWBHDF5IO(file=h5_file, mode='r', load_namespaces=True) as io:
-            nwbfile_rec = io.read()
-
-            if not os.path.exists('output'):
-                os.mkdir('output')
-            sorting_out_fname = 'output/sorting.nwb'
-
-            create_sorting_out_nwb_file(nwbfile_rec=nwbfile_rec, sorting=sorting, sorting_out_fname=sorting_out_fname)
-        print_elapsed_time()
+        with profiler.stage('upload'):
+            print('Uploading output NWB file')
+            context.output.upload(sorting_out_fname)
 
-        print('Uploading output NWB file')
-        context.output.upload(sorting_out_fname)
-        print_elapsed_time()
+        input_file.print_summary()
+        profiler.record_io(input_file.get_summary())
+        profiler.print_summary()
+        profiler.write_json('output/profile.json')
 
 def _combine_sortings(sortings, group_ids):
     from typing import Dict
@@ -0,0 +1,227 @@
+import os
+import json
+import shutil
+import itertools
+from dendro.sdk import ProcessorBase
+from models import Mountainsort5SweepProcessorContext
+
+
+# context field swept -> field of Mountainsort5SweepProcessorContext with its values
+SWEEP_FIELDS = {
+    'scheme': 'sweep_scheme',
+    'detect_threshold': 'sweep_detect_threshold',
+    'snippet_T1': 'sweep_snippet_T1',
+    'snippet_T2': 'sweep_snippet_T2',
+    'npca_per_channel': 'sweep_npca_per_channel'
+}
+
+class Mountainsort5SweepProcessor(ProcessorBase):
+    name = 'mountainsort5_sweep'
+    label = 'MountainSort 5 parameter sweep'
+    description = 'Sort an electrical series with MountainSort 5 for each configuration of a grid of sorting parameters, preprocessing the recording once for all of the configurations'
+    tags = ['spike_sorting', 'mountainsort5']
+    attributes = {
+        'wip': True
+    }
+
+    @staticmethod
+    def run(context: Mountainsort5SweepProcessorContext):
+        import h5py
+        import pynwb
+        from common.NwbRecording import NwbRecording
+        from common.create_sorting_out_nwb_file import create_sorting_out_nwb_file
+        from common.make_scratch_recording import make_scratch_recording
+        from common.StageProfiler import StageProfiler
+        from common.open_input_file import open_input_file
+        from common.preprocess_for_mountainsort5 import preprocess_for_mountainsort5
+        from common.BatchScheduler import BatchScheduler
+        from common.BinaryRecordingCache import BinaryRecordingCache
+        from common.get_available_memory_bytes import get_available_memory_bytes
+        from Mountainsort5BatchProcessor import _get_input_identity, _estimate_memory_bytes
+
+        print('Starting mountainsort5 sweep processor')
+        profiler = StageProfiler('mountainsort5_sweep')
+
+        # the grid: every combination of the swept values (the value in the context when a field is not swept)
+        swept_values = {
+            k: getattr(context, v) if len(getattr(context, v)) > 0 else [getattr(context, k)]
+            for k, v in SWEEP_FIELDS.items()
+        }
+        configurations = [dict(zip(swept_values.keys(), values)) for values in itertools.product(*swept_values.values())]
+        print(f'Sweeping {len(configurations)} configurations')
+
+        binary_cache = BinaryRecordingCache(context.binary_cache_dir or 'binary_cache')
+        key = BinaryRecordingCache.get_key({
+            'input': _get_input_identity(context.input),
+            'electrical_series_path': context.electrical_series_path,
+            'preprocessing': context.preprocessing.dict(),
+            'test_duration_sec': context.test_duration_sec
+        })
+
+        with profiler.stage('open'):
+            print('Opening input file')
+            input_file = open_input_file(context.input)
+
+            print('Creating input recording')
+            recording = NwbRecording(
+                file=input_file,
+                electrical_series_path=context.electrical_series_path
+            )
+
+            if context.test_duration_sec > 0:
+                recording = recording.frame_slice(0, int(recording.get_sampling_frequency() * context.test_duration_sec))
+        num_samples = recording.get_num_frames() * recording.get_num_channels()
+
+        # preprocessed once for all of the configurations
+        def make_binary(dirname: str):
+            with profiler.stage('preprocess'):
+                recording_preprocessed = preprocess_for_mountainsort5(recording, preprocessing=context.preprocessing)
+            with profiler.stage('convert', num_samples=num_samples, num_bytes=num_samples * 4):
+                print('Creating binary recording')
+                return make_scratch_recording(recording_preprocessed, dirname=dirname, dtype=context.preprocessing.scratch_dtype, compression=context.preprocessing.scratch_compression)
+        recording_binary = binary_cache.get_or_create(key, make_binary)
+
+        tasks = []
+        for i, configuration in enumerate(configurations):
+            configuration_context = context.model_copy(update=configuration)
+            tasks.append({
+                'label': f'configuration {i} ({_describe_configuration(configuration)})',
+                'kwargs': {
+                    'stage_name': f'configuration_{i}',
+                    'context': configuration_context,
+                    'cache_dir': binary_cache.cache_dir,
+                    'key': key
+                },
+                'memory_bytes': _estimate_memory_bytes(
+                    num_frames=recording_binary.get_num_frames(),
+                    num_channels=recording_binary.get_num_channels(),
+                    sampling_frequency=recording_binary.get_sampling_frequency(),
+                    context=configuration_context
+                ),
+                # the binary is shared
+                'disk_bytes': 0
+            })
+
+        memory_budget_bytes = int(context.memory_budget_gb * 1e9) if context.memory_budget_gb > 0 else int(get_available_memory_bytes() * 0.8)
+        print(f'Sorting {len(tasks)} configurations with {context.max_workers} workers and {memory_budget_bytes / 1e9:.1f} GB memory budget')
+
+        with profiler.stage('sort'):
+            scheduler = BatchScheduler(max_workers=context.max_workers, max_memory_bytes=memory_budget_bytes, max_disk_bytes=0)
+            results = scheduler.run(_sort_configuration, tasks)
+        if not context.binary_cache_dir:
+            binary_cache.remove(key)
+
+        with profiler.stage('write'):
+            output_dirname = 'sweep_output'
+            if os.path.exists(output_dirname):
+                shutil.rmtree(output_dirname)
+            os.mkdir(output_dirname)
+            summary = []
+            h5_file = h5py.File(input_file, 'r')
+            with pynwb.NWBHDF5IO(file=h5_file, mode='r', load_namespaces=True) as io:
+                nwbfile_rec = io.read()
+                for i, (configuration, r) in enumerate(zip(configurations, results)):
+                    item = {
+                        'index': i,
+                        **configuration,
+                        'output': None,
+                        'num_units': None,
+                        'num_spikes': None,
+                        'sort_time_sec': None,
+                        'peak_rss_mb': None,
+                        'error': None
+                    }
+                    summary.append(item)
+                    if isinstance(r, BaseException):
+                        item['error'] = str(r)
+                        continue
+                    print(f'Writing output NWB file for configuration {i + 1} of {len(configurations)}')
+                    sorting = _numpy_sorting_from_dict([r['units']], sampling_frequency=r['sampling_frequency'])
+                    sorting_out_fname = f'sorting_{i}.nwb'
+                    create_sorting_out_nwb_file(
+                        nwbfile_rec=nwbfile_rec,
+                        sorting=sorting,
+                        sorting_out_fname=f'{output_dirname}/{sorting_out_fname}'
+                    )
+                    sort_stage = [s for s in r['stages'] if s['name'] == f'configuration_{i}/sort'][0]
+                    item['output'] = sorting_out_fname
+                    item['num_units'] = len(r['units'])
+                    item['num_spikes'] = int(sum(len(v) for v in r['units'].values()))
+                    item['sort_time_sec'] = sort_stage['wall_time_sec']
+                    item['peak_rss_mb'] = sort_stage['peak_rss_mb']
+            with open(f'{output_dirname}/sweep_summary.json', 'w') as f:
+                json.dump(summary, f, indent=2)
+            columns = list(summary[0].keys())
+            with open(f'{output_dirname}/sweep_summary.tsv', 'w') as f:
+                f.write('\t'.join(columns) + '\n')
+                for item in summary:
+                    f.write('\t'.join('' if item[c] is None else str(item[c]) for c in columns) + '\n')
+            _print_summary(summary)
+
+        with profiler.stage('upload'):
+            print('Uploading output folder')
+            context.output.upload(output_dirname)
+
+        input_file.print_summary()
+        profiler.record_io(input_file.get_summary())
+        scheme_choices = []
+        for r in results:
+            if not isinstance(r, BaseException):
+                profiler.stages.extend(r['stages'])
+                scheme_choices.extend(r['scheme_choices'])
+        if len(scheme_choices) > 0:
+            profiler.record_metadata('scheme_choices', scheme_choices)
+        profiler.print_summary()
+        profiler.write_json('output/profile.json')
+
+        failed = [item for item in summary if item['error'] is not None]
+        if len(failed) == len(summary):
+            raise Exception(f'Sorting failed for all {len(summary)} configurations: {failed[0]["error"]}')
+
+def _sort_configuration(*, stage_name: str, context: Mountainsort5SweepProcessorContext, cache_dir: str, key: str) -> dict:
+    # runs in a worker process
+    from common.StageProfiler import StageProfiler
+    from common.run_mountainsort5_sorting import run_mountainsort5_sorting
+    from common.BinaryRecordingCache import BinaryRecordingCache
+
+    profiler = StageProfiler(stage_name)
+    scheme_choices = []
+    recording_binary = BinaryRecordingCache(cache_dir).get(key)
+    if recording_binary is None:
+        raise Exception(f'Binary recording not found in cache: {key}')
+    with profiler.stage(stage_name):
+        num_samples = recording_binary.get_num_frames() * recording_binary.get_num_channels()
+        with profiler.stage('sort', num_samples=num_samples, num_bytes=num_samples * 4):
+            sorting = run_mountainsort5_sorting(recording=recording_binary, context=context, scheme_choices=scheme_choices)
+    return {
+        'sampling_frequency': sorting.get_sampling_frequency(),
+        'units': {unit_id: sorting.get_unit_spike_train(unit_id) for unit_id in sorting.get_unit_ids()},
+        'stages': profiler.stages,
+        'scheme_choices': [{**c, 'stage_name': stage_name} for c in scheme_choices]
+    }
+
+def _describe_configuration(configuration: dict) -> str:
+    return ', '.join(f'{k}={v}' for k, v in configuration.items())
+
+def _print_summary(summary: list):
+    print('Sweep summary:')
+    for item in summary:
+        configuration = {k: item[k] for k in SWEEP_FIELDS}
+        if item['error'] is not None:
+            print(f'  {item["index"]}: {_describe_configuration(configuration)}: error: {item["error"]}')
+        else:
+            print(f'  {item["index"]}: {_describe_configuration(configuration)}: {item["num_units"]} units, {item["num_spikes"]} spikes, {item["sort_time_sec"]:.1f} s, {item["peak_rss_mb"]:.0f} MB peak RSS')
+
+def _numpy_sorting_from_dict(units_dict_list, *, sampling_frequency):
+    import spikeinterface as si
+    try:
+        # different versions of spikeinterface
+        # see: https://github.com/SpikeInterface/spikeinterface/issues/2083
+        sorting = si.NumpySorting.from_dict(
+            units_dict_list, sampling_frequency=sampling_frequency # type: ignore
+        )
+    except: # noqa
+        sorting = si.NumpySorting.from_unit_dict(
+            units_dict_list, sampling_frequency=sampling_frequency # type: ignore
+        )
+    return sorting
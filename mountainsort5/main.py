@@ -3,6 +3,9 @@
 import os
 from dendro.sdk import App, ProcessorBase
 from Mountainsort5HamilosLabProcessor import Mountainsort5HamilosLabProcessor
+from Mountainsort5BatchProcessor import Mountainsort5BatchProcessor
+from Mountainsort5SweepProcessor import Mountainsort5SweepProcessor
+from Mountainsort5CompareProcessor import Mountainsort5CompareProcessor
 from models import Mountainsort5ProcessorContext
 
 
@@ -30,130 +33,185 @@ class Mountainsort5Processor(ProcessorBase):
     @staticmethod
     def run(context: Mountainsort5ProcessorContext):
         import h5py
-        import spikeinterface as si
         import pynwb
         from common.NwbRecording import NwbRecording
         from common.create_sorting_out_nwb_file import create_sorting_out_nwb_file
-        import spikeinterface.preprocessing as spre
-        import mountainsort5 as ms5
-        from common.make_float32_recording import make_float32_recording
-        from common.print_elapsed_time import print_elapsed_time, start_timer
-        from common._scale_recording_if_float_type import _scale_recording_if_float_type
+        from common.make_scratch_recording import make_scratch_recording
+        from common.StageProfiler import StageProfiler
+        from common.open_input_file import open_input_file
+        from common.select_channel_groups import select_channel_groups
+        from common.preprocess_for_mountainsort5 import preprocess_for_mountainsort5
+        from common.run_mountainsort5_sorting import run_mountainsort5_sorting
+        from common.ChannelHealthStats import ChannelHealthStats
+        from common.PreviewWindows import PreviewWindows
+        from common.run_windowed_mountainsort5_sorting import run_windowed_mountainsort5_sorting
 
         input = context.input
         output = context.output
 
         print('Starting mountainsort5 processor')
-        start_timer()
+        profiler = StageProfiler('mountainsort5')
 
-        print('Creating input recording')
-        recording = NwbRecording(
-            file=context.input.get_file(),
-            electrical_series_path=context.electrical_series_path
-        )
-        print_elapsed_time()
-
-        if context.test_duration_sec > 0:
-            recording = recording.frame_slice(0, int(recording.get_sampling_frequency() * context.test_duration_sec))
+        with profiler.stage('open'):
+            print('Opening input file')
+            input_file = open_input_file(input)
 
-        # Make sure the recording is preprocessed appropriately
-        # lazy preprocessing
-        if context.preprocessing.filter:
-            print('Filtering on')
-            recording_filtered = spre.bandpass_filter(recording, freq_min=context.preprocessing.freq_min, freq_max=context.preprocessing.freq_max)
-        else:
-            print('Filtering off')
-            recording_filtered = recording
-        if context.preprocessing.whiten:
-            print('Whitening on')
-            # see comment below in _scale_recording_if_float_type
-            recording_scaled = _scale_recording_if_float_type(recording_filtered)
-            recording_preprocessed: si.BaseRecording = spre.whiten(
-                recording_scaled,
-                dtype='float32',
-                num_chunks_per_segment=1, # by default this is 20 which takes a long time to load depending on the chunking
-                chunk_size=int(1e5)
+            print('Creating input recording')
+            recording = NwbRecording(
+                file=input_file,
+                electrical_series_path=context.electrical_series_path
             )
-        else:
-            print('Whitening off')
-            recording_preprocessed = recording_filtered
-        print_elapsed_time()
-
-        # Maybe sometime in the future we will spike sort while lazy loading
-        # but for now we're going to download the entire recording to disk first.
-        # Probably lazy loading in a smart way would be in order for scheme 3
-        # at some point in the future.
-        print('Creating binary recording')
-        recording_binary = make_float32_recording(recording_preprocessed, dirname='preprocessed_recording')
-        print_elapsed_time()
-
-        print('Setting up sorting parameters')
-        scheme1_sorting_parameters = ms5.Scheme1SortingParameters(
-            detect_threshold=context.detect_threshold,
-            detect_channel_radius=context.scheme1_detect_channel_radius,
-            detect_time_radius_msec=context.detect_time_radius_msec,
-            detect_sign=context.detect_sign,
-            snippet_T1=context.snippet_T1,
-            snippet_T2=context.snippet_T2,
-            snippet_mask_radius=context.snippet_mask_radius,
-            npca_per_channel=context.npca_per_channel,
-            npca_per_subdivision=context.npca_per_subdivision
-        )
-
-        scheme2_sorting_parameters = ms5.Scheme2SortingParameters(
-            phase1_detect_channel_radius=context.scheme2.scheme2_phase1_detect_channel_radius,
-            detect_channel_radius=context.scheme2.scheme2_detect_channel_radius,
-            phase1_detect_threshold=context.detect_threshold,
-            phase1_detect_time_radius_msec=context.detect_time_radius_msec,
-            detect_time_radius_msec=context.detect_time_radius_msec,
-            phase1_npca_per_channel=context.npca_per_channel,
-            phase1_npca_per_subdivision=context.npca_per_subdivision,
-            detect_sign=context.detect_sign,
-            detect_threshold=context.detect_threshold,
-            snippet_T1=context.snippet_T1,
-            snippet_T2=context.snippet_T2,
-            snippet_mask_radius=context.snippet_mask_radius,
-            max_num_snippets_per_training_batch=context.scheme2.scheme2_max_num_snippets_per_training_batch,
-            classifier_npca=None,
-            training_duration_sec=context.scheme2.scheme2_training_duration_sec,
-            training_recording_sampling_mode=context.scheme2.scheme2_training_recording_sampling_mode # type: ignore
-        )
 
-        scheme3_sorting_parameters = ms5.Scheme3SortingParameters(
-            block_sorting_parameters=scheme2_sorting_parameters, block_duration_sec=context.scheme3_block_duration_sec
-        )
-
-        if context.scheme == 1:
-            print('Sorting scheme 1')
-            sorting = ms5.sorting_scheme1(recording=recording_binary, sorting_parameters=scheme1_sorting_parameters)
-        elif context.scheme == 2:
-            print('Sorting scheme 2')
-            sorting = ms5.sorting_scheme2(recording=recording_binary, sorting_parameters=scheme2_sorting_parameters)
-        elif context.scheme == 3:
-            print('Sorting scheme 3')
-            sorting = ms5.sorting_scheme3(recording=recording_binary, sorting_parameters=scheme3_sorting_parameters)
+            if context.test_duration_sec > 0:
+                recording = recording.frame_slice(0, int(recording.get_sampling_frequency() * context.test_duration_sec))
+
+            # only the channels of the selected groups are read from the input file
+            recording = select_channel_groups(recording, channel_groups=context.channel_groups)
+
+            # a quick look: windows spread across the session instead of the whole recording
+            preview_windows = PreviewWindows(recording, num_windows=context.preview_num_windows, window_duration_sec=context.preview_window_duration_sec) if context.preview_num_windows > 0 else None
+        num_frames = preview_windows.get_num_frames() if preview_windows is not None else recording.get_num_frames()
+        num_samples = num_frames * recording.get_num_channels()
+
+        # statistics accumulated while the recording is converted
+        channel_health_stats = ChannelHealthStats(recording)
+
+        scheme_choices = []
+        if context.window_duration_sec > 0:
+            if context.exclude_bad_channels or preview_windows is not None:
+                raise Exception('Windowed mode cannot be combined with exclude_bad_channels or preview mode')
+            with profiler.stage('preprocess'):
+                recording_preprocessed = preprocess_for_mountainsort5(channel_health_stats.recording, preprocessing=context.preprocessing)
+            # each window is converted and sorted in turn instead of the whole recording
+            with profiler.stage('windows', num_samples=num_samples, num_bytes=num_samples * 4):
+                sorting = run_windowed_mountainsort5_sorting(
+                    recording=recording_preprocessed,
+                    context=context,
+                    window_duration_sec=context.window_duration_sec,
+                    window_overlap_sec=context.window_overlap_sec,
+                    link_threshold=context.window_link_threshold,
+                    dirname='preprocessed_windows',
+                    profiler=profiler,
+                    channel_health_stats=channel_health_stats,
+                    scheme_choices=scheme_choices
+                )
+            bad_channels = channel_health_stats.get_bad_channels()
+            channel_health_stats.print_summary(bad_channels)
+            excluded_channels = {}
+        elif not context.exclude_bad_channels:
+            # Make sure the recording is preprocessed appropriately
+            # lazy preprocessing
+            with profiler.stage('preprocess'):
+                recording_preprocessed = preprocess_for_mountainsort5(channel_health_stats.recording, preprocessing=context.preprocessing, preview_windows=preview_windows)
+
+            # Maybe sometime in the future we will spike sort while lazy loading
+            # but for now we're going to download the entire recording to disk first.
+            # Probably lazy loading in a smart way would be in order for scheme 3
+            # at some point in the future.
+            with profiler.stage('convert', num_samples=num_samples, num_bytes=num_samples * 4):
+                print('Creating binary recording')
+                recording_binary = make_scratch_recording(recording_preprocessed, dirname='preprocessed_recording', dtype=context.preprocessing.scratch_dtype, compression=context.preprocessing.scratch_compression, channel_health_stats=channel_health_stats)
+            bad_channels = channel_health_stats.get_bad_channels()
+            channel_health_stats.print_summary(bad_channels)
+            # flagged only: the whitening was estimated with all the channels
+            excluded_channels = {}
         else:
-            raise ValueError(f'Unexpected scheme: {context.scheme}')
-        print_elapsed_time()
-
-        print('Writing output NWB file')
-        h5_file = h5py.File(input.get_file(), 'r')
-        with pynwb.NWBHDF5IO(file=h5_file, mode='r', load_namespaces=True) as io:
-            nwbfile_rec = io.read()
-
-            if not os.path.exists('output'):
-                os.mkdir('output')
-            sorting_out_fname = 'output/sorting.nwb'
-
-            create_sorting_out_nwb_file(nwbfile_rec=nwbfile_rec, sorting=sorting, sorting_out_fname=sorting_out_fname)
-        print_elapsed_time()
-
-        print('Uploading output NWB file')
-        output.upload(sorting_out_fname)
-        print_elapsed_time()
+            # the bad channels are only known after the conversion pass, and they must not
+            # contribute to the whitening, so whiten after the conversion of the filtered recording
+            with profiler.stage('preprocess'):
+                recording_filtered = preprocess_for_mountainsort5(channel_health_stats.recording, preprocessing=context.preprocessing.model_copy(update={'whiten': False}), preview_windows=preview_windows)
+            with profiler.stage('convert', num_samples=num_samples, num_bytes=num_samples * 4):
+                print('Creating binary recording')
+                recording_filtered_binary = make_scratch_recording(recording_filtered, dirname='filtered_recording', dtype=context.preprocessing.scratch_dtype, compression=context.preprocessing.scratch_compression, channel_health_stats=channel_health_stats)
+            bad_channels = channel_health_stats.get_bad_channels()
+            channel_health_stats.print_summary(bad_channels)
+            excluded_channels = bad_channels
+            good_channel_ids = [ch for ch in recording.get_channel_ids() if ch not in excluded_channels]
+            if len(good_channel_ids) == 0:
+                raise Exception('All channels were flagged as bad')
+            print(f'Excluding {len(excluded_channels)} of {recording.get_num_channels()} channels')
+            num_samples_good = num_frames * len(good_channel_ids)
+            with profiler.stage('whiten', num_samples=num_samples_good, num_bytes=num_samples_good * 4):
+                recording_preprocessed = preprocess_for_mountainsort5(
+                    recording_filtered_binary.channel_slice(channel_ids=good_channel_ids),
+                    preprocessing=context.preprocessing.model_copy(update={'filter': False})
+                )
+                recording_binary = make_scratch_recording(recording_preprocessed, dirname='preprocessed_recording', dtype=context.preprocessing.scratch_dtype, compression=context.preprocessing.scratch_compression)
+            num_samples = num_samples_good
+
+        if context.window_duration_sec <= 0:
+            with profiler.stage('sort', num_samples=num_samples, num_bytes=num_samples * 4):
+                if preview_windows is None:
+                    sorting = run_mountainsort5_sorting(recording=recording_binary, context=context, scheme_choices=scheme_choices)
+                else:
+                    # the concatenated windows are short, so there is nothing to gain from the blocks of scheme 3
+                    sorting = run_mountainsort5_sorting(recording=recording_binary, context=context.model_copy(update={'scheme': 2}) if context.scheme == 3 else context, scheme_choices=scheme_choices)
+                    sorting = preview_windows.map_sorting(sorting)
+        if len(scheme_choices) > 0:
+            profiler.record_metadata('scheme_choices', scheme_choices)
+
+        with profiler.stage('write'):
+            print('Writing output NWB file')
+            h5_file = h5py.File(input_file, 'r')
+            with pynwb.NWBHDF5IO(file=h5_file, mode='r', load_namespaces=True) as io:
+                nwbfile_rec = io.read()
+
+                if not os.path.exists('output'):
+                    os.mkdir('output')
+                sorting_out_fname = 'output/sorting.nwb'
+
+                create_sorting_out_nwb_file(
+                    nwbfile_rec=nwbfile_rec,
+                    sorting=sorting,
+                    sorting_out_fname=sorting_out_fname,
+                    channel_health={**channel_health_stats.get_stats(), 'flagged': bad_channels, 'excluded': list(excluded_channels)},
+                    preview_intervals_sec=preview_windows.get_intervals_sec() if preview_windows is not None else None
+                )
+
+        with profiler.stage('upload'):
+            print('Uploading output NWB file')
+            output.upload(sorting_out_fname)
+
+        input_file.print_summary()
+        profiler.record_io(input_file.get_summary())
+        profiler.print_summary()
+        profiler.write_json('output/profile.json')
 
 app.add_processor(Mountainsort5Processor)
 app.add_processor(Mountainsort5HamilosLabProcessor)
+app.add_processor(Mountainsort5BatchProcessor)
+app.add_processor(Mountainsort5SweepProcessor)
+app.add_processor(Mountainsort5CompareProcessor)
 
 if __name__ == '__main__':
-    app.run()
+    if os.environ.get('WARM_WORKER_JOBS', None) is not None:
+        # run many local jobs in this process (see common/run_warm_worker.py)
+        from common.run_warm_worker import run_warm_worker
+        run_warm_worker(
+            processors=[Mountainsort5Processor, Mountainsort5HamilosLabProcessor, Mountainsort5BatchProcessor, Mountainsort5SweepProcessor, Mountainsort5CompareProcessor],
+            preload_modules=[
+                'numpy',
+                'h5py',
+                'pynwb',
+                'remfile',
+                'spikeinterface',
+                'spikeinterface.preprocessing',
+                'mountainsort5',
+                'common.NwbRecording',
+                'common.NwbSorting',
+                'common.create_sorting_out_nwb_file',
+                'common.StageProfiler',
+                'common.open_input_file',
+                'common.make_float32_recording',
+                'common.make_scratch_recording',
+                'common.make_compressed_recording',
+                'common.preprocess_for_mountainsort5',
+                'common.run_mountainsort5_sorting',
+                'common.BatchScheduler',
+                'common.BinaryRecordingCache'
+            ],
+            jobs=os.environ['WARM_WORKER_JOBS'],
+            work_dir=os.environ.get('WARM_WORKER_DIR', 'warm_worker_jobs')
+        )
+    else:
+        app.run()
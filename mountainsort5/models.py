@@ -1,4 +1,5 @@
-from dendro.sdk import BaseModel, Field, InputFile, OutputFile
+from typing import List
+from dendro.sdk import BaseModel, Field, InputFile, OutputFile, OutputFolder
 
 
 class Mountainsort5PreprocessingParameters(BaseModel):
@@ -6,6 +7,8 @@ class Mountainsort5PreprocessingParameters(BaseModel):
     freq_max: int = Field(default=6000, description='Low-pass filter cutoff frequency')
     filter: bool = Field(default=True, description='Enable or disable filter')
     whiten: bool = Field(default=True, description='Enable or disable whiten')
+    scratch_dtype: str = Field(default='float32', description='Data type of the intermediate binary recordings on the scratch disk: float32, or int16 with a gain per channel (half the size, dequantized when read)', json_schema_extra={'options': ['float32', 'int16']})
+    scratch_compression: str = Field(default='none', description='Compression of the intermediate recordings on the scratch disk: none (raw binary), or zstd (chunked, lossless, decompressed lazily when read) for slow, e.g., network attached, scratch', json_schema_extra={'options': ['none', 'zstd']})
 
 class Mountainsort5Scheme2SortingParameters(BaseModel):
     scheme2_phase1_detect_channel_radius: int = Field(default=200, description='Channel radius for excluding events that are too close in time during phase 1 of scheme 2')
@@ -14,11 +17,9 @@ class Mountainsort5Scheme2SortingParameters(BaseModel):
     scheme2_training_duration_sec: int = Field(default=60 * 5, description='Duration of training data to use in scheme 2')
     scheme2_training_recording_sampling_mode: str = Field(default='uniform', description='initial or uniform', json_schema_extra={'options': ['initial', 'uniform']})
 
-class Mountainsort5ProcessorContext(BaseModel):
-    input: InputFile = Field(description='Input NWB file')
-    output: OutputFile = Field(description='Output NWB file')
-    electrical_series_path: str = Field(description='Path to the electrical series in the NWB file, e.g., /acquisition/ElectricalSeries')
-    scheme: int = Field(default=2, description='Which sorting scheme to use: 1, 2, or 3', json_schema_extra={'options': [1, 2, 3]})
+# the parameters of run_mountainsort5_sorting, shared by the contexts of the processors
+class Mountainsort5SortingParameters(BaseModel):
+    scheme: int = Field(default=2, description='Which sorting scheme to use: 1, 2, or 3, or 0 (auto) to choose the scheme and the scheme 2 training and scheme 3 block durations from the estimated memory and runtime', json_schema_extra={'options': [0, 1, 2, 3]})
     detect_threshold: float = Field(default=5.5, description='Detection threshold - recommend to use the default')
     detect_sign: int = Field(default=-1, description='Use -1 for detecting negative peaks, 1 for positive, 0 for both', json_schema_extra={'options': [-1, 0, 1]})
     detect_time_radius_msec: float = Field(default=0.5, description='Determines the minimum allowable time interval between detected spikes in the same spatial region')
@@ -30,5 +31,51 @@ class Mountainsort5ProcessorContext(BaseModel):
     scheme1_detect_channel_radius: int = Field(default=150, description='Channel radius for excluding events that are too close in time in scheme 1')
     scheme2: Mountainsort5Scheme2SortingParameters = Field(description='Parameters for scheme 2') # indicate somehow that this is active only if scheme == 2 or 3
     scheme3_block_duration_sec: int = Field(default=60 * 30, description='Duration of each block in scheme 3') # indicate somehow that this is active only if scheme == 3
+
+# plus the parameters that are applied before the sorting
+class Mountainsort5Parameters(Mountainsort5SortingParameters):
     preprocessing: Mountainsort5PreprocessingParameters = Field(description='Preprocessing parameters')
     test_duration_sec: float = Field(default=0, description='For testing purposes: duration of the recording in seconds (0 means all)')
+
+class Mountainsort5ProcessorContext(Mountainsort5Parameters):
+    input: InputFile = Field(description='Input NWB file')
+    output: OutputFile = Field(description='Output NWB file')
+    electrical_series_path: str = Field(description='Path to the electrical series in the NWB file, e.g., /acquisition/ElectricalSeries')
+    channel_groups: List[int] = Field(default=[], description='Channel groups to sort (empty means all). Only the channels of these groups are read from the input file. The Hamilos lab processor sorts each group separately.')
+    exclude_bad_channels: bool = Field(default=False, description='Exclude the channels flagged by the channel health statistics (flat, saturated, dead or noisy) from whitening and sorting. The statistics are written to the output NWB file either way.')
+    preview_num_windows: int = Field(default=0, description='Preview mode: number of windows spread across the session that are sorted instead of the whole recording, with scheme 2 in place of scheme 3 (0 means off). The spike times refer to the original recording.')
+    preview_window_duration_sec: float = Field(default=10, description='Preview mode: duration of each window in seconds')
+    window_duration_sec: float = Field(default=0, description='Windowed mode for long (e.g., chronic) recordings: duration in seconds of the windows that are converted and sorted one at a time, so that at most two windows are on the scratch disk, with the units linked across windows by template similarity (0 means off)')
+    window_overlap_sec: float = Field(default=60, description='Windowed mode: overlap in seconds between consecutive windows')
+    window_link_threshold: float = Field(default=0.9, description='Windowed mode: minimum cosine similarity of the templates for a unit of a window to be linked to a unit of the earlier windows')
+
+class Mountainsort5BatchProcessorContext(Mountainsort5Parameters):
+    inputs: List[InputFile] = Field(description='Input NWB files')
+    output: OutputFolder = Field(description='Output folder with one sorting NWB file per input (sorting_<index>.nwb) and batch_manifest.json')
+    electrical_series_paths: List[str] = Field(default=['/acquisition/ElectricalSeries'], description='Paths to the electrical series to sort in each NWB file. Each series is sorted separately and the units of all series of an input are written to its output file, with an electrical_series_path column.')
+    max_workers: int = Field(default=2, description='Number of recordings sorted in parallel')
+    memory_budget_gb: float = Field(default=0, description='Estimated memory that the parallel sortings may use together (0 means 80% of the available memory)')
+    disk_budget_gb: float = Field(default=0, description='Disk space that the preprocessed binary recordings may use together, including those kept in binary_cache_dir (the least recently used are removed to stay within it; 0 means 80% of the free space)')
+    binary_cache_dir: str = Field(default='', description='Directory where the preprocessed binary recordings are kept and reused by later jobs with the same input, series and preprocessing (empty means they are deleted once sorted)')
+
+class Mountainsort5SweepProcessorContext(Mountainsort5Parameters):
+    input: InputFile = Field(description='Input NWB file')
+    output: OutputFolder = Field(description='Output folder with one sorting NWB file per configuration (sorting_<index>.nwb) and a summary table (sweep_summary.tsv and sweep_summary.json)')
+    electrical_series_path: str = Field(description='Path to the electrical series in the NWB file, e.g., /acquisition/ElectricalSeries')
+    sweep_scheme: List[int] = Field(default=[], description='Values of scheme to sweep (empty means only the value of scheme)')
+    sweep_detect_threshold: List[float] = Field(default=[], description='Values of detect_threshold to sweep (empty means only the value of detect_threshold)')
+    sweep_snippet_T1: List[int] = Field(default=[], description='Values of snippet_T1 to sweep (empty means only the value of snippet_T1)')
+    sweep_snippet_T2: List[int] = Field(default=[], description='Values of snippet_T2 to sweep (empty means only the value of snippet_T2)')
+    sweep_npca_per_channel: List[int] = Field(default=[], description='Values of npca_per_channel to sweep (empty means only the value of npca_per_channel)')
+    max_workers: int = Field(default=2, description='Number of configurations sorted in parallel')
+    memory_budget_gb: float = Field(default=0, description='Estimated memory that the parallel sortings may use together (0 means 80% of the available memory)')
+    binary_cache_dir: str = Field(default='', description='Directory where the preprocessed binary recording is kept and reused by later sweeps with the same input, series and preprocessing (empty means it is deleted at the end of the job)')
+
+class Mountainsort5CompareProcessorContext(Mountainsort5Parameters):
+    input: InputFile = Field(description='Input NWB file')
+    output: OutputFolder = Field(description='Output folder with the sorting of each build (sorting_a.nwb and sorting_b.nwb) and comparison.json')
+    electrical_series_path: str = Field(description='Path to the electrical series in the NWB file, e.g., /acquisition/ElectricalSeries')
+    build_a_path: str = Field(default='', description='Directory with the mountainsort5 package of build A, e.g., installed with pip install --target (empty means the mountainsort5 installed in the image)')
+    build_b_path: str = Field(default='/builds/mountainsort5_0.5.9', description='Directory with the mountainsort5 package of build B (empty means the mountainsort5 installed in the image). The image has mountainsort5 0.5.9 at /builds/mountainsort5_0.5.9, while the installed build is 0.3.3.')
+    match_delta_msec: float = Field(default=0.4, description='Maximum time difference for two spikes of the two sortings to be matched')
+    scheme: int = Field(default=2, description='Which sorting scheme to use: 1, 2, or 3, or 0 (auto) to choose the scheme and the scheme 2 training and scheme 3 block durations from the estimated memory and runtime (once, for both builds)', json_schema_extra={'options': [0, 1, 2, 3]})
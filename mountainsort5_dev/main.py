@@ -36,123 +36,159 @@ class Mountainsort5DevProcessor(ProcessorBase):
         import spikeinterface.preprocessing as spre
         import mountainsort5 as ms5
         from common.make_float32_recording import make_float32_recording
-        from common.print_elapsed_time import print_elapsed_time, start_timer
+        from common.StageProfiler import StageProfiler
+        from common.open_input_file import open_input_file
         from common._scale_recording_if_float_type import _scale_recording_if_float_type
+        from common.plan_chunk_size import plan_chunk_size
 
         input = context.input
         output = context.output
 
         print('Starting mountainsort5-dev processor')
-        start_timer()
+        profiler = StageProfiler('mountainsort5-dev')
 
-        print('Creating input recording')
-        recording = NwbRecording(
-            file=context.input.get_file(),
-            electrical_series_path=context.electrical_series_path
-        )
-        print_elapsed_time()
+        with profiler.stage('open'):
+            print('Opening input file')
+            input_file = open_input_file(input)
+
+            print('Creating input recording')
+            recording = NwbRecording(
+                file=input_file,
+                electrical_series_path=context.electrical_series_path
+            )
 
-        if context.test_duration_sec > 0:
-            recording = recording.frame_slice(0, int(recording.get_sampling_frequency() * context.test_duration_sec))
+            if context.test_duration_sec > 0:
+                recording = recording.frame_slice(0, int(recording.get_sampling_frequency() * context.test_duration_sec))
+        num_samples = recording.get_num_frames() * recording.get_num_channels()
 
         # Make sure the recording is preprocessed appropriately
         # lazy preprocessing
-        if context.preprocessing.filter:
-            print('Filtering on')
-            recording_filtered = spre.bandpass_filter(recording, freq_min=context.preprocessing.freq_min, freq_max=context.preprocessing.freq_max)
-        else:
-            print('Filtering off')
-            recording_filtered = recording
-        if context.preprocessing.whiten:
-            print('Whitening on')
-            # see comment below in _scale_recording_if_float_type
-            recording_scaled = _scale_recording_if_float_type(recording_filtered)
-            recording_preprocessed: si.BaseRecording = spre.whiten(
-                recording_scaled,
-                dtype='float32',
-                num_chunks_per_segment=1, # by default this is 20 which takes a long time to load depending on the chunking
-                chunk_size=int(1e5)
-            )
-        else:
-            print('Whitening off')
-            recording_preprocessed = recording_filtered
-        print_elapsed_time()
+        with profiler.stage('preprocess'):
+            if context.preprocessing.filter:
+                print('Filtering on')
+                recording_filtered = spre.bandpass_filter(recording, freq_min=context.preprocessing.freq_min, freq_max=context.preprocessing.freq_max)
+            else:
+                print('Filtering off')
+                recording_filtered = recording
+            if context.preprocessing.whiten:
+                print('Whitening on')
+                # see comment below in _scale_recording_if_float_type
+                recording_scaled = _scale_recording_if_float_type(recording_filtered)
+                recording_preprocessed: si.BaseRecording = spre.whiten(
+                    recording_scaled,
+                    dtype='float32',
+                    num_chunks_per_segment=1, # by default this is 20 which takes a long time to load depending on the chunking
+                    chunk_size=plan_chunk_size(recording_scaled, target_duration_sec=int(1e5) / recording_scaled.get_sampling_frequency())
+                )
+            else:
+                print('Whitening off')
+                recording_preprocessed = recording_filtered
 
         # Maybe sometime in the future we will spike sort while lazy loading
         # but for now we're going to download the entire recording to disk first.
         # Probably lazy loading in a smart way would be in order for scheme 3
         # at some point in the future.
-        print('Creating binary recording')
-        recording_binary = make_float32_recording(recording_preprocessed, dirname='preprocessed_recording')
-        print_elapsed_time()
-
-        print('Setting up sorting parameters')
-        scheme1_sorting_parameters = ms5.Scheme1SortingParameters(
-            detect_threshold=context.detect_threshold,
-            detect_channel_radius=context.scheme1_detect_channel_radius,
-            detect_time_radius_msec=context.detect_time_radius_msec,
-            detect_sign=context.detect_sign,
-            snippet_T1=context.snippet_T1,
-            snippet_T2=context.snippet_T2,
-            snippet_mask_radius=context.snippet_mask_radius,
-            npca_per_channel=context.npca_per_channel,
-            npca_per_subdivision=context.npca_per_subdivision
-        )
+        with profiler.stage('convert', num_samples=num_samples, num_bytes=num_samples * 4):
+            print('Creating binary recording')
+            recording_binary = make_float32_recording(recording_preprocessed, dirname='preprocessed_recording')
+
+        with profiler.stage('sort', num_samples=num_samples, num_bytes=num_samples * 4):
+            print('Setting up sorting parameters')
+            scheme1_sorting_parameters = ms5.Scheme1SortingParameters(
+                detect_threshold=context.detect_threshold,
+                detect_channel_radius=context.scheme1_detect_channel_radius,
+                detect_time_radius_msec=context.detect_time_radius_msec,
+                detect_sign=context.detect_sign,
+                snippet_T1=context.snippet_T1,
+                snippet_T2=context.snippet_T2,
+                snippet_mask_radius=context.snippet_mask_radius,
+                npca_per_channel=context.npca_per_channel,
+                npca_per_subdivision=context.npca_per_subdivision
+            )
 
-        scheme2_sorting_parameters = ms5.Scheme2SortingParameters(
-            phase1_detect_channel_radius=context.scheme2.scheme2_phase1_detect_channel_radius,
-            detect_channel_radius=context.scheme2.scheme2_detect_channel_radius,
-            phase1_detect_threshold=context.detect_threshold,
-            phase1_detect_time_radius_msec=context.detect_time_radius_msec,
-            detect_time_radius_msec=context.detect_time_radius_msec,
-            phase1_npca_per_channel=context.npca_per_channel,
-            phase1_npca_per_subdivision=context.npca_per_subdivision,
-            detect_sign=context.detect_sign,
-            detect_threshold=context.detect_threshold,
-            snippet_T1=context.snippet_T1,
-            snippet_T2=context.snippet_T2,
-            snippet_mask_radius=context.snippet_mask_radius,
-            max_num_snippets_per_training_batch=context.scheme2.scheme2_max_num_snippets_per_training_batch,
-            classifier_npca=None,
-            training_duration_sec=context.scheme2.scheme2_training_duration_sec,
-            training_recording_sampling_mode=context.scheme2.scheme2_training_recording_sampling_mode # type: ignore
-        )
+            scheme2_sorting_parameters = ms5.Scheme2SortingParameters(
+                phase1_detect_channel_radius=context.scheme2.scheme2_phase1_detect_channel_radius,
+                detect_channel_radius=context.scheme2.scheme2_detect_channel_radius,
+                phase1_detect_threshold=context.detect_threshold,
+                phase1_detect_time_radius_msec=context.detect_time_radius_msec,
+                detect_time_radius_msec=context.detect_time_radius_msec,
+                phase1_npca_per_channel=context.npca_per_channel,
+                phase1_npca_per_subdivision=context.npca_per_subdivision,
+                detect_sign=context.detect_sign,
+                detect_threshold=context.detect_threshold,
+                snippet_T1=context.snippet_T1,
+                snippet_T2=context.snippet_T2,
+                snippet_mask_radius=context.snippet_mask_radius,
+                max_num_snippets_per_training_batch=context.scheme2.scheme2_max_num_snippets_per_training_batch,
+                classifier_npca=None,
+                training_duration_sec=context.scheme2.scheme2_training_duration_sec,
+                training_recording_sampling_mode=context.scheme2.scheme2_training_recording_sampling_mode # type: ignore
+            )
 
-        scheme3_sorting_parameters = ms5.Scheme3SortingParameters(
-            block_sorting_parameters=scheme2_sorting_parameters, block_duration_sec=context.scheme3_block_duration_sec
-        )
+            scheme3_sorting_parameters = ms5.Scheme3SortingParameters(
+                block_sorting_parameters=scheme2_sorting_parameters, block_duration_sec=context.scheme3_block_duration_sec
+            )
+
+            if context.scheme == 1:
+                print('Sorting scheme 1')
+                sorting = ms5.sorting_scheme1(recording=recording_binary, sorting_parameters=scheme1_sorting_parameters)
+            elif context.scheme == 2:
+                print('Sorting scheme 2')
+                sorting = ms5.sorting_scheme2(recording=recording_binary, sorting_parameters=scheme2_sorting_parameters)
+            elif context.scheme == 3:
+                print('Sorting scheme 3')
+                sorting = ms5.sorting_scheme3(recording=recording_binary, sorting_parameters=scheme3_sorting_parameters)
+            else:
+                raise ValueError(f'Unexpected scheme: {context.scheme}')
 
-        if context.scheme == 1:
-            print('Sorting scheme 1')
-            sorting = ms5.sorting_scheme1(recording=recording_binary, sorting_parameters=scheme1_sorting_parameters)
-        elif context.scheme == 2:
-            print('Sorting scheme 2')
-            sorting = ms5.sorting_scheme2(recording=recording_binary, sorting_parameters=scheme2_sorting_parameters)
-        elif context.scheme == 3:
-            print('Sorting scheme 3')
-            sorting = ms5.sorting_scheme3(recording=recording_binary, sorting_parameters=scheme3_sorting_parameters)
-        else:
-            raise ValueError(f'Unexpected scheme: {context.scheme}')
-        print_elapsed_time()
+        with profiler.stage('write'):
+            print('Writing output NWB file')
+            h5_file = h5py.File(input_file, 'r')
+            with pynwb.NWBHDF5IO(file=h5_file, mode='r', load_namespaces=True) as io:
+                nwbfile_rec = io.read()
 
-        print('Writing output NWB file')
-        h5_file = h5py.File(input.get_file(), 'r')
-        with pynwb.NWBHDF5IO(file=h5_file, mode='r', load_namespaces=True) as io:
-            nwbfile_rec = io.read()
+                if not os.path.exists('output'):
+                    os.mkdir('output')
+                sorting_out_fname = 'output/sorting.nwb'
 
-            if not os.path.exists('output'):
-                os.mkdir('output')
-            sorting_out_fname = 'output/sorting.nwb'
+                create_sorting_out_nwb_file(nwbfile_rec=nwbfile_rec, sorting=sorting, sorting_out_fname=sorting_out_fname)
 
-            create_sorting_out_nwb_file(nwbfile_rec=nwbfile_rec, sorting=sorting, sorting_out_fname=sorting_out_fname)
-        print_elapsed_time()
+        with profiler.stage('upload'):
+            print('Uploading output NWB file')
+            output.upload(sorting_out_fname)
 
-        print('Uploading output NWB file')
-        output.upload(sorting_out_fname)
-        print_elapsed_time()
+        input_file.print_summary()
+        profiler.record_io(input_file.get_summary())
+        profiler.print_summary()
+        profiler.write_json('output/profile.json')
 
 
 app.add_processor(Mountainsort5DevProcessor)
 
 if __name__ == '__main__':
-    app.run()
+    if os.environ.get('WARM_WORKER_JOBS', None) is not None:
+        # run many local jobs in this process (see common/run_warm_worker.py)
+        from common.run_warm_worker import run_warm_worker
+        run_warm_worker(
+            processors=[Mountainsort5DevProcessor],
+            preload_modules=[
+                'numpy',
+                'h5py',
+                'pynwb',
+                'remfile',
+                'spikeinterface',
+                'spikeinterface.preprocessing',
+                'mountainsort5',
+                'common.NwbRecording',
+                'common.NwbSorting',
+                'common.create_sorting_out_nwb_file',
+                'common.StageProfiler',
+                'common.open_input_file',
+                'common.make_float32_recording',
+                'common._scale_recording_if_float_type'
+            ],
+            jobs=os.environ['WARM_WORKER_JOBS'],
+            work_dir=os.environ.get('WARM_WORKER_DIR', 'warm_worker_jobs')
+        )
+    else:
+        app.run()
@@ -0,0 +1,120 @@
+from typing import List, Union
+import numpy as np
+import numpy.typing as npt
+import h5py
+
+
+def compute_spike_count_pyramid(
+    h5_file: h5py.File, *,
+    spike_times_sec: npt.NDArray[np.float64],
+    spike_unit_indices: npt.NDArray[np.int32],
+    unit_ids: List[int],
+    num_levels: int,
+    level0_bin_size_sec: float = 0.001,
+    block_num_bins: int = 2 ** 20,
+    compression: str = 'gzip'
+):
+    """
+    Write a dyadic pyramid of per-unit binned spike counts to an open HDF5 file.
+
+    The spike vector (spike_times_sec, spike_unit_indices) must be sorted by time.
+    Level 0 uses bins of level0_bin_size_sec and each subsequent level doubles the
+    bin width. Each level is stored as a (num_bins, num_units) dataset named
+    level_<i> so that any time range at any resolution is a single contiguous slice.
+
+    The spike vector is consumed in one pass in blocks of block_num_bins level-0 bins.
+    Each block is binned once and then reduced pairwise to produce the coarser levels.
+    A bin that is left without its pair at the end of a block (at any level) is carried
+    over to the next block, so the block size does not depend on the number of levels
+    and memory use is bounded by the block size rather than the duration.
+    """
+    K = len(unit_ids)
+    L = num_levels
+    if L < 1:
+        raise ValueError(f'num_levels must be at least 1: {num_levels}')
+    if len(spike_times_sec) > 1 and np.any(np.diff(spike_times_sec) < 0):
+        raise ValueError('Spike times must be sorted')
+
+    # at most 2 ** 24 counts per block (128 MB for the int64 bincount) however many units there are
+    B = max(min(int(block_num_bins), 2 ** 24 // max(K, 1)), 1)
+
+    spike_bins = np.floor(spike_times_sec / level0_bin_size_sec).astype(np.int64)
+    if len(spike_bins) > 0 and spike_bins[0] < 0:
+        raise ValueError('Spike times must be non-negative')
+    num_bins0 = int(spike_bins[-1]) + 1 if len(spike_bins) > 0 else 0
+
+    h5_file.attrs['level0_bin_size_sec'] = level0_bin_size_sec
+    h5_file.attrs['num_levels'] = L
+    h5_file.create_dataset('unit_ids', data=np.array(unit_ids))
+    datasets: List[h5py.Dataset] = []
+    for level in range(L):
+        num_bins = int(np.ceil(num_bins0 / 2 ** level))
+        if num_bins > 0 and K > 0:
+            # chunk along time only (all units in each chunk) so that a time range is a contiguous read
+            chunk_num_bins = min(num_bins, max(1, 2 ** 16 // K))
+            ds = h5_file.create_dataset(
+                f'level_{level}',
+                shape=(num_bins, K),
+                dtype=np.int32,
+                chunks=(chunk_num_bins, K),
+                compression=compression
+            )
+        else:
+            ds = h5_file.create_dataset(f'level_{level}', shape=(num_bins, K), dtype=np.int32)
+        ds.attrs['bin_size_sec'] = level0_bin_size_sec * 2 ** level
+        datasets.append(ds)
+
+    # the number of bins written so far at each level
+    write_positions = [0] * L
+    # the bin at each level that is waiting for its pair (from the next block) to be reduced
+    carried: List[Union[np.ndarray, None]] = [None] * L
+
+    def add_bins(level: int, counts: np.ndarray, final: bool):
+        ds = datasets[level]
+        s1 = write_positions[level]
+        if counts.shape[0] > 0:
+            ds[s1:s1 + counts.shape[0], :] = counts
+            write_positions[level] = s1 + counts.shape[0]
+        if level + 1 == L:
+            return
+        if carried[level] is not None:
+            counts = np.concatenate([carried[level], counts], axis=0)
+            carried[level] = None
+        if counts.shape[0] % 2 == 1:
+            if final:
+                # the last bin of the coarser level only covers the end of the recording
+                counts = np.concatenate([counts, np.zeros((1, K), dtype=np.int32)], axis=0)
+            else:
+                carried[level] = counts[-1:]
+                counts = counts[:-1]
+        if counts.shape[0] > 0 or final:
+            add_bins(level + 1, counts[0::2] + counts[1::2], final)
+
+    num_blocks = int(np.ceil(num_bins0 / B))
+    for i in range(num_blocks):
+        bin_start = i * B
+        bin_end = min(bin_start + B, num_bins0)
+        # spikes are sorted, so each block is a contiguous slice of the spike vector
+        i1 = np.searchsorted(spike_bins, bin_start, side='left')
+        i2 = np.searchsorted(spike_bins, bin_end, side='left')
+        counts = np.bincount(
+            (spike_bins[i1:i2] - bin_start) * K + spike_unit_indices[i1:i2],
+            minlength=(bin_end - bin_start) * K
+        ).astype(np.int32).reshape(bin_end - bin_start, K)
+        add_bins(0, counts, final=i == num_blocks - 1)
+    for level in range(L):
+        assert write_positions[level] == datasets[level].shape[0]
+
+
+def get_sorted_spike_vector_from_units_table(h5_file: h5py.File):
+    """
+    Read the NWB units table and return (unit_ids, spike_times_sec, spike_unit_indices)
+    with the spike vector sorted by time.
+    """
+    unit_ids: np.ndarray = h5_file['units']['id'][:] # type: ignore
+    spike_times_index: np.ndarray = h5_file['units']['spike_times_index'][:] # type: ignore
+    spike_times: np.ndarray = h5_file['units']['spike_times'][:] # type: ignore
+    counts = np.diff(np.concatenate([[0], spike_times_index]))
+    spike_unit_indices = np.repeat(np.arange(len(unit_ids), dtype=np.int32), counts)
+    sort_inds = np.argsort(spike_times, kind='stable')
+    return unit_ids, spike_times[sort_inds], spike_unit_indices[sort_inds]
@@ -0,0 +1,33 @@
+from typing import List
+import spikeinterface as si
+from .compute_correlogram_data import compute_correlogram_data
+
+
+def create_autocorrelograms_figurl(sorting: si.BaseSorting, *, label: str = 'Autocorrelograms') -> str:
+    """Compute the autocorrelogram of each unit and return the figurl URL of the view"""
+    import sortingview.views as vv
+
+    autocorrelogram_items: List[vv.AutocorrelogramItem] = []
+    for unit_id in sorting.get_unit_ids():
+        a = compute_correlogram_data(sorting=sorting, unit_id1=unit_id, unit_id2=None, window_size_msec=50, bin_size_msec=1)
+        bin_edges_sec = a['bin_edges_sec']
+        bin_counts = a['bin_counts']
+        autocorrelogram_items.append(
+            vv.AutocorrelogramItem(
+                unit_id=unit_id,
+                bin_edges_sec=bin_edges_sec,
+                bin_counts=bin_counts
+            )
+        )
+    view = vv.Autocorrelograms(
+        autocorrelograms=autocorrelogram_items
+    )
+    return view.url(label=label)
+
+def create_autocorrelograms_figurl_for_input(*, sorting_input, label: str) -> str:
+    # runs in a worker process of the batch processor
+    from common.NwbSorting import NwbSorting
+    from common.open_input_file import open_input_file
+    sorting_file = open_input_file(sorting_input, label=label)
+    nwb_sorting = NwbSorting(sorting_file)
+    return create_autocorrelograms_figurl(nwb_sorting, label=f'Autocorrelograms {label}')
@@ -34,10 +34,12 @@ class SpikeSortingFigurlProcessor(ProcessorBase):
         import remfile
         # from common.NwbRecording import NwbRecording
         from common.NwbSorting import NwbSorting
-        import sortingview.views as vv
-        from helpers.compute_correlogram_data import compute_correlogram_data
+        from helpers.create_autocorrelograms_figurl import create_autocorrelograms_figurl
+        from common.StageProfiler import StageProfiler
+        from common.open_input_file import open_input_file
 
         print('Starting spike_sorting_figurl')
+        profiler = StageProfiler('spike_sorting_figurl')
         recording_nwb_url = context.recording.get_url()
         sorting_nwb_url = context.sorting.get_url()
         print(f'Input recording NWB URL: {recording_nwb_url}')
@@ -55,31 +57,18 @@ class SpikeSortingFigurlProcessor(ProcessorBase):
         #     electrical_series_path=context.electrical_series_path
         # )
 
-        print('Opening remote input sorting file')
-        sorting_remf = remfile.File(sorting_nwb_url)
-        nwb_sorting = NwbSorting(sorting_remf)
+        with profiler.stage('open'):
+            print('Opening remote input sorting file')
+            sorting_remf = open_input_file(context.sorting, label='sorting')
+            nwb_sorting = NwbSorting(sorting_remf)
 
         # freq_min = 300
         # freq_max = 6000
         # recording_filtered = spre.bandpass_filter(nwb_recording, freq_min=freq_min, freq_max=freq_max)
 
-        print('Computing autocorrelograms')
-        autocorrelogram_items: List[vv.AutocorrelogramItem] = []
-        for unit_id in nwb_sorting.get_unit_ids():
-            a = compute_correlogram_data(sorting=nwb_sorting, unit_id1=unit_id, unit_id2=None, window_size_msec=50, bin_size_msec=1)
-            bin_edges_sec = a['bin_edges_sec']
-            bin_counts = a['bin_counts']
-            autocorrelogram_items.append(
-                vv.AutocorrelogramItem(
-                    unit_id=unit_id,
-                    bin_edges_sec=bin_edges_sec,
-                    bin_counts=bin_counts
-                )
-            )
-        view = vv.Autocorrelograms(
-            autocorrelograms=autocorrelogram_items
-        )
-        output_url = view.url(label='Autocorrelograms')
+        with profiler.stage('compute'):
+            print('Computing autocorrelograms')
+            output_url = create_autocorrelograms_figurl(nwb_sorting)
 
         if not os.path.exists('output'):
             os.mkdir('output')
@@ -88,12 +77,191 @@ class SpikeSortingFigurlProcessor(ProcessorBase):
         with open(output_fname, 'w') as f:
             f.write(output_url)
 
-        print('Uploading output file')
-        context.output.upload(output_fname)
+        with profiler.stage('upload'):
+            print('Uploading output file')
+            context.output.upload(output_fname)
+
+        sorting_remf.print_summary()
+        profiler.record_io(sorting_remf.get_summary())
+        profiler.print_summary()
+        profiler.write_json('output/profile.json')
+
+
+class SpikeCountPyramidContext(BaseModel):
+    sorting: InputFile = Field(description='sorting .nwb file')
+    output: OutputFile = Field(description='output .h5 file')
+    num_levels: int = Field(default=0, description='Number of levels in the pyramid (0 means enough levels for the coarsest bin to span the whole recording)')
+    compression: str = Field(default='gzip', description='HDF5 compression filter', json_schema_extra={'options': ['gzip', 'lzf']})
+
+
+class SpikeCountPyramidProcessor(ProcessorBase):
+    name = 'spike_count_pyramid'
+    description = 'Precompute a multi-resolution pyramid of per-unit binned spike counts. Level 0 uses 1 ms bins and each subsequent level doubles the bin width.'
+    label = 'Spike count pyramid'
+    tags = ['spike_sorting', 'spike_count_pyramid']
+    attributes = {'wip': True}
+    @staticmethod
+    def run(context: SpikeCountPyramidContext):
+        import numpy as np
+        import h5py
+        from helpers.compute_spike_count_pyramid import compute_spike_count_pyramid, get_sorted_spike_vector_from_units_table
+        from common.StageProfiler import StageProfiler
+        from common.open_input_file import open_input_file
+
+        print('Starting spike_count_pyramid')
+        profiler = StageProfiler('spike_count_pyramid')
+        sorting_nwb_url = context.sorting.get_url()
+        print(f'Input sorting NWB URL: {sorting_nwb_url}')
+
+        with profiler.stage('open'):
+            print('Loading spike vector')
+            sorting_remf = open_input_file(context.sorting, label='sorting')
+            with h5py.File(sorting_remf, 'r') as f:
+                unit_ids, spike_times_sec, spike_unit_indices = get_sorted_spike_vector_from_units_table(f)
+        print(f'Num. units: {len(unit_ids)}; num. spikes: {len(spike_times_sec)}')
+
+        level0_bin_size_sec = 0.001
+        num_levels = context.num_levels
+        if num_levels <= 0:
+            num_bins0 = int(np.floor(spike_times_sec[-1] / level0_bin_size_sec)) + 1 if len(spike_times_sec) > 0 else 1
+            num_levels = int(np.ceil(np.log2(num_bins0))) + 1
+        print(f'Num. levels: {num_levels}')
+
+        if not os.path.exists('output'):
+            os.mkdir('output')
+        output_fname = 'output/spike_count_pyramid.h5'
+
+        with profiler.stage('compute'):
+            print('Computing spike count pyramid')
+            with h5py.File(output_fname, 'w') as f:
+                compute_spike_count_pyramid(
+                    f,
+                    spike_times_sec=spike_times_sec,
+                    spike_unit_indices=spike_unit_indices,
+                    unit_ids=list(unit_ids),
+                    num_levels=num_levels,
+                    level0_bin_size_sec=level0_bin_size_sec,
+                    compression=context.compression
+                )
+
+        with profiler.stage('upload'):
+            print('Uploading output file')
+            context.output.upload(output_fname)
+
+        sorting_remf.print_summary()
+        profiler.record_io(sorting_remf.get_summary())
+        profiler.print_summary()
+        profiler.write_json('output/profile.json')
+
+
+
+class SpikeSortingFigurlBatchContext(BaseModel):
+    recordings: List[InputFile] = Field(description='recording .nwb files')
+    sortings: List[InputFile] = Field(description='sorting .nwb files, one per recording')
+    output: OutputFile = Field(description='output .json file with the figurl URL (or the error) for each sorting')
+    electrical_series_paths: List[str] = Field(description='Path to the electrical series in each recording NWB file (one per recording, or a single path for all of them)')
+    max_workers: int = Field(default=4, description='Number of sortings processed in parallel')
+    memory_budget_gb: float = Field(default=0, description='Estimated memory that the parallel workers may use together (0 means 80% of the available memory)')
+
+
+class SpikeSortingFigurlBatchProcessor(ProcessorBase):
+    name = 'spike_sorting_figurl_batch'
+    description = 'Create summary data for many spike sorting runs in a single job, on a local process pool'
+    label = 'Spike sorting figurl batch'
+    tags = ['spike_sorting', 'spike_sorting_figurl']
+    attributes = {'wip': True}
+    @staticmethod
+    def run(context: SpikeSortingFigurlBatchContext):
+        import json
+        import h5py
+        from common.StageProfiler import StageProfiler
+        from common.open_input_file import open_input_file
+        from common.BatchScheduler import BatchScheduler
+        from common.get_available_memory_bytes import get_available_memory_bytes
+        from helpers.create_autocorrelograms_figurl import create_autocorrelograms_figurl_for_input
+
+        print('Starting spike_sorting_figurl_batch')
+        profiler = StageProfiler('spike_sorting_figurl_batch')
+
+        if len(context.sortings) != len(context.recordings):
+            raise Exception(f'Number of sortings ({len(context.sortings)}) does not match number of recordings ({len(context.recordings)})')
+        if len(context.electrical_series_paths) not in [1, len(context.recordings)]:
+            raise Exception(f'Expected 1 or {len(context.recordings)} electrical series paths, got {len(context.electrical_series_paths)}')
+
+        with profiler.stage('open'):
+            tasks = []
+            for ii, sorting_input in enumerate(context.sortings):
+                # the autocorrelograms work on the spike trains, so the memory is estimated from the number of spikes
+                sorting_file = open_input_file(sorting_input, label=f'sorting_{ii}')
+                with h5py.File(sorting_file, 'r') as f:
+                    num_spikes = f['units']['spike_times'].shape[0]
+                tasks.append({
+                    'label': f'sorting {ii}',
+                    'kwargs': {
+                        'sorting_input': sorting_input,
+                        'label': f'sorting_{ii}'
+                    },
+                    'memory_bytes': num_spikes * 8 * 8,
+                    'disk_bytes': 0
+                })
+
+        memory_budget_bytes = int(context.memory_budget_gb * 1e9) if context.memory_budget_gb > 0 else int(get_available_memory_bytes() * 0.8)
+        with profiler.stage('compute'):
+            scheduler = BatchScheduler(max_workers=context.max_workers, max_memory_bytes=memory_budget_bytes, max_disk_bytes=0)
+            results = scheduler.run(create_autocorrelograms_figurl_for_input, tasks)
+
+        if not os.path.exists('output'):
+            os.mkdir('output')
+        output_fname = 'output/output.json'
+        items = []
+        for ii, r in enumerate(results):
+            items.append({
+                'index': ii,
+                'electrical_series_path': context.electrical_series_paths[ii] if len(context.electrical_series_paths) > 1 else context.electrical_series_paths[0],
+                'figurl': r if not isinstance(r, BaseException) else None,
+                'error': str(r) if isinstance(r, BaseException) else None
+            })
+        with open(output_fname, 'w') as f:
+            json.dump(items, f, indent=2)
+
+        with profiler.stage('upload'):
+            print('Uploading output file')
+            context.output.upload(output_fname)
+
+        profiler.print_summary()
+        profiler.write_json('output/profile.json')
+
+        failed = [item for item in items if item['error'] is not None]
+        if len(failed) > 0:
+            raise Exception(f'Failed for {len(failed)} of {len(items)} sortings: ' + '; '.join(f'sorting {item["index"]}: {item["error"]}' for item in failed))
 
 
 app.add_processor(SpikeSortingFigurlProcessor)
+app.add_processor(SpikeCountPyramidProcessor)
+app.add_processor(SpikeSortingFigurlBatchProcessor)
 
 
 if __name__ == '__main__':
-    app.run()
+    if os.environ.get('WARM_WORKER_JOBS', None) is not None:
+        # run many local jobs in this process (see common/run_warm_worker.py)
+        from common.run_warm_worker import run_warm_worker
+        run_warm_worker(
+            processors=[SpikeSortingFigurlProcessor, SpikeCountPyramidProcessor, SpikeSortingFigurlBatchProcessor],
+            preload_modules=[
+                'numpy',
+                'h5py',
+                'remfile',
+                'spikeinterface',
+                'sortingview.views',
+                'common.NwbSorting',
+                'common.StageProfiler',
+                'common.open_input_file',
+                'common.BatchScheduler',
+                'helpers.create_autocorrelograms_figurl',
+                'helpers.compute_spike_count_pyramid'
+            ],
+            jobs=os.environ['WARM_WORKER_JOBS'],
+            work_dir=os.environ.get('WARM_WORKER_DIR', 'warm_worker_jobs')
+        )
+    else:
+        app.run()